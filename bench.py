@@ -0,0 +1,830 @@
+import argparse
+import contextlib
+import io
+import time
+import os
+import re
+import tracemalloc
+from trie import TRIE_TYPES
+
+
+def timed(fn, repeat=5):
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def read_words(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def bench_trie(arguments):
+    words = read_words(arguments.w)
+    prefixes = ['', 't', 'th', 'pre', 'con', 'zz']
+    print(f'{len(words)} words from {arguments.w}')
+    print(f'{"trie":<10}{"memory (MB)":>14}{"build (s)":>12}  get_words(prefix) (ms)')
+    for kind in ['dict', 'compact']:
+        cls = TRIE_TYPES[kind]
+        def build():
+            trie = cls()
+            for word in words:
+                trie.add_word(word)
+            trie.get_words('zz')
+            return trie
+        tracemalloc.start()
+        trie = build()
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del trie
+        build_time, trie = timed(build, 1)
+        latencies = []
+        for prefix in prefixes:
+            best, _ = timed(lambda: trie.get_words(prefix), arguments.r)
+            latencies.append(f'{prefix!r}: {best * 1000:.2f}')
+        print(f'{kind:<10}{memory / 2**20:>14.2f}{build_time:>12.3f}  {", ".join(latencies)}')
+        latencies = []
+        for prefix in prefixes:
+            best, _ = timed(lambda: trie.top_k(prefix, arguments.k), arguments.r)
+            latencies.append(f'{prefix!r}: {best * 1000:.2f}')
+        print(f'{"":<36}  top_k(prefix, {arguments.k}) (ms)')
+        print(f'{"":<36}  {", ".join(latencies)}')
+
+
+def bench_load(arguments):
+    from ngram import NGramModel
+    from neural import NeuralPredictor
+    for path in arguments.m:
+        for kind in TRIE_TYPES:
+            if os.path.isfile(path):
+                load = lambda: NGramModel.load(path, trie=kind)
+            elif os.path.isfile(os.path.join(path, 'state.pt')):
+                load = lambda: NeuralPredictor.load(path, device='cpu', trie=kind)
+            else:
+                # No weights saved, time the vocabulary and trie part only.
+                words = read_words(os.path.join(path, 'words.txt'))
+                sidecar = os.path.join(path, 'words.trie')
+                load = lambda: NeuralPredictor(device='cpu', trie=kind).learn_words(words, sidecar=sidecar)
+            best, _ = timed(load, arguments.r)
+            print(f'{path:<28}{kind:<10}{best:.3f} s')
+
+
+def bench_fuzzy(arguments):
+    words = read_words(arguments.w)
+    counts = [(word, 1) for word in words]
+    prefixes = ['teh', 'becuase', 'presidnet', 'gvoernment', 'xq']
+    print(f'{len(words)} words from {arguments.w}, budget {arguments.b} ms per keystroke')
+    for kind in ['dict', 'compact']:
+        cls = TRIE_TYPES[kind]
+        trie = cls.from_counts(counts)
+        for max_edits in [0, 1, 2]:
+            latencies = []
+            for prefix in prefixes:
+                if max_edits == 0:
+                    best, result = timed(lambda: trie.get_words(prefix), arguments.r)
+                else:
+                    best, result = timed(lambda: trie.get_words_fuzzy(prefix, max_edits), arguments.r)
+                flag = '' if best * 1000 <= arguments.b else '!'
+                latencies.append(f'{prefix}: {best * 1000:.2f}{flag} ({len(result[1])})')
+            print(f'{kind:<10}max_edits={max_edits}  ms (matches): {", ".join(latencies)}')
+
+
+def read_samples(path, limit=None):
+    samples = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if limit is not None and len(samples) >= limit:
+                break
+            context, label = line.strip().split(',')
+            samples.append((context, label))
+    return samples
+
+
+def bench_completions(arguments):
+    from ngram import NGramModel
+    model = NGramModel.load(arguments.m, frozen=arguments.f)
+    samples = read_samples(arguments.d, arguments.n)
+    start = time.perf_counter()
+    for context, _ in samples:
+        model.completions(context, '', arguments.k)
+    elapsed = time.perf_counter() - start
+    print(f'{len(samples)} completions on {arguments.m}: {elapsed / len(samples) * 1000:.2f} ms per call')
+
+
+def bench_typing(arguments):
+    # Replays typing each label one keystroke at a time in its context.
+    from ngram import NGramModel
+    samples = read_samples(arguments.d, arguments.n)
+    for cache_size in [0, arguments.c]:
+        model = NGramModel.load(arguments.m, stub_cache_size=cache_size)
+        calls = 0
+        start = time.perf_counter()
+        for context, label in samples:
+            for i in range(len(label)):
+                model.completions(context, label[:i], arguments.k)
+                calls += 1
+        elapsed = time.perf_counter() - start
+        info = model.stub_cache_info()
+        print(f'cache size {cache_size:<6}{elapsed / calls * 1000:.2f} ms per keystroke, {info["hits"]} hits, {info["misses"]} misses')
+
+
+def bench_memory(arguments):
+    from ngram import NGramModel
+    print(f'{"stores":<10}{"model (MB)":>12}{"load (s)":>10}')
+    for frozen in [False, True]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        model = NGramModel.load(arguments.m, frozen=frozen)
+        elapsed = time.perf_counter() - start
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del model
+        name = 'frozen' if frozen else 'dict'
+        print(f'{name:<10}{memory / 2**20:>12.2f}{elapsed:>10.2f}')
+
+
+def bench_train(arguments):
+    from ngram import NGramModel
+    from data import DataLoader
+    source = DataLoader(arguments.d)
+    print(f'{arguments.k}-gram training on {arguments.d}, {os.cpu_count()} cores')
+    for jobs in range(1, arguments.j + 1):
+        start = time.perf_counter()
+        model = NGramModel(arguments.k)
+        if jobs > 1:
+            model.learn_parallel(source, jobs)
+        else:
+            for sample in source.labeled_samples():
+                model.learn_sample(*sample)
+        elapsed = time.perf_counter() - start
+        print(f'{jobs} processes: {elapsed:.2f} s')
+
+
+class Limited:
+    # The first n samples of a DataLoader, for eval.evaluate.
+    def __init__(self, source, n):
+        self._source = source
+        self._n = n
+
+
+    def labeled_samples(self):
+        for i, sample in zip(range(self._n), self._source.labeled_samples()):
+            yield sample
+
+
+def bench_prune(arguments):
+    from ngram import NGramModel
+    from data import DataLoader
+    from eval import evaluate
+    source = Limited(DataLoader(arguments.d), arguments.n)
+    k = [1, 3, 5]
+    settings = [('none', {})]
+    settings += [(f'min count {c}', {'min_counts': [c]}) for c in arguments.c]
+    settings += [(f'{size} MB', {'max_bytes': int(size * 2**20)}) for size in arguments.b]
+    print(f'{"pruning":<14}{"size (MB)":>10}{"prune (s)":>10}  ' + '  '.join(f'top {i}' for i in k))
+    for name, options in settings:
+        model = NGramModel.load(arguments.m)
+        start = time.perf_counter()
+        if options:
+            model.prune(**options)
+        elapsed = time.perf_counter() - start
+        with contextlib.redirect_stdout(io.StringIO()):
+            acc, _, _ = evaluate(model, source, k)
+        print(f'{name:<14}{model.nbytes() / 2**20:>10.2f}{elapsed:>10.2f}  ' + '  '.join(f'{a:.3f}' for a in acc))
+
+
+def bench_scoring(arguments):
+    from ngram import NGramModel, SCORINGS
+    from data import DataLoader
+    from eval import evaluate
+    source = Limited(DataLoader(arguments.d), arguments.n)
+    samples = read_samples(arguments.d, arguments.n)
+    k = [1, 3, 5]
+    print(f'{"scoring":<16}{"ms per call":>12}{"ms per keystroke":>18}  ' + '  '.join(f'top {i}' for i in k))
+    for scoring in SCORINGS:
+        model = NGramModel.load(arguments.m, frozen=True, scoring=scoring)
+        model.completions('', '', 1)
+        start = time.perf_counter()
+        for context, _ in samples:
+            model.completions(context, '', arguments.k)
+        per_call = (time.perf_counter() - start) / len(samples)
+        calls = 0
+        start = time.perf_counter()
+        for context, label in samples:
+            for i in range(len(label)):
+                model.completions(context, label[:i], arguments.k)
+                calls += 1
+        per_keystroke = (time.perf_counter() - start) / calls
+        with contextlib.redirect_stdout(io.StringIO()):
+            acc, _, _ = evaluate(model, source, k)
+        print(f'{scoring:<16}{per_call * 1000:>12.2f}{per_keystroke * 1000:>18.2f}  ' + '  '.join(f'{a:.3f}' for a in acc))
+
+
+def bench_observe(arguments):
+    # The completion right after observing each sample, as when a suggestion
+    # is accepted, against the same completion again without one.
+    from ngram import NGramModel, SCORINGS
+    samples = read_samples(arguments.d, arguments.n)
+    print(f'{"scoring":<16}{"trie":<10}{"warm (ms)":>10}{"after observe (ms)":>20}')
+    for scoring in SCORINGS:
+        for trie in arguments.t:
+            model = NGramModel.load(arguments.m, trie=trie, scoring=scoring)
+            model.completions('', '', arguments.k)
+            warm = observed = 0.0
+            for context, label in samples:
+                model.completions(context, '', arguments.k)
+                start = time.perf_counter()
+                model.completions(context, '', arguments.k)
+                warm += time.perf_counter() - start
+                model.observe(context, label)
+                start = time.perf_counter()
+                model.completions(context, '', arguments.k)
+                observed += time.perf_counter() - start
+            print(f'{scoring:<16}{trie:<10}{warm / len(samples) * 1000:>10.2f}{observed / len(samples) * 1000:>20.2f}')
+
+
+def bench_sketch(arguments):
+    from ngram import NGramModel
+    from data import DataLoader
+    from eval import evaluate
+    source = Limited(DataLoader(arguments.d), arguments.n)
+    samples = read_samples(arguments.d, arguments.n)
+    k = [1, 3, 5]
+    exact = NGramModel.load(arguments.m)
+    approx_orders = range(arguments.a, exact._n + 1)
+    print(f'orders {approx_orders.start}-{approx_orders.stop - 1} sketched, depth {arguments.r}')
+    print(f'{"store":<14}{"model (MB)":>11}{"traced (MB)":>12}{"ms per call":>12}{"same top 5":>11}  ' + '  '.join(f'top {i}' for i in k))
+    expected = [exact.completions(context, '', 5)[0] for context, _ in samples]
+    for width in [None] + arguments.w:
+        tracemalloc.start()
+        if width is None:
+            model = NGramModel.load(arguments.m)
+        else:
+            model = NGramModel.load(arguments.m, approx_orders=approx_orders, sketch_width=width, sketch_depth=arguments.r)
+        traced, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        start = time.perf_counter()
+        same = 0
+        for (context, _), top in zip(samples, expected):
+            same += model.completions(context, '', 5)[0] == top
+        per_call = (time.perf_counter() - start) / len(samples)
+        with contextlib.redirect_stdout(io.StringIO()):
+            acc, _, _ = evaluate(model, source, k)
+        name = 'exact' if width is None else f'width {width}'
+        print(f'{name:<14}{model.nbytes() / 2**20:>11.2f}{traced / 2**20:>12.2f}{per_call * 1000:>12.2f}{same / len(samples):>11.3f}  ' + '  '.join(f'{a:.3f}' for a in acc))
+
+
+def rss():
+    # Resident set size of this process in bytes, Linux only.
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def pss():
+    # Proportional set size of this process in bytes, shared pages split
+    # between the processes that map them. Linux only.
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def quantized_run(job):
+    # One model in a fresh process, so the growth of its RSS is down to
+    # loading and using that model alone.
+    path, bits, data, limit = job
+    from ngram import NGramModel
+    from data import DataLoader
+    from eval import evaluate
+    source = Limited(DataLoader(data), limit)
+    samples = read_samples(data, limit)
+    before = rss()
+    model = NGramModel.load(path, frozen=True)
+    if bits is not None:
+        model.quantize(bits)
+    top = [model.completions(context, '', 5)[0] for context, _ in samples]
+    with contextlib.redirect_stdout(io.StringIO()):
+        acc, _, _ = evaluate(model, source, [1, 3, 5])
+    return model.nbytes(), rss() - before, top, acc
+
+
+def bench_quantize(arguments):
+    # Text models are quantized after loading, binary ones are converted
+    # first and then mapped as they are.
+    import multiprocessing
+    import tempfile
+    from ngram import NGramModel
+    k = [1, 3, 5]
+    print(f'{"counts":<14}{"model (MB)":>11}{"RSS (MB)":>10}{"same top 5":>11}  ' + '  '.join(f'top {i}' for i in k))
+    with tempfile.TemporaryDirectory() as tmp:
+        jobs = []
+        for bits in [None, 16, 8]:
+            name = 'exact' if bits is None else f'{bits} bit'
+            jobs.append((f'{name}, text', (arguments.m, bits, arguments.d, arguments.n)))
+        for bits in [None, 16, 8]:
+            model = NGramModel.load(arguments.m)
+            if bits is not None:
+                model.quantize(bits)
+            path = os.path.join(tmp, f'{bits}.bin')
+            model.save(path, binary=True)
+            name = 'exact' if bits is None else f'{bits} bit'
+            jobs.append((f'{name}, binary', (path, None, arguments.d, arguments.n)))
+        expected = None
+        for name, job in jobs:
+            with multiprocessing.Pool(1) as pool:
+                size, grown, top, acc = pool.apply(quantized_run, (job,))
+            if expected is None:
+                expected = top
+            same = sum(a == b for a, b in zip(top, expected)) / len(top)
+            print(f'{name:<14}{size / 2**20:>11.2f}{grown / 2**20:>10.2f}{same:>11.3f}  ' + '  '.join(f'{a:.3f}' for a in acc))
+
+
+def bench_batch(arguments):
+    from ngram import NGramModel
+    from neural import NeuralPredictor
+    from data import DataLoader
+    from eval import evaluate
+    source = Limited(DataLoader(arguments.d), arguments.n)
+    k = [1, 3, 5]
+    print(f'{"model":<24}{"batch":>6}{"ms per sample":>15}  ' + '  '.join(f'top {i}' for i in k))
+    for path in arguments.m:
+        if os.path.isdir(path):
+            model = NeuralPredictor.load(path)
+        else:
+            model = NGramModel.load(path)
+        for batch_size in arguments.b:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                acc, _, total = evaluate(model, source, k, batch_size)
+            per_sample = (time.perf_counter() - start) / total
+            print(f'{path:<24}{batch_size:>6}{per_sample * 1000:>15.2f}  ' + '  '.join(f'{a:.3f}' for a in acc))
+
+
+def bench_topk(arguments):
+    # Completions for the first few keystrokes of each label, scored
+    # exhaustively and with the upper bound pruned top-k search.
+    from ngram import NGramModel
+    samples = read_samples(arguments.d, arguments.n)
+    exhaustive = NGramModel.load(arguments.m)
+    exhaustive._TOP_K_MIN_CANDIDATES = float('inf')
+    pruned = NGramModel.load(arguments.m)
+    print(f'{"prefix":<8}{"candidates":>11}{"exhaustive (ms)":>16}{"top-k (ms)":>11}{"same":>6}')
+    for length in range(arguments.p + 1):
+        queries = [(context, label[:length]) for context, label in samples if len(label) > length]
+        candidates = sum(len(exhaustive._trie.get_words(prefix)[1]) for _, prefix in queries) / len(queries)
+        times = []
+        results = []
+        for model in [exhaustive, pruned]:
+            model.completions('', '', 1)
+            start = time.perf_counter()
+            results.append([model.completions(context, prefix, arguments.k)[0] for context, prefix in queries])
+            times.append((time.perf_counter() - start) / len(queries))
+        same = sum(a == b for a, b in zip(*results)) / len(queries)
+        print(f'{length:<8}{candidates:>11.0f}{times[0] * 1000:>16.2f}{times[1] * 1000:>11.2f}{same:>6.3f}')
+
+
+def bench_startup(arguments):
+    # Time from loading a text model to its first suggestion, and until all
+    # its orders are read. The first lazy load has no section offsets yet.
+    from ngram import NGramModel
+    print(f'{"model":<24}{"trie":<8}{"load":<16}{"first (s)":>10}{"all (s)":>9}')
+    for path in arguments.m:
+        for kind in arguments.t:
+            if os.path.isfile(f'{path}.sections'):
+                os.remove(f'{path}.sections')
+            for name, lazy in [('eager', False), ('lazy', True), ('lazy, sections', True)]:
+                start = time.perf_counter()
+                model = NGramModel.load(path, trie=kind, lazy=lazy)
+                model.completions('', '', arguments.k)
+                first = time.perf_counter() - start
+                model._ngram_stores.items()
+                everything = time.perf_counter() - start
+                print(f'{path:<24}{kind:<8}{name:<16}{first:>10.3f}{everything:>9.3f}')
+                # The background thread writes the offsets once it is done.
+                if lazy:
+                    model._ngram_stores._thread.join()
+
+
+def shared_worker(path, name, data, limit, queue, done):
+    # Scores without eval.py, whose imports would swamp the model's memory.
+    from ngram import NGramModel
+    samples = read_samples(data, limit)
+    before = pss(), rss()
+    start = time.perf_counter()
+    if name is None:
+        model = NGramModel.load(path, frozen=True)
+    else:
+        model = NGramModel.attach(name)
+    elapsed = time.perf_counter() - start
+    hits = sum(label in model.completions(context, '', 5)[0] for context, label in samples)
+    queue.put((pss() - before[0], rss() - before[1], elapsed, hits / len(samples)))
+    # Measured while all the workers are alive, so shared pages are split
+    # between them.
+    done.wait()
+
+
+def bench_shared(arguments):
+    # Workers that each load the model against workers that attach to one
+    # copy in shared memory.
+    import multiprocessing
+    from ngram import NGramModel
+    model = NGramModel.load(arguments.m, frozen=True)
+    shm = model.share()
+    print(f'{"workers":<8}{"model":<10}{"total PSS (MB)":>15}{"RSS each (MB)":>15}{"load (s)":>10}{"top 5":>7}')
+    print('memory grown by loading and using the model')
+    try:
+        for workers in arguments.j:
+            for name in [None, shm.name]:
+                queue = multiprocessing.Queue()
+                done = multiprocessing.Event()
+                processes = [multiprocessing.Process(target=shared_worker, args=(arguments.m, name, arguments.d, arguments.n, queue, done)) for _ in range(workers)]
+                for process in processes:
+                    process.start()
+                results = [queue.get() for _ in processes]
+                done.set()
+                for process in processes:
+                    process.join()
+                kind = 'loaded' if name is None else 'attached'
+                total = sum(r[0] for r in results) / 2**20
+                each = sum(r[1] for r in results) / len(results) / 2**20
+                load = max(r[2] for r in results)
+                print(f'{workers:<8}{kind:<10}{total:>15.1f}{each:>15.1f}{load:>10.3f}{results[0][3]:>7.3f}')
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def corpus_worker(kind, path, queue):
+    # Reads the whole corpus in a fresh process, so its peak RSS is the
+    # reader's alone.
+    import resource
+    from data import DataSource, DataLoader
+    start = time.perf_counter()
+    if kind == 'loader':
+        lines = sum(1 for _ in DataLoader(path).sentences())
+    else:
+        lines = sum(1 for _ in DataSource(os.path.dirname(path)).sentences())
+    elapsed = time.perf_counter() - start
+    queue.put((lines, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+
+
+def bench_corpus(arguments):
+    # Peak memory and time of reading corpora of growing size. DataSource
+    # detects the encoding on its first read and takes it from the manifest
+    # after that.
+    import multiprocessing
+    import tempfile
+    context = multiprocessing.get_context('spawn')
+    with open(arguments.d, 'rb') as f:
+        data = f.read()
+    print(f'{"corpus (MB)":<12}{"reader":<18}{"lines":>10}{"time (s)":>10}{"peak RSS (MB)":>15}')
+    for size in arguments.s:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'corpus.txt')
+            with open(path, 'wb') as f:
+                for _ in range(max(1, size * 2**20 // len(data))):
+                    f.write(data)
+            # Written last, so neither reader rebuilds its vocabulary.
+            for vocab in [f'{path}__vocab.txt', os.path.join(directory, 'vocab.txt')]:
+                open(vocab, 'w').close()
+            for kind, name in [('loader', 'DataLoader'), ('source', 'DataSource'), ('source', 'DataSource, cached')]:
+                queue = context.Queue()
+                process = context.Process(target=corpus_worker, args=(kind, path, queue))
+                process.start()
+                lines, elapsed, peak = queue.get()
+                process.join()
+                print(f'{size:<12}{name:<18}{lines:>10}{elapsed:>10.2f}{peak / 2**20:>15.1f}')
+
+
+def bench_vocab(arguments):
+    # Vocabulary building for a DataSource directory: counted from scratch
+    # with 1 to -j processes, then after its files are touched, then with
+    # another min_freq.
+    import tempfile
+    from data import DataSource, VOCAB_COUNTS
+    with open(arguments.d, 'rb') as f:
+        data = f.read()
+    print(f'{arguments.s} MB corpus, {os.cpu_count()} cores')
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, f'corpus{i}.txt') for i in range(arguments.f)]
+        for path in paths:
+            with open(path, 'wb') as f:
+                for _ in range(max(1, arguments.s * 2**20 // len(data) // arguments.f)):
+                    f.write(data)
+        for jobs in range(1, arguments.j + 1):
+            if os.path.isfile(os.path.join(directory, VOCAB_COUNTS)):
+                os.remove(os.path.join(directory, VOCAB_COUNTS))
+            start = time.perf_counter()
+            DataSource(directory, jobs=jobs)
+            print(f'counted, {jobs} processes: {time.perf_counter() - start:.2f} s')
+        for path in paths:
+            os.utime(path)
+        start = time.perf_counter()
+        DataSource(directory)
+        print(f'touched files: {time.perf_counter() - start:.2f} s')
+        start = time.perf_counter()
+        DataSource(directory, min_freq=5)
+        print(f'min_freq 5: {time.perf_counter() - start:.2f} s')
+        start = time.perf_counter()
+        DataSource(directory, min_freq=5)
+        print(f'unchanged: {time.perf_counter() - start:.2f} s')
+
+
+def bench_tokens(arguments):
+    # Neural training epochs and evaluation from the text of a samples file
+    # against from its compiled token ids.
+    import tempfile
+    import torch
+    from data import DataLoader
+    from neural import NeuralPredictor
+    from eval import evaluate
+
+    class Text:
+        # A DataLoader that NeuralPredictor and evaluate read as text.
+        def __init__(self, source):
+            self._source = source
+
+        def vocab(self):
+            return self._source.vocab()
+
+        def labeled_samples(self):
+            return self._source.labeled_samples()
+
+        def labeled_samples_batch(self, batch_size):
+            return self._source.labeled_samples_batch(batch_size)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, os.path.basename(arguments.d))
+        with open(arguments.d, 'r', encoding='utf-8') as f, open(path, 'w', encoding='utf-8') as out:
+            for i, line in zip(range(arguments.n), f):
+                out.write(line)
+        source = DataLoader(path)
+        start = time.perf_counter()
+        source.tokens()
+        print(f'{arguments.n} samples, compiled in {time.perf_counter() - start:.2f} s')
+        print(f'{"input":<8}{"train (s/epoch)":>16}{"eval (s)":>10}{"top 1":>7}')
+        for name, data in [('text', Text(source)), ('tokens', source)]:
+            torch.manual_seed(0)
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                model = NeuralPredictor(lstm=False, data_src=data, epochs=arguments.e, device='cpu')
+                train = (time.perf_counter() - start) / arguments.e
+                start = time.perf_counter()
+                acc, _, _ = evaluate(model, data, [1], arguments.b)
+                elapsed = time.perf_counter() - start
+            print(f'{name:<8}{train:>16.2f}{elapsed:>10.2f}{acc[0]:>7.3f}')
+
+
+def regex_split(line, comments=False):
+    # DataSource.split and DataSourceNTComments.split before the normalize
+    # module, for reference.
+    for s in re.split('\\.(?=(\\s+[A-Z])|$)', line):
+        if not s or s.startswith(' '):
+            continue
+        if comments and ('<a' in s or 'href=' in s or 'text=' in s or 'target=' in s or '&amp' in s or 'http' in s or "www." in s):
+            continue
+        yield s
+
+
+def regex_clean(phrase, comments=False):
+    # DataSource.clean and DataSourceNTComments.clean before the normalize
+    # module, for reference.
+    if comments:
+        phrase = re.sub('(<br/>|-)', ' ', phrase)
+    phrase = phrase.strip().lower()
+    phrase = re.sub('[^a-z\'\\s]', '', phrase)
+    phrase = re.sub('\\s+', ' ', phrase)
+    return phrase
+
+
+def comment_lines(words, size):
+    # Lines of comment-like text of about size bytes, made of words.
+    import random
+    random.seed(0)
+    lines = []
+    total = 0
+    while total < size:
+        sentences = []
+        for _ in range(random.randint(1, 6)):
+            sentence = [random.choice(words) for _ in range(random.randint(3, 25))]
+            sentence[0] = sentence[0].capitalize()
+            if random.random() < 0.2:
+                sentence.insert(random.randrange(len(sentence)), random.choice(['1999', '-', '<br/>', '"so"', 'well,', 'http://www.nytimes.com']))
+            sentences.append(' '.join(sentence) + random.choice(['.', '.', '.', '?', '!']))
+        line = ' '.join(sentences)
+        lines.append(line)
+        total += len(line.encode('utf-8')) + 1
+    return lines
+
+
+def bench_normalize(arguments):
+    # Throughput of splitting and cleaning lines of text, one line at a time
+    # with the regexes DataSource used, and with the normalize module.
+    import normalize
+    if arguments.d is None:
+        words = [line.strip().split(',')[-1] for line in open('char/small_strat/train.txt', encoding='utf-8')]
+        lines = comment_lines(words, arguments.s * 2**20)
+    else:
+        with open(arguments.d, 'r', encoding='utf-8') as f:
+            lines = [line.rstrip('\n') for line in f]
+    size = sum(len(line.encode('utf-8')) + 1 for line in lines) / 2**20
+    print(f'{size:.1f} MB, {len(lines)} lines, {os.cpu_count()} cores')
+    print(f'{"mode":<10}{"normalizer":<22}{"MB/s":>8}')
+    for comments in [False, True]:
+        mode = 'comments' if comments else 'text'
+        start = time.perf_counter()
+        reference = [regex_clean(s, comments) for line in lines for s in regex_split(line.strip(), comments)]
+        print(f'{mode:<10}{"regex, per line":<22}{size / (time.perf_counter() - start):>8.1f}')
+        for jobs in range(1, arguments.j + 1):
+            start = time.perf_counter()
+            result = list(normalize.normalized(lines, jobs, comments))
+            elapsed = time.perf_counter() - start
+            if result != reference:
+                raise ValueError('normalize output differs from the reference')
+            print(f'{mode:<10}{f"normalize, {jobs} jobs":<22}{size / elapsed:>8.1f}')
+
+
+def bench_nyt(arguments):
+    # Reading a made up New York Times comments directory with 1 to -j
+    # processes.
+    import csv
+    import tempfile
+    from data import DataSourceNTComments
+    words = [line.strip().split(',')[-1] for line in open('char/small_strat/train.txt', encoding='utf-8')]
+    lines = comment_lines(words, arguments.s * 2**20)
+    with tempfile.TemporaryDirectory() as directory:
+        per_file = len(lines) // arguments.f + 1
+        for i in range(arguments.f):
+            with open(os.path.join(directory, f'Comments{i}.csv'), 'w', encoding='utf8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['articleID', 'commentBody', 'userID'])
+                for j, line in enumerate(lines[i * per_file:(i + 1) * per_file]):
+                    writer.writerow([i, line.replace('. ', '.\n', 1), j])
+        print(f'{arguments.s} MB in {arguments.f} files, {os.cpu_count()} cores')
+        source = DataSourceNTComments.__new__(DataSourceNTComments)
+        source.num_datapoints = None
+        source._paths = sorted(os.path.join(directory, name) for name in os.listdir(directory))
+        for jobs in range(1, arguments.j + 1):
+            source._jobs = jobs
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                count = sum(1 for _ in source.sentences())
+            elapsed = time.perf_counter() - start
+            print(f'{jobs} processes: {elapsed:.2f} s, {arguments.s / elapsed:.1f} MB/s, {count} sentences')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark word prediction components.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    trie_parser = subparsers.add_parser('trie', help='Memory and latency of the trie implementations.')
+    trie_parser.add_argument('-w', type=str, default='_lstm_e10/words.txt', help='Vocabulary file, one word per line.')
+    trie_parser.add_argument('-r', type=int, default=5, help='Repetitions per measurement.')
+    trie_parser.add_argument('-k', type=int, default=20, help='Number of words for top_k.')
+    trie_parser.set_defaults(func=bench_trie)
+
+    fuzzy_parser = subparsers.add_parser('fuzzy', help='Latency of typo tolerant prefix lookup.')
+    fuzzy_parser.add_argument('-w', type=str, default='_lstm_e10/words.txt', help='Vocabulary file, one word per line.')
+    fuzzy_parser.add_argument('-r', type=int, default=5, help='Repetitions per measurement.')
+    fuzzy_parser.add_argument('-b', type=float, default=10.0, help='Per keystroke budget in ms, slower lookups are marked with !.')
+    fuzzy_parser.set_defaults(func=bench_fuzzy)
+
+    load_parser = subparsers.add_parser('load', help='Model load time.')
+    load_parser.add_argument('-m', type=str, nargs='+', default=['_fair_char_10gram.txt', '_neural_char_e20', '_lstm_e10'], help='Model paths.')
+    load_parser.add_argument('-r', type=int, default=5, help='Repetitions per measurement.')
+    load_parser.set_defaults(func=bench_load)
+
+    completions_parser = subparsers.add_parser('completions', help='Latency of NGramModel.completions.')
+    completions_parser.add_argument('-m', type=str, default='_fair_char_10gram.txt', help='N-gram model file.')
+    completions_parser.add_argument('-d', type=str, default='char/small_strat/val.txt', help='Samples file to take contexts from.')
+    completions_parser.add_argument('-n', type=int, default=200, help='Number of samples.')
+    completions_parser.add_argument('-k', type=int, default=5, help='Number of completions per call.')
+    completions_parser.add_argument('-f', action='store_true', help='Load the model with frozen stores.')
+    completions_parser.set_defaults(func=bench_completions)
+
+    typing_parser = subparsers.add_parser('typing', help='Completions per keystroke with and without the stub cache.')
+    typing_parser.add_argument('-m', type=str, default='_fair_char_10gram.txt', help='N-gram model file.')
+    typing_parser.add_argument('-d', type=str, default='char/small_strat/val.txt', help='Samples file to type.')
+    typing_parser.add_argument('-n', type=int, default=100, help='Number of samples.')
+    typing_parser.add_argument('-k', type=int, default=5, help='Number of completions per call.')
+    typing_parser.add_argument('-c', type=int, default=1024, help='Stub cache size.')
+    typing_parser.set_defaults(func=bench_typing)
+
+    memory_parser = subparsers.add_parser('memory', help='Memory of a loaded n-gram model.')
+    memory_parser.add_argument('-m', type=str, default='_fair_char_10gram.txt', help='N-gram model file.')
+    memory_parser.set_defaults(func=bench_memory)
+
+    train_parser = subparsers.add_parser('train', help='N-gram training time, as in main.py, with 1 to -j processes.')
+    train_parser.add_argument('-d', type=str, default='char/small_strat/train.txt', help='Samples file.')
+    train_parser.add_argument('-k', type=int, default=10, help='k-gram.')
+    train_parser.add_argument('-j', type=int, default=os.cpu_count(), help='Largest number of processes.')
+    train_parser.set_defaults(func=bench_train)
+
+    prune_parser = subparsers.add_parser('prune', help='Size and accuracy of a pruned n-gram model.')
+    prune_parser.add_argument('-m', type=str, default='_fair_char_10gram.txt', help='N-gram model file.')
+    prune_parser.add_argument('-d', type=str, default='char/small_strat/val.txt', help='Validation samples file.')
+    prune_parser.add_argument('-n', type=int, default=2000, help='Number of validation samples.')
+    prune_parser.add_argument('-c', type=int, nargs='*', default=[2, 3], help='Minimum counts to try.')
+    prune_parser.add_argument('-b', type=float, nargs='*', default=[1.0, 0.5, 0.25], help='Size budgets in MB to try.')
+    prune_parser.set_defaults(func=bench_prune)
+
+    scoring_parser = subparsers.add_parser('scoring', help='Latency and accuracy of the n-gram scoring modes.')
+    scoring_parser.add_argument('-m', type=str, default='_fair_char_10gram.txt', help='N-gram model file.')
+    scoring_parser.add_argument('-d', type=str, default='char/small_strat/val.txt', help='Validation samples file.')
+    scoring_parser.add_argument('-n', type=int, default=2000, help='Number of validation samples.')
+    scoring_parser.add_argument('-k', type=int, default=5, help='Number of completions per call.')
+    scoring_parser.set_defaults(func=bench_scoring)
+
+    observe_parser = subparsers.add_parser('observe', help='Latency of the first completion after observing a sample.')
+    observe_parser.add_argument('-m', type=str, default='_fair_char_10gram.txt', help='N-gram model file.')
+    observe_parser.add_argument('-d', type=str, default='char/small_strat/val.txt', help='Samples file to observe.')
+    observe_parser.add_argument('-n', type=int, default=200, help='Number of samples.')
+    observe_parser.add_argument('-k', type=int, default=5, help='Number of completions per call.')
+    observe_parser.add_argument('-t', type=str, nargs='+', default=['dict', 'compact'], help='Trie types.')
+    observe_parser.set_defaults(func=bench_observe)
+
+    sketch_parser = subparsers.add_parser('sketch', help='Memory, latency and accuracy of count-min sketched orders.')
+    sketch_parser.add_argument('-m', type=str, default='_fair_char_10gram.txt', help='N-gram model file.')
+    sketch_parser.add_argument('-d', type=str, default='char/small_strat/val.txt', help='Validation samples file.')
+    sketch_parser.add_argument('-n', type=int, default=2000, help='Number of validation samples.')
+    sketch_parser.add_argument('-a', type=int, default=5, help='Lowest sketched order, all orders above it are sketched too.')
+    sketch_parser.add_argument('-w', type=int, nargs='*', default=[2**10, 2**12, 2**14, 2**16], help='Sketch widths to try.')
+    sketch_parser.add_argument('-r', type=int, default=4, help='Sketch depth.')
+    sketch_parser.set_defaults(func=bench_sketch)
+
+    quantize_parser = subparsers.add_parser('quantize', help='Memory and accuracy of log-quantized n-gram counts.')
+    quantize_parser.add_argument('-m', type=str, default='_fair_char_10gram.txt', help='N-gram model file.')
+    quantize_parser.add_argument('-d', type=str, default='char/small_strat/val.txt', help='Validation samples file.')
+    quantize_parser.add_argument('-n', type=int, default=2000, help='Number of validation samples.')
+    quantize_parser.set_defaults(func=bench_quantize)
+
+    batch_parser = subparsers.add_parser('batch', help='Evaluation time and accuracy with batched predictions.')
+    batch_parser.add_argument('-m', type=str, nargs='+', default=['_fair_char_10gram.txt', '_neural_char_e20'], help='Model paths.')
+    batch_parser.add_argument('-d', type=str, default='char/small_strat/val.txt', help='Validation samples file.')
+    batch_parser.add_argument('-n', type=int, default=2000, help='Number of validation samples.')
+    batch_parser.add_argument('-b', type=int, nargs='*', default=[1, 16, 64, 256], help='Batch sizes to try.')
+    batch_parser.set_defaults(func=bench_batch)
+
+    topk_parser = subparsers.add_parser('topk', help='Latency of exhaustive and upper bound pruned top-k completions.')
+    topk_parser.add_argument('-m', type=str, default='_fair_char_10gram.txt', help='N-gram model file.')
+    topk_parser.add_argument('-d', type=str, default='char/small_strat/val.txt', help='Samples file to take contexts and prefixes from.')
+    topk_parser.add_argument('-n', type=int, default=1000, help='Number of samples.')
+    topk_parser.add_argument('-k', type=int, default=5, help='Number of completions per call.')
+    topk_parser.add_argument('-p', type=int, default=3, help='Longest prefix length.')
+    topk_parser.set_defaults(func=bench_topk)
+
+    startup_parser = subparsers.add_parser('startup', help='Time to first suggestion with eager and lazy n-gram loading.')
+    startup_parser.add_argument('-m', type=str, nargs='+', default=['_fair_char_10gram.txt'], help='Text n-gram model files.')
+    startup_parser.add_argument('-t', type=str, nargs='+', default=['dict', 'mmap'], help='Trie types.')
+    startup_parser.add_argument('-k', type=int, default=5, help='Number of completions.')
+    startup_parser.set_defaults(func=bench_startup)
+
+    shared_parser = subparsers.add_parser('shared', help='Memory of worker processes with their own or a shared n-gram model.')
+    shared_parser.add_argument('-m', type=str, default='_fair_char_10gram.txt', help='N-gram model file.')
+    shared_parser.add_argument('-d', type=str, default='char/small_strat/val.txt', help='Validation samples file.')
+    shared_parser.add_argument('-n', type=int, default=500, help='Number of validation samples per worker.')
+    shared_parser.add_argument('-j', type=int, nargs='*', default=[1, 4], help='Numbers of workers to try.')
+    shared_parser.set_defaults(func=bench_shared)
+
+    corpus_parser = subparsers.add_parser('corpus', help='Peak memory of reading corpora of growing size.')
+    corpus_parser.add_argument('-d', type=str, default='char/small_strat/train.txt', help='File repeated to make up the corpora.')
+    corpus_parser.add_argument('-s', type=int, nargs='+', default=[16, 64, 256], help='Corpus sizes in MB.')
+    corpus_parser.set_defaults(func=bench_corpus)
+
+    vocab_parser = subparsers.add_parser('vocab', help='Vocabulary building time with and without its counts cached.')
+    vocab_parser.add_argument('-d', type=str, default='char/small_strat/train.txt', help='File repeated to make up the corpus.')
+    vocab_parser.add_argument('-s', type=int, default=32, help='Corpus size in MB.')
+    vocab_parser.add_argument('-f', type=int, default=4, help='Number of files in the corpus.')
+    vocab_parser.add_argument('-j', type=int, default=2, help='Largest number of processes to try.')
+    vocab_parser.set_defaults(func=bench_vocab)
+
+    tokens_parser = subparsers.add_parser('tokens', help='Neural training and evaluation from text and from compiled token ids.')
+    tokens_parser.add_argument('-d', type=str, default='char/small_strat/train.txt', help='Samples file.')
+    tokens_parser.add_argument('-n', type=int, default=20000, help='Number of samples.')
+    tokens_parser.add_argument('-e', type=int, default=2, help='Number of epochs.')
+    tokens_parser.add_argument('-b', type=int, default=64, help='Evaluation batch size.')
+    tokens_parser.set_defaults(func=bench_tokens)
+
+    normalize_parser = subparsers.add_parser('normalize', help='Throughput of splitting and cleaning text with and without the normalize module.')
+    normalize_parser.add_argument('-d', type=str, help='UTF-8 text file, one comment per line. Made up from the words of char/small_strat/train.txt by default.')
+    normalize_parser.add_argument('-s', type=int, default=16, help='Size in MB of the made up text.')
+    normalize_parser.add_argument('-j', type=int, default=2, help='Largest number of processes to try.')
+    normalize_parser.set_defaults(func=bench_normalize)
+
+    nyt_parser = subparsers.add_parser('nyt', help='New York Times comments reading time with 1 to -j processes.')
+    nyt_parser.add_argument('-s', type=int, default=32, help='Size in MB of the made up comments.')
+    nyt_parser.add_argument('-f', type=int, default=4, help='Number of comment files.')
+    nyt_parser.add_argument('-j', type=int, default=2, help='Largest number of processes to try.')
+    nyt_parser.set_defaults(func=bench_nyt)
+
+    arguments = parser.parse_args()
+    arguments.func(arguments)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,11 +6,20 @@ from neural import NeuralPredictor
 from chardata import context_and_keystrokes
 
 class CharNeuralProbabilities(WordProbabilities):
-    def __init__(self, model_path):
-        self._model = NeuralPredictor.load(model_path)
+    def __init__(self, model_path, trie='dict'):
+        self._model = NeuralPredictor.load(model_path, trie=trie)
 
     def most_likely_words(self, input_str: str, n: int) -> tuple[list[str], list[float]]:
         context, keystrokes = context_and_keystrokes(input_str)
         context = f'<S> {context}'
         return self._model.completions(context, keystrokes, n)
 
+    def most_likely_words_batch(self, inputs: list[str], n: int) -> list[tuple[list[str], list[float]]]:
+        contexts = []
+        keystrokes = []
+        for input_str in inputs:
+            context, prefix = context_and_keystrokes(input_str)
+            contexts.append(f'<S> {context}')
+            keystrokes.append(prefix)
+        return self._model.completions_batch(contexts, keystrokes, n)
+
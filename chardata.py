@@ -2,10 +2,26 @@
 # Date: 2024.
 
 import os
-import re
 import csv
+import json
+import codecs
+import locale
+import multiprocessing
+from collections import Counter
 from tqdm import tqdm
 from chardet import detect
+import normalize
+# Files are read, hashed and split, New York Times comment files parsed
+# and samples compiled to token ids as for data.
+from data import read_lines, line_shards, csv_shards, content_hash, compile_tokens, _comment_chunk, _count_shard
+
+
+# Encodings are detected from this many bytes at the start of a file.
+ENCODING_SAMPLE_SIZE = 1 << 20
+ENCODING_MANIFEST = 'encodings.json'
+VOCAB_COUNTS = 'vocab_counts.txt'
+# New York Times comment files are read in byte ranges of about this size.
+COMMENT_CHUNK_SIZE = 1 << 22
 
 
 class Special:
@@ -22,72 +38,142 @@ class Special:
 
 
 class DataSource:
-    def __init__(self, path, num_datapoints=None):
+    def __init__(self, path, num_datapoints=None, min_freq=2, jobs=1):
         self.num_datapoints = num_datapoints
+        self._min_freq = min_freq
+        self._jobs = jobs
         if os.path.isdir(path):
             self._path = path
             vocab_name = 'vocab.txt'
             self._vocab_path = vocab_path = os.path.join(self._path, vocab_name)
-            
-            stale_vocab = False
-            if os.path.isfile(self._vocab_path):
-                vocab_time = os.path.getmtime(self._vocab_path)
-            else:
-                vocab_time = 0
+            self._counts_path = os.path.join(self._path, VOCAB_COUNTS)
+            # Files that the data source writes itself.
+            own_paths = [vocab_path, self._counts_path, os.path.join(self._path, ENCODING_MANIFEST)]
 
             paths = []
             for root, _, filenames in os.walk(path):
                 for filename in filenames:
                     filepath = os.path.join(self._path, filename) 
-                    if filepath != vocab_path:
+                    if filepath not in own_paths:
                          paths.append(filepath)
-                    if os.path.getmtime(filepath) > vocab_time:
-                        stale_vocab = True
             self._paths = paths
-            if stale_vocab:
-                self._ensure_vocab()
+            self._ensure_vocab()
         else:
             raise ValueError(f'Path {path} does not exist')
 
 
     def _ensure_vocab(self):
-        vocab = set()
-        counts = {}
-        min_freq = 2
-        for sentence in self.sentences():
-            sentence = self.clean(sentence)
-            words = sentence.split()
-            for word in words:
-                if word not in counts:
-                    counts[word] = 0
-                counts[word] += 1
-                if counts[word] >= min_freq:
-                    vocab.add(word)
-        with open(self._vocab_path, 'w', encoding='utf-8') as f:
-            for word in vocab:
-                f.writelines([f'{word}\n'])
+        # The word counts are kept in the counts file along with a hash of
+        # the files they were counted from and the number of datapoints
+        # read. The files are only hashed when their sizes or modification
+        # times change and only recounted when their contents or the number
+        # of datapoints do, and the vocabulary is only rewritten when the
+        # counts or min_freq change.
+        saved = self._counts_header()
+        header = dict(saved)
+        source = type(self).__name__
+        counts = None
+        files = {}
+        for path in self._paths:
+            stat = os.stat(path)
+            files[os.path.basename(path)] = [stat.st_size, stat.st_mtime_ns]
+        if header.get('source') != source or header.get('files') != files:
+            digest = content_hash(self._paths)
+            if header.get('source') != source or header.get('hash') != digest:
+                header = {'source': source, 'hash': digest}
+            header['files'] = files
+        if 'num_datapoints' not in header or header['num_datapoints'] != self.num_datapoints:
+            header = {'source': source, 'hash': header['hash'], 'files': files, 'num_datapoints': self.num_datapoints}
+            counts = self._count_words()
+        if header.get('min_freq') != self._min_freq or not os.path.isfile(self._vocab_path):
+            if counts is None:
+                counts = self._saved_counts()
+            with open(self._vocab_path, 'w', encoding='utf-8') as f:
+                for word, count in counts.items():
+                    if count >= self._min_freq and word not in Special.all():
+                        f.writelines([f'{word}\n'])
+            header['min_freq'] = self._min_freq
+        if header != saved:
+            if counts is None:
+                counts = self._saved_counts()
+            with open(self._counts_path, 'w', encoding='utf-8') as f:
+                f.writelines([f'{json.dumps(header)}\n'])
+                for word, count in counts.items():
+                    f.writelines([f'{word} {count}\n'])
+
+
+    def _counts_header(self):
+        try:
+            with open(self._counts_path, 'r', encoding='utf-8') as f:
+                return json.loads(f.readline())
+        except (OSError, ValueError):
+            return {}
+
+
+    def _saved_counts(self):
+        counts = Counter()
+        with open(self._counts_path, 'r', encoding='utf-8') as f:
+            f.readline()
+            for line in f:
+                word, count = line.split()
+                counts[word] = int(count)
+        return counts
+
+
+    def _count_words(self):
+        # Counts the words of each file over self._jobs processes, one byte
+        # range of the file each. The counts are merged in file order, so
+        # words come out in the order they are first seen. UTF-16 and UTF-32
+        # files are not split, since a line end byte may be part of another
+        # character.
+        shards = []
+        for path, encoding_type in self._files():
+            codec = codecs.lookup(encoding_type or locale.getpreferredencoding(False)).name
+            if codec.startswith(('utf-16', 'utf-32')):
+                ranges = [(0, None)]
+            else:
+                ranges = line_shards(path, self._jobs)
+            shards += [(self, path, encoding_type, start, end) for start, end in ranges]
+        counts = Counter()
+        if self._jobs > 1:
+            with multiprocessing.Pool(self._jobs) as pool:
+                for shard_counts in pool.imap(_count_shard, shards):
+                    counts.update(shard_counts)
+        else:
+            for shard in shards:
+                counts.update(_count_shard(shard))
+        return counts
 
     def vocab(self):
         with open(self._vocab_path, 'r', encoding='utf-8') as f:
-            for line in f.readlines():
+            for line in f:
                 word = line.strip()
                 yield word
 
 
 
     def sentences(self):
+        for path, encoding_type in self._files():
+            yield from self._sentences(path, encoding_type, jobs=self._jobs)
+
+
+    def _files(self):
+        # The files with the encodings they are read in.
         for path in self._paths:
-            encoding_type = None
-            if not encoding_type:
-                encoding_type = self.get_encoding_type(path)
-            with open(path, 'r', encoding=encoding_type) as f:
-                for line in f.readlines():
-                    line = line.strip()
-                    sentences = self.split(line)
-                    for sentence in sentences:
-                        sentence = self.clean(sentence)
-                        for word in sentence.split():
-                            yield word
+            yield path, self.get_encoding_type(path)
+
+
+    def _sentences(self, path, encoding_type, start=0, end=None, jobs=1):
+        lines = read_lines(path, encoding_type, start, end)
+        for sentence in normalize.normalized(lines, jobs):
+            for word in sentence.split():
+                yield word
+
+
+    def _words(self, path, encoding_type, start=0, end=None):
+        # The words counted for the vocabulary in a byte range of a file.
+        for word in self._sentences(path, encoding_type, start, end):
+            yield from word.split()
 
 
     def labeled_samples(self):
@@ -128,132 +214,167 @@ class DataSource:
     
     @staticmethod
     def get_encoding_type(path: str):
-        encoding_type = None
+        # Detects the encoding from a sample at the start of the file, and
+        # remembers it in a manifest next to the file for as long as the
+        # file's size and modification time stay the same.
+        manifest_path = os.path.join(os.path.dirname(path), ENCODING_MANIFEST)
+        key = os.path.basename(path)
+        stat = os.stat(path)
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        saved = manifest.get(key, {})
+        if saved.get('size') == stat.st_size and saved.get('mtime_ns') == stat.st_mtime_ns:
+            return saved['encoding']
+
         with open(path, 'rb') as f:
-            encoding_type = detect(f.read())['encoding']
+            sample = f.read(ENCODING_SAMPLE_SIZE)
+        encoding_type = detect(sample)['encoding']
+        # An ASCII sample says nothing about the rest of the file.
+        if encoding_type == 'ascii' and len(sample) < stat.st_size:
+            encoding_type = 'utf-8'
+        manifest[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'encoding': encoding_type}
+        try:
+            with open(manifest_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
+        except OSError:
+            pass
         return encoding_type
 
 
     @staticmethod
     def split(line):
-        split = re.split('\\.(?=(\\s+[A-Z])|$)', line)
-        for s in split:
-            # Because re.split behaves weirdly and includes lookahead and None
-            if not s or s.startswith(' '):
-                continue
-            yield s
-        return
+        return normalize.split(line)
 
 
     @staticmethod
     def clean(phrase):
-        phrase = phrase.strip().lower()
-        phrase = re.sub('[^a-z\'\\s]', '', phrase)
-        phrase = re.sub('\\s+', ' ', phrase)
-        return phrase
+        return normalize.clean(phrase)
 
 
 class DataSourceNTComments(DataSource):
     def sentences(self):
+        # The files are read in chunks of whole records, parsed and cleaned
+        # in self._jobs processes and yielded in order.
         max_comments = self.num_datapoints
-        #processed_comments = 0
         print("Reading New York Times dataset.")
         processed_comments = 0
         encoding_type = 'utf8'
+        chunks = normalize.ordered_map(_comment_chunk, self._comment_chunks(encoding_type), self._jobs)
+        reading = None
+        progress = None
+        for path, size, sentences, ends in chunks:
+            if path != reading:
+                if reading is not None:
+                    progress.close()
+                    print("Finished reading", reading)
+                print("Reading", path)
+                reading = path
+                progress = tqdm(total=os.path.getsize(path), unit='B', unit_scale=True)
+            if max_comments and processed_comments + len(ends) >= max_comments:
+                count = max(0, max_comments - processed_comments)
+                for sentence in sentences[:ends[count - 1] if count > 0 else 0]:
+                    for word in sentence.split():
+                        yield word
+                progress.update(size)
+                progress.close()
+                return
+            for sentence in sentences:
+                for word in sentence.split():
+                    yield word
+            processed_comments += len(ends)
+            progress.update(size)
+        if reading is not None:
+            progress.close()
+            print("Finished reading", reading)
+        return
+
+
+    def _comment_chunks(self, encoding_type):
         for path in self._paths:
             # Look only at comment files.
             if "Comments" not in path:
                 continue
-            if not encoding_type:
-                encoding_type = self.get_encoding_type(path)
-            print("Reading", path)
             with open(file=path, mode='r', encoding=encoding_type) as f:
                 reader = csv.reader(f)
                 fields = next(reader) # Column names.
                 comment_body_index = fields.index('commentBody')
-                for row in tqdm(reader):
-                    if max_comments and processed_comments >= max_comments:
-                        return
-                    comment = row[comment_body_index].strip()
-                    sentences = self.split(comment)
-                    for sentence in sentences:
-                        sentence = self.clean(sentence)
-                        for word in sentence.split():
-                            yield word
-                    processed_comments += 1
-            print("Finished reading", path)
-        return
+            for start, end in csv_shards(path, COMMENT_CHUNK_SIZE):
+                yield path, encoding_type, start, end, comment_body_index
+
+
+    def _count_words(self):
+        # Comments may span lines and num_datapoints limits the comments
+        # over all files, so the words are counted from sentences, which
+        # splits the files on records itself.
+        counts = Counter()
+        for sentence in self.sentences():
+            counts.update(sentence.split())
+        return counts
 
 
     @staticmethod
     def split(line):
-        split = re.split('\\.(?=(\\s+[A-Z])|$)', line)
-        for s in split:
-            # Remove HTML tags and other junk.
-            if not s or s.startswith(' ') or '<a' in s or 'href=' in s or 'text=' in s or 'target=' in s or '&amp' in s or 'http' in s or "www." in s:
-                continue
-            yield s
-        return
+        return normalize.split_comment(line)
 
 
     @staticmethod
     def clean(phrase):
-        phrase = re.sub('(<br/>|-)', ' ', phrase) # Replace linebreak HTML symbol.
-        return DataSource.clean(phrase)
+        return normalize.clean_comment(phrase)
     
 
 class DataLoader(DataSource):
-    def __init__(self, path):
+    def __init__(self, path, min_freq=1, jobs=1):
         self._path = path
         flat_path = path.replace('.', '_')
+        self._paths = [path]
+        self.num_datapoints = None
         self._vocab_path = f'{path}__vocab.txt'
+        self._counts_path = f'{path}__{VOCAB_COUNTS}'
+        self._min_freq = min_freq
+        self._jobs = jobs
         
         if os.path.isfile(self._path):
-            stale_vocab = False
-            if os.path.isfile(self._vocab_path):
-                vocab_time = os.path.getmtime(self._vocab_path)
-            else:
-                vocab_time = 0
-
-            if os.path.getmtime(self._path) > vocab_time:
-                stale_vocab = True
-            if stale_vocab:
-                self._ensure_vocab()
+            self._ensure_vocab()
         else:
             raise ValueError(f'File {path} does not exist')
 
 
-    def _ensure_vocab(self):
-        vocab = set()
-        for sentence in self.sentences():
-            context, label = sentence.split(',')
-            words = context.split()
-            words += [label]
-            for word in words:
-                vocab.add(word)
-        with open(self._vocab_path, 'w', encoding='utf-8') as f:
-            for word in vocab:
-                if word not in Special.all():
-                    f.writelines([f'{word}\n'])
+    def _files(self):
+        yield self._path, 'utf-8'
 
 
-    def sentences(self):
+    def _words(self, path, encoding_type, start=0, end=None):
+        for context, label in self.labeled_samples(start, end):
+            yield from context.split()
+            yield label
+
+
+    def shards(self, count):
+        # Splits the file into at most count byte ranges (start, end) of
+        # about equal size, each starting at the beginning of a line.
+        return line_shards(self._path, count)
+
+
+    def sentences(self, start=0, end=None):
+        # Samples files are written as UTF-8 by save_samples.
         encoding_type = 'utf-8'
-        if not encoding_type:
-            encoding_type = self.get_encoding_type(path)
-        with open(self._path, 'r', encoding=encoding_type) as f:
-            for line in f.readlines():
-                line = line.strip()
-                yield line
+        for line in read_lines(self._path, encoding_type, start, end):
+            line = line.strip()
+            yield line
 
 
-    def labeled_samples(self):
-        for sentence in self.sentences():
+    def labeled_samples(self, start=0, end=None):
+        for sentence in self.sentences(start, end):
             context, label = sentence.split(',')
             yield context, label
-    
 
 
+    def tokens(self):
+        return compile_tokens(self)
+
 
 def context_and_keystrokes(text):
     split = text.split()
@@ -0,0 +1,29 @@
+import argparse
+from ngram import NGramModel, SCORINGS, COUNT_BITS
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert an n-gram model between the text and binary formats.', usage='\n* -m Model file path. -o Output file path. -t Write the text format. -s Scoring mode. -q Count bits.')
+    parser.add_argument('-m', type=str, help='Model file path, text or binary')
+    parser.add_argument('-o', type=str, help='Output file path')
+    parser.add_argument('-t', action='store_true', help='Write the text format instead of the binary one.')
+    parser.add_argument('-s', type=str, choices=SCORINGS, help='Scoring mode to save the model with, default is to keep the current one.')
+    parser.add_argument('-q', type=int, choices=COUNT_BITS, help='Quantize the counts of order 2 and up to this many bits.')
+    arguments = parser.parse_args()
+    model_path = arguments.m
+    out_path = arguments.o
+    if None in [model_path, out_path]:
+        print('Invalid arguments')
+        exit(-1)
+
+    print('Loading...')
+    model = NGramModel.load(model_path, scoring=arguments.s)
+    if arguments.q is not None:
+        model.quantize(arguments.q)
+    print('Saving...')
+    model.save(out_path, binary=not arguments.t)
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
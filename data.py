@@ -1,11 +1,195 @@
 # Authors: Rasmus Söderström Nylander and Erik Lidbjörk.
 # Date: 2024.
 
+import io
 import os
-import re
 import csv
+import json
+import codecs
+import locale
+import shutil
+import hashlib
+import multiprocessing
+from collections import Counter
+import numpy as np
 from tqdm import tqdm
 from chardet import detect
+import normalize
+
+
+# Encodings are detected from this many bytes at the start of a file.
+ENCODING_SAMPLE_SIZE = 1 << 20
+READ_BUFFER_SIZE = 1 << 20
+ENCODING_MANIFEST = 'encodings.json'
+VOCAB_COUNTS = 'vocab_counts.txt'
+# Token ids are written to disk this many at a time while compiling.
+TOKEN_CHUNK_SIZE = 1 << 20
+# New York Times comment files are read in byte ranges of about this size.
+COMMENT_CHUNK_SIZE = 1 << 22
+
+
+def read_lines(path, encoding, start=0, end=None):
+    # Yields the lines, without line endings, in the byte range [start, end)
+    # of the file, which starts at the beginning of a line. The range is
+    # decoded one buffer at a time, so memory does not grow with its size.
+    # An encoding of None is the locale's, as for open.
+    encoding = encoding or locale.getpreferredencoding(False)
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(), translate=True)
+    tail = ''
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while True:
+            size = READ_BUFFER_SIZE if end is None else min(READ_BUFFER_SIZE, end - f.tell())
+            chunk = f.read(size) if size > 0 else b''
+            lines = (tail + decoder.decode(chunk, final=not chunk)).split('\n')
+            tail = lines.pop()
+            yield from lines
+            if not chunk:
+                break
+    if tail:
+        yield tail
+
+
+def line_shards(path, count):
+    # Splits the file into at most count byte ranges (start, end) of about
+    # equal size, each starting at the beginning of a line.
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, count):
+            f.seek(max(size * i // count, bounds[-1]))
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_CUR)
+                f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+# The bytes a quote can come after when it opens a quoted field and
+# before when it closes one. Next to a quote it is one of a doubled pair.
+_FIELD_STARTS = np.frombuffer(b',\n"', dtype=np.uint8)
+_FIELD_ENDS = np.frombuffer(b',\r\n"', dtype=np.uint8)
+
+
+def csv_shards(path, size):
+    # Splits the CSV file into byte ranges (start, end) of about size bytes,
+    # each starting at the beginning of a record. Fields are taken to be
+    # quoted with " and to double the quotes inside them, so a newline ends
+    # a record when the quotes before it are balanced. csv.reader also
+    # takes quotes that do not open or close a field as they are, as in
+    # 'a,b"c,d'. Files with any are split with csv.reader instead, see
+    # record_shards.
+    bounds = [0]
+    target = size
+    position = 0
+    odd = False
+    last = b'\n'
+    with open(path, 'rb') as f:
+        while chunk := f.read(READ_BUFFER_SIZE):
+            if not _quoted_fields(last + chunk, odd ^ (last == b'"')):
+                return record_shards(path, size)
+            i = 0
+            while True:
+                if position + i < target:
+                    j = min(len(chunk), target - position)
+                    odd ^= chunk.count(b'"', i, j) & 1
+                    i = j
+                    if i == len(chunk):
+                        break
+                newline = chunk.find(b'\n', i)
+                if newline < 0:
+                    odd ^= chunk.count(b'"', i) & 1
+                    break
+                odd ^= chunk.count(b'"', i, newline) & 1
+                i = newline + 1
+                if not odd:
+                    bounds.append(position + i)
+                    target = position + i + size
+            last = chunk[-1:]
+            position += len(chunk)
+    bounds.append(position)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+def _quoted_fields(data, odd):
+    # Whether every quote in data, bytes of a CSV file after odd quotes,
+    # opens a quoted field, closes one or is doubled inside one. A quote at
+    # data[0] is only checked against the byte after it, and one at the end
+    # only against the byte before it.
+    data = np.frombuffer(data, dtype=np.uint8)
+    quotes = np.flatnonzero(data == ord('"'))
+    opening = (np.arange(len(quotes)) & 1).astype(bool) == odd
+    openers = quotes[opening]
+    closers = quotes[~opening]
+    openers = openers[openers > 0]
+    closers = closers[closers < len(data) - 1]
+    return np.isin(data[openers - 1], _FIELD_STARTS).all() and np.isin(data[closers + 1], _FIELD_ENDS).all()
+
+
+def record_shards(path, size):
+    # csv_shards for any CSV file, with its records found by csv.reader in
+    # one pass over the file. Delimiters, quotes and line endings are the
+    # same bytes in latin-1 as in UTF-8, and latin-1 has one character per
+    # byte, so the records end at the same places and their sizes are in
+    # bytes.
+    bounds = [0]
+    position = 0
+
+    def lines(f):
+        nonlocal position
+        for line in f:
+            position += len(line)
+            yield line
+
+    with open(path, 'r', encoding='latin-1', newline='') as f:
+        for _ in csv.reader(lines(f)):
+            if position - bounds[-1] >= size:
+                bounds.append(position)
+    bounds.append(position)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+def content_hash(paths):
+    h = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        h.update(f'{os.path.getsize(path)}\n'.encode('utf-8'))
+        with open(path, 'rb') as f:
+            while chunk := f.read(READ_BUFFER_SIZE):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def _npy_from_raw(raw_path, path, dtype):
+    # Turns a file of raw array items into a .npy file, without reading
+    # the array into memory.
+    dtype = np.dtype(dtype)
+    header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (os.path.getsize(raw_path) // dtype.itemsize,)}
+    with open(raw_path, 'rb') as raw, open(path, 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, header)
+        shutil.copyfileobj(raw, f, READ_BUFFER_SIZE)
+    os.remove(raw_path)
+
+
+def _comment_chunk(path, encoding_type, start, end, column):
+    # The sentences of the comments in a byte range of a New York Times
+    # comments file, where each comment's sentences end in them, and the
+    # file and the size of the range.
+    with open(path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode(encoding_type)
+    reader = csv.reader(io.StringIO(text, newline=None))
+    if start == 0:
+        next(reader) # Column names.
+    sentences, ends = normalize.line_sentences([row[column] for row in reader], comments=True)
+    return path, end - start, sentences, ends
+
+
+def _count_shard(job):
+    source, path, encoding_type, start, end = job
+    return Counter(source._words(path, encoding_type, start, end))
 
 
 class Special:
@@ -22,71 +206,144 @@ class Special:
 
 
 class DataSource:
-    def __init__(self, path, num_datapoints=None):
+    def __init__(self, path, num_datapoints=None, min_freq=2, jobs=1):
         self.num_datapoints = num_datapoints
+        self._min_freq = min_freq
+        self._jobs = jobs
         if os.path.isdir(path):
             self._path = path
             vocab_name = 'vocab.txt'
             self._vocab_path = vocab_path = os.path.join(self._path, vocab_name)
-            
-            stale_vocab = False
-            if os.path.isfile(self._vocab_path):
-                vocab_time = os.path.getmtime(self._vocab_path)
-            else:
-                vocab_time = 0
+            self._counts_path = os.path.join(self._path, VOCAB_COUNTS)
+            # Files that the data source writes itself.
+            own_paths = [vocab_path, self._counts_path, os.path.join(self._path, ENCODING_MANIFEST)]
 
             paths = []
             for root, _, filenames in os.walk(path):
                 for filename in filenames:
                     filepath = os.path.join(self._path, filename) 
-                    if filepath != vocab_path:
+                    if filepath not in own_paths:
                          paths.append(filepath)
-                    if os.path.getmtime(filepath) > vocab_time:
-                        stale_vocab = True
             self._paths = paths
-            if stale_vocab:
-                self._ensure_vocab()
+            self._ensure_vocab()
         else:
             raise ValueError(f'Path {path} does not exist')
 
 
     def _ensure_vocab(self):
-        vocab = set()
-        counts = {}
-        min_freq = 2
-        for sentence in self.sentences():
-            sentence = self.clean(sentence)
-            words = sentence.split()
-            for word in words:
-                if word not in counts:
-                    counts[word] = 0
-                counts[word] += 1
-                if counts[word] >= min_freq:
-                    vocab.add(word)
-        with open(self._vocab_path, 'w', encoding='utf-8') as f:
-            for word in vocab:
-                f.writelines([f'{word}\n'])
+        # The word counts are kept in the counts file along with a hash of
+        # the files they were counted from and the number of datapoints
+        # read. The files are only hashed when their sizes or modification
+        # times change and only recounted when their contents or the number
+        # of datapoints do, and the vocabulary is only rewritten when the
+        # counts or min_freq change.
+        saved = self._counts_header()
+        header = dict(saved)
+        source = type(self).__name__
+        counts = None
+        files = {}
+        for path in self._paths:
+            stat = os.stat(path)
+            files[os.path.basename(path)] = [stat.st_size, stat.st_mtime_ns]
+        if header.get('source') != source or header.get('files') != files:
+            digest = content_hash(self._paths)
+            if header.get('source') != source or header.get('hash') != digest:
+                header = {'source': source, 'hash': digest}
+            header['files'] = files
+        if 'num_datapoints' not in header or header['num_datapoints'] != self.num_datapoints:
+            header = {'source': source, 'hash': header['hash'], 'files': files, 'num_datapoints': self.num_datapoints}
+            counts = self._count_words()
+        if header.get('min_freq') != self._min_freq or not os.path.isfile(self._vocab_path):
+            if counts is None:
+                counts = self._saved_counts()
+            with open(self._vocab_path, 'w', encoding='utf-8') as f:
+                for word, count in counts.items():
+                    if count >= self._min_freq and word not in Special.all():
+                        f.writelines([f'{word}\n'])
+            header['min_freq'] = self._min_freq
+        if header != saved:
+            if counts is None:
+                counts = self._saved_counts()
+            with open(self._counts_path, 'w', encoding='utf-8') as f:
+                f.writelines([f'{json.dumps(header)}\n'])
+                for word, count in counts.items():
+                    f.writelines([f'{word} {count}\n'])
+
+
+    def _counts_header(self):
+        try:
+            with open(self._counts_path, 'r', encoding='utf-8') as f:
+                return json.loads(f.readline())
+        except (OSError, ValueError):
+            return {}
+
+
+    def _saved_counts(self):
+        counts = Counter()
+        with open(self._counts_path, 'r', encoding='utf-8') as f:
+            f.readline()
+            for line in f:
+                word, count = line.split()
+                counts[word] = int(count)
+        return counts
+
+
+    def _count_words(self):
+        # Counts the words of each file over self._jobs processes, one byte
+        # range of the file each. The counts are merged in file order, so
+        # words come out in the order they are first seen. UTF-16 and UTF-32
+        # files are not split, since a line end byte may be part of another
+        # character.
+        shards = []
+        for path, encoding_type in self._files():
+            codec = codecs.lookup(encoding_type or locale.getpreferredencoding(False)).name
+            if codec.startswith(('utf-16', 'utf-32')):
+                ranges = [(0, None)]
+            else:
+                ranges = line_shards(path, self._jobs)
+            shards += [(self, path, encoding_type, start, end) for start, end in ranges]
+        counts = Counter()
+        if self._jobs > 1:
+            with multiprocessing.Pool(self._jobs) as pool:
+                for shard_counts in pool.imap(_count_shard, shards):
+                    counts.update(shard_counts)
+        else:
+            for shard in shards:
+                counts.update(_count_shard(shard))
+        return counts
 
     def vocab(self):
         with open(self._vocab_path, 'r', encoding='utf-8') as f:
-            for line in f.readlines():
+            for line in f:
                 word = line.strip()
                 yield word
 
 
 
     def sentences(self):
+        for path, encoding_type in self._files():
+            yield from self._sentences(path, encoding_type, jobs=self._jobs)
+
+
+    def _files(self):
+        # The files with the encodings they are read in. The first detected
+        # encoding is used for the remaining files.
         encoding_type = None
         for path in self._paths:
             if not encoding_type:
                 encoding_type = self.get_encoding_type(path)
-            with open(path, 'r', encoding=encoding_type) as f:
-                for line in f.readlines():
-                    line = line.strip()
-                    sentences = self.split(line)
-                    for sentence in sentences:
-                        sentence = self.clean(sentence)
-                        yield sentence
+            yield path, encoding_type
+
+
+    def _sentences(self, path, encoding_type, start=0, end=None, jobs=1):
+        lines = read_lines(path, encoding_type, start, end)
+        yield from normalize.normalized(lines, jobs)
+
+
+    def _words(self, path, encoding_type, start=0, end=None):
+        # The words counted for the vocabulary in a byte range of a file.
+        for sentence in self._sentences(path, encoding_type, start, end):
+            yield from sentence.split()
 
 
     def labeled_samples(self):
@@ -127,128 +384,246 @@ class DataSource:
     
     @staticmethod
     def get_encoding_type(path: str):
-        encoding_type = None
+        # Detects the encoding from a sample at the start of the file, and
+        # remembers it in a manifest next to the file for as long as the
+        # file's size and modification time stay the same.
+        manifest_path = os.path.join(os.path.dirname(path), ENCODING_MANIFEST)
+        key = os.path.basename(path)
+        stat = os.stat(path)
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        saved = manifest.get(key, {})
+        if saved.get('size') == stat.st_size and saved.get('mtime_ns') == stat.st_mtime_ns:
+            return saved['encoding']
+
         with open(path, 'rb') as f:
-            encoding_type = detect(f.read())['encoding']
+            sample = f.read(ENCODING_SAMPLE_SIZE)
+        encoding_type = detect(sample)['encoding']
+        # An ASCII sample says nothing about the rest of the file.
+        if encoding_type == 'ascii' and len(sample) < stat.st_size:
+            encoding_type = 'utf-8'
+        manifest[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'encoding': encoding_type}
+        try:
+            with open(manifest_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
+        except OSError:
+            pass
         return encoding_type
 
 
     @staticmethod
     def split(line):
-        split = re.split('\\.(?=(\\s+[A-Z])|$)', line)
-        for s in split:
-            # Because re.split behaves weirdly and includes lookahead and None
-            if not s or s.startswith(' '):
-                continue
-            yield s
-        return
+        return normalize.split(line)
 
 
     @staticmethod
     def clean(phrase):
-        phrase = phrase.strip().lower()
-        phrase = re.sub('[^a-z\'\\s]', '', phrase)
-        phrase = re.sub('\\s+', ' ', phrase)
-        return phrase
+        return normalize.clean(phrase)
 
 
 class DataSourceNTComments(DataSource):
     def sentences(self):
+        # The files are read in chunks of whole records, parsed and cleaned
+        # in self._jobs processes and yielded in order.
         max_comments = self.num_datapoints
-        #processed_comments = 0
         print("Reading New York Times dataset.")
         processed_comments = 0
         encoding_type = 'utf8'
+        chunks = normalize.ordered_map(_comment_chunk, self._comment_chunks(encoding_type), self._jobs)
+        reading = None
+        progress = None
+        for path, size, sentences, ends in chunks:
+            if path != reading:
+                if reading is not None:
+                    progress.close()
+                    print("Finished reading", reading)
+                print("Reading", path)
+                reading = path
+                progress = tqdm(total=os.path.getsize(path), unit='B', unit_scale=True)
+            if max_comments and processed_comments + len(ends) >= max_comments:
+                count = max(0, max_comments - processed_comments)
+                yield from sentences[:ends[count - 1] if count > 0 else 0]
+                progress.update(size)
+                progress.close()
+                return
+            yield from sentences
+            processed_comments += len(ends)
+            progress.update(size)
+        if reading is not None:
+            progress.close()
+            print("Finished reading", reading)
+        return
+
+
+    def _comment_chunks(self, encoding_type):
         for path in self._paths:
             # Look only at comment files.
             if "Comments" not in path:
                 continue
-            if not encoding_type:
-                encoding_type = self.get_encoding_type(path)
-            print("Reading", path)
             with open(file=path, mode='r', encoding=encoding_type) as f:
                 reader = csv.reader(f)
                 fields = next(reader) # Column names.
                 comment_body_index = fields.index('commentBody')
-                for row in tqdm(reader):
-                    if max_comments and processed_comments >= max_comments:
-                        return
-                    comment = row[comment_body_index].strip()
-                    sentences = self.split(comment)
-                    for sentence in sentences:
-                        sentence = self.clean(sentence)
-                        yield sentence
-                    processed_comments += 1
-            print("Finished reading", path)
-        return
+            for start, end in csv_shards(path, COMMENT_CHUNK_SIZE):
+                yield path, encoding_type, start, end, comment_body_index
+
+
+    def _count_words(self):
+        # Comments may span lines and num_datapoints limits the comments
+        # over all files, so the words are counted from sentences, which
+        # splits the files on records itself.
+        counts = Counter()
+        for sentence in self.sentences():
+            counts.update(sentence.split())
+        return counts
 
 
     @staticmethod
     def split(line):
-        split = re.split('\\.(?=(\\s+[A-Z])|$)', line)
-        for s in split:
-            # Remove HTML tags and other junk.
-            if not s or s.startswith(' ') or '<a' in s or 'href=' in s or 'text=' in s or 'target=' in s or '&amp' in s or 'http' in s or "www." in s:
-                continue
-            yield s
-        return
+        return normalize.split_comment(line)
 
 
     @staticmethod
     def clean(phrase):
-        phrase = re.sub('(<br/>|-)', ' ', phrase) # Replace linebreak HTML symbol.
-        return DataSource.clean(phrase)
+        return normalize.clean_comment(phrase)
     
 
 class DataLoader(DataSource):
-    def __init__(self, path):
+    def __init__(self, path, min_freq=1, jobs=1):
         self._path = path
         flat_path = path.replace('.', '_')
+        self._paths = [path]
+        self.num_datapoints = None
         self._vocab_path = f'{path}__vocab.txt'
+        self._counts_path = f'{path}__{VOCAB_COUNTS}'
+        self._min_freq = min_freq
+        self._jobs = jobs
         
         if os.path.isfile(self._path):
-            stale_vocab = False
-            if os.path.isfile(self._vocab_path):
-                vocab_time = os.path.getmtime(self._vocab_path)
-            else:
-                vocab_time = 0
-
-            if os.path.getmtime(self._path) > vocab_time:
-                stale_vocab = True
-            if stale_vocab:
-                self._ensure_vocab()
+            self._ensure_vocab()
         else:
             raise ValueError(f'File {path} does not exist')
 
 
-    def _ensure_vocab(self):
-        vocab = set()
-        for sentence in self.sentences():
-            context, label = sentence.split(',')
-            words = context.split()
-            words += [label]
-            for word in words:
-                vocab.add(word)
-        with open(self._vocab_path, 'w', encoding='utf-8') as f:
-            for word in vocab:
-                if word not in Special.all():
-                    f.writelines([f'{word}\n'])
+    def _files(self):
+        yield self._path, 'utf-8'
 
 
-    def sentences(self):
+    def _words(self, path, encoding_type, start=0, end=None):
+        for context, label in self.labeled_samples(start, end):
+            yield from context.split()
+            yield label
+
+
+    def shards(self, count):
+        # Splits the file into at most count byte ranges (start, end) of
+        # about equal size, each starting at the beginning of a line.
+        return line_shards(self._path, count)
+
+
+    def sentences(self, start=0, end=None):
+        # Samples files are written as UTF-8 by save_samples.
         encoding_type = 'utf-8'
-        if not encoding_type:
-            encoding_type = self.get_encoding_type(path)
-        with open(self._path, 'r', encoding=encoding_type) as f:
-            for line in f.readlines():
-                line = line.strip()
-                yield line
+        for line in read_lines(self._path, encoding_type, start, end):
+            line = line.strip()
+            yield line
 
 
-    def labeled_samples(self):
-        for sentence in self.sentences():
+    def labeled_samples(self, start=0, end=None):
+        for sentence in self.sentences(start, end):
             context, label = sentence.split(',')
             yield context, label
+
+
+    def tokens(self):
+        return compile_tokens(self)
+
+
+def compile_tokens(loader):
+    # The samples of a DataLoader as token ids in memory mapped arrays.
+    # They are compiled from the text once and kept next to the file for
+    # as long as its contents stay the same.
+    key = loader._counts_header()['hash']
+    key_path = f'{loader._path}__tokens.json'
+    ids_path = f'{loader._path}__ids.npy'
+    offsets_path = f'{loader._path}__offsets.npy'
+    try:
+        with open(key_path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {}
+    if saved.get('hash') != key or not os.path.isfile(ids_path) or not os.path.isfile(offsets_path):
+        # Every counted word gets an id, so no word is lost to min_freq.
+        words = Special.all() + [word for word in loader._saved_counts() if word not in Special.all()]
+        _compile_tokens(loader, words, ids_path, offsets_path)
+        saved = {'hash': key, 'words': words}
+        # Written last, so an interrupted compile is redone.
+        with open(key_path, 'w', encoding='utf-8') as f:
+            json.dump(saved, f)
+    return TokenizedSamples(saved['words'], np.load(ids_path, mmap_mode='r'), np.load(offsets_path, mmap_mode='r'))
+
+
+def _compile_tokens(loader, words, ids_path, offsets_path):
+    w2i = {word: idx for idx, word in enumerate(words)}
+    unknown = w2i[Special.UNKNOWN]
+    ids = []
+    offsets = []
+    total = 0
+    with open(f'{ids_path}.tmp', 'wb') as ids_file, open(f'{offsets_path}.tmp', 'wb') as offsets_file:
+        offsets_file.write(np.zeros(1, dtype=np.int64).tobytes())
+        for context, label in loader.labeled_samples():
+            ids.extend(w2i.get(word, unknown) for word in context.split())
+            ids.append(w2i.get(label, unknown))
+            offsets.append(total + len(ids))
+            if len(ids) >= TOKEN_CHUNK_SIZE:
+                ids_file.write(np.array(ids, dtype=np.int32).tobytes())
+                offsets_file.write(np.array(offsets, dtype=np.int64).tobytes())
+                total += len(ids)
+                ids = []
+                offsets = []
+        ids_file.write(np.array(ids, dtype=np.int32).tobytes())
+        offsets_file.write(np.array(offsets, dtype=np.int64).tobytes())
+    _npy_from_raw(f'{ids_path}.tmp', ids_path, np.int32)
+    _npy_from_raw(f'{offsets_path}.tmp', offsets_path, np.int64)
+
+
+class TokenizedSamples:
+    # The samples of a DataLoader as token ids. Sample i is
+    # ids[offsets[i]:offsets[i + 1]], the ids of its context words followed
+    # by the id of its label, and words[idx] is the word with id idx.
+    def __init__(self, words, ids, offsets):
+        self.words = words
+        self.ids = ids
+        self.offsets = offsets
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+    def lookup(self, w2i):
+        # An array from these ids to the ids of w2i, with the words that
+        # w2i does not know mapped to the unknown word.
+        unknown = w2i[Special.UNKNOWN]
+        return np.array([w2i.get(word, unknown) for word in self.words], dtype=np.int64)
+
+
+    def batch(self, start, end):
+        # The contexts of samples start to end as rows of ids, left padded
+        # to the longest of them, and their labels. An empty context is the
+        # start word alone.
+        offsets = np.asarray(self.offsets[start:end + 1], dtype=np.int64)
+        lengths = np.diff(offsets) - 1
+        width = max(1, int(lengths.max(initial=0)))
+        columns = np.arange(width) - (width - lengths)[:, None]
+        positions = offsets[:-1, None] + np.maximum(columns, 0)
+        contexts = np.where(columns >= 0, self.ids[positions], Special.all().index(Special.PADDING))
+        contexts[lengths == 0, -1] = Special.all().index(Special.START)
+        labels = np.asarray(self.ids[offsets[1:] - 1], dtype=np.int64)
+        return contexts.astype(np.int64), labels
     
 
 
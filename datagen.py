@@ -116,6 +116,7 @@ def main():
     parser.add_argument('-s', type=str, help='Sample file path')
     parser.add_argument('-o', type=str, help='Output directory')
     parser.add_argument('-n', type=int, help='Number of datapoints to read. Default behavior is reading all the data.')
+    parser.add_argument('-j', type=int, default=1, help='Number of processes to read the data with.')
     arguments = parser.parse_args()
 
     out_dir = arguments.o
@@ -127,9 +128,9 @@ def main():
 
     if not samples_path:
         if 'nyt' in data_path.lower():
-            source = DataSourceNTComments(data_path, 10 * arguments.n)
+            source = DataSourceNTComments(data_path, 10 * arguments.n, jobs=arguments.j)
         else:
-            source = DataSource(data_path, arguments.n)
+            source = DataSource(data_path, arguments.n, jobs=arguments.j)
         samples_path = os.path.join(out_dir, 'samples.txt')
         source.save_samples(samples_path)
 
@@ -1,4 +1,8 @@
 import os
+import io
+import contextlib
+import multiprocessing
+import numpy as np
 from ngram import NGramModel
 from neural import NeuralPredictor
 import argparse
@@ -13,7 +17,53 @@ def predict(model, context, k):
         return prediction
 
 
-def evaluate(model, data_src, k=None):
+def predict_batch(model, contexts, k):
+    return [prediction for prediction, _ in model.completions_batch(contexts, [''] * len(contexts), n=k)]
+
+
+def batches(data_src, batch_size):
+    batch = []
+    for sample in data_src.labeled_samples():
+        batch.append(sample)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def predictions(model, data_src, k, batch_size):
+    # The context, the number of context words, the label and the k
+    # predictions of each sample.
+    for batch in batches(data_src, max(1, batch_size)):
+        if batch_size > 1:
+            preds = predict_batch(model, [ctx for ctx, _ in batch], k)
+        else:
+            preds = [predict(model, ctx, k) for ctx, _ in batch]
+        for (ctx, label), pred in zip(batch, preds):
+            yield ctx, len(ctx.split()), label, pred
+
+
+def token_predictions(model, data_src, k, batch_size):
+    # predictions for a NeuralPredictor on a DataLoader, from the token ids
+    # of its samples rather than their text. The contexts are only turned
+    # into strings for the samples that evaluate prints.
+    tokens = data_src.tokens()
+    lookup = tokens.lookup(model._w2i)
+    for start in range(0, len(tokens), batch_size):
+        end = min(start + batch_size, len(tokens))
+        contexts, labels = tokens.batch(start, end)
+        lengths = np.diff(tokens.offsets[start:end + 1]) - 1
+        preds = model.completions_ids(lookup[contexts], k)
+        for i, label, length, (pred, _) in zip(range(start, end), labels.tolist(), lengths.tolist(), preds):
+            ctx = None
+            if (i + 1) % 100 == 0:
+                ctx = ' '.join(tokens.words[idx] for idx in tokens.ids[tokens.offsets[i]:tokens.offsets[i + 1] - 1])
+            yield ctx, length, tokens.words[label], pred
+
+
+def evaluate(model, data_src, k=None, batch_size=1):
+    # batch_size > 1 predicts that many samples per completions_batch call.
     if k is None or k == []:
         k = [1]
     max_k = max(k)
@@ -23,9 +73,12 @@ def evaluate(model, data_src, k=None):
     total = 0
     correct = [0] * len(k)
     acc = [0] * len(k)
-    for ctx, label in data_src.labeled_samples():
-        pred = predict(model, ctx, max_k)
-        ctx_len = len(ctx.split()) - 1
+    if batch_size > 1 and isinstance(model, NeuralPredictor) and hasattr(data_src, 'tokens'):
+        samples = token_predictions(model, data_src, max_k, batch_size)
+    else:
+        samples = predictions(model, data_src, max_k, batch_size)
+    for ctx, ctx_words, label, pred in samples:
+        ctx_len = ctx_words - 1
         keystrokes_total += len(label)
         for i in range(len(k)):
             if label in pred[:k[i]]:
@@ -43,7 +96,7 @@ def evaluate(model, data_src, k=None):
             print('---')
             for i in range(len(acc)):
                 print(f'Assuming char-level: % keystrokes saved (top {k[i]}):\t {keystrokes_saved[i] / keystrokes_total}\t [{keystrokes_saved[i]} out of {keystrokes_total}]')
-            
+        
             print(f'evaled {total} datapoints')
     for i in range(len(k)):
         acc[i] = correct[i] / total
@@ -51,10 +104,49 @@ def evaluate(model, data_src, k=None):
 
 
 
+class Shard:
+    # The samples in one byte range of a DataLoader's file.
+    def __init__(self, source, start, end):
+        self._source = source
+        self._start = start
+        self._end = end
+
+    def labeled_samples(self):
+        return self._source.labeled_samples(self._start, self._end)
+
+
+def evaluate_shard(job):
+    name, source, start, end, k, batch_size = job
+    model = NGramModel.attach(name)
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, correct, total = evaluate(model, Shard(source, start, end), k, batch_size)
+    return correct, total
+
+
+def evaluate_parallel(model, data_src, k, jobs, batch_size=1):
+    # evaluate over jobs processes, one shard of data_src, a DataLoader,
+    # each. The processes attach to one copy of the n-gram model in shared
+    # memory instead of loading their own.
+    shm = model.share()
+    try:
+        shards = [(shm.name, data_src, start, end, k, batch_size) for start, end in data_src.shards(jobs)]
+        with multiprocessing.Pool(jobs) as pool:
+            results = pool.map(evaluate_shard, shards)
+    finally:
+        shm.close()
+        shm.unlink()
+    correct = [sum(counts[i] for counts, _ in results) for i in range(len(k))]
+    total = sum(count for _, count in results)
+    acc = [c / total for c in correct]
+    return acc, correct, total
+
+
 def main():
-    parser = argparse.ArgumentParser(description='Evaluate word prediction model.', usage='\n* -m Model path. -d Validation dataset path.')
+    parser = argparse.ArgumentParser(description='Evaluate word prediction model.', usage='\n* -m Model path. -d Validation dataset path. -b Batch size. -j Processes.')
     parser.add_argument('-m', type=str, default='./model.txt', help='Model file path')
     parser.add_argument('-d', type=str, default='./data', help='Dataset directory path')
+    parser.add_argument('-b', type=int, default=64, help='Number of samples predicted per batch')
+    parser.add_argument('-j', type=int, default=1, help='Number of processes, n-gram models only')
     arguments = parser.parse_args()
     model_path = arguments.m
     data_path = arguments.d
@@ -70,7 +162,10 @@ def main():
     data = DataLoader(data_path)
     k = [1, 3, 5]
     print(k)
-    acc, correct, total = evaluate(model, data, k=k)
+    if arguments.j > 1 and isinstance(model, NGramModel):
+        acc, correct, total = evaluate_parallel(model, data, k, arguments.j, batch_size=arguments.b)
+    else:
+        acc, correct, total = evaluate(model, data, k=k, batch_size=arguments.b)
     for i in range(len(acc)):
         print(f'accuracy (top {k[i]}):\t {acc[i]}\t [{correct[i]} out of {total}]')
 
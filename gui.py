@@ -113,8 +113,9 @@ class Window(tk.Tk):
         self.update_displayed_words()
 
     def correct_text(self, pressed_word: str) -> None:
-        pressed_word = pressed_word + " "
         input_str = self.text_input.get(1.0, "end-1c")
+        self.word_probabilities[self.current_model].observe(input_str, pressed_word)
+        pressed_word = pressed_word + " "
         if len(input_str) == 0:
             self.text_input.insert(1.0, pressed_word)
         elif input_str[-1].isspace():
@@ -141,20 +142,24 @@ if __name__ == '__main__':
     parser.add_argument('--model-char-neural', type=str, default='_neural_char_e20', help='Path to neural network character model.')
     parser.add_argument('--model-word-ngram', type=str, default='_fair_10gram.txt', help='Path to N-gram word model.')
     parser.add_argument('--model-word-neural', type=str, default='_lstm_e10', help='Path to neural network word model.')
+    parser.add_argument('--trie', type=str, default='mmap', help='Trie type for the models (dict, compact or mmap).')
     arguments = parser.parse_args()
     num_word_displayed = arguments.n
     path_char_ngram = arguments.model_char_ngram
     path_char_neural = arguments.model_char_neural
     path_word_ngram = arguments.model_word_ngram
     path_word_neural = arguments.model_word_neural
+    trie = arguments.trie
 
-    probs_char_ngram = CharNGramProbabilities(path_char_ngram)
-    probs_char_neural = CharNeuralProbabilities(path_char_neural)
-    probs_word_ngram = NGramProbabilities(path_word_ngram)
-    probs_word_neural = NeuralProbabilities(path_word_neural)
+    probs_char_ngram = CharNGramProbabilities(path_char_ngram, trie=trie, lazy=True, log=True)
+    probs_char_neural = CharNeuralProbabilities(path_char_neural, trie=trie)
+    probs_word_ngram = NGramProbabilities(path_word_ngram, trie=trie, lazy=True, log=True)
+    probs_word_neural = NeuralProbabilities(path_word_neural, trie=trie)
     window = Window(num_words_displayed=num_word_displayed)
     window.insert_word_probability('Character N-gram', probs_char_ngram)
     window.insert_word_probability('Character neural network', probs_char_neural)
     window.insert_word_probability('Word N-gram', probs_word_ngram)
     window.insert_word_probability('Word neural network', probs_word_neural)
     window.mainloop()
+    for probs in window.word_probabilities.values():
+        probs.close()
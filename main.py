@@ -6,39 +6,82 @@ from ngram import NGramModel
 import argparse
 from data import DataSource, DataSourceNTComments, DataLoader, context_and_keystrokes
 
+def prune(model, min_counts, threshold, max_size, validation_path):
+    # Returns whether the model was pruned.
+    if min_counts is None and threshold is None and max_size is None:
+        return False
+    # eval imports torch, which training n-gram models does not need.
+    from eval import evaluate
+    k = [1, 3, 5]
+    stages = ['before', 'after']
+    for stage in stages:
+        if stage == 'after':
+            print('Pruning...')
+            max_bytes = None if max_size is None else int(max_size * 2**20)
+            removed = model.prune(min_counts, threshold, max_bytes)
+            print(f'Done pruning, removed {sum(removed.values())} k-grams {removed}.')
+        size = model.nbytes() / 2**20
+        if validation_path is None:
+            print(f'{stage} pruning: {size:.2f} MB')
+            continue
+        acc, _, _ = evaluate(model, DataLoader(validation_path), k=k)
+        accuracies = ', '.join(f'top {k[i]} {acc[i]:.4f}' for i in range(len(k)))
+        print(f'{stage} pruning: {size:.2f} MB, accuracy {accuracies}')
+    return True
+
+
 def main():
     parser = argparse.ArgumentParser(description='Train word prediction model.', usage='\n* -m Model file path. -d Dataset directory path. -n Number of datapoints to read.')
     parser.add_argument('-m', type=str, default='./model.txt', help='Model file path')
     parser.add_argument('-d', type=str, default='./data', help='Dataset directory path')
     parser.add_argument('-n', type=int, help='Number of datapoints to read. Default behavior is reading all the data.')
     parser.add_argument('-k', type=int, help='k-gram.')
-    parser.add_argument('-s', action='store_true', help='Save the data.')
+    parser.add_argument('-s', action='store_true', help='Save the data. A loaded model is saved over its file after pruning.')
+    parser.add_argument('-j', type=int, default=1, help='Number of processes to train with.')
+    parser.add_argument('-c', type=int, nargs='+', help='Pruning: smallest count kept for k-grams of order 2 and up, the last one is used for the remaining orders.')
+    parser.add_argument('-t', type=float, help='Pruning: remove k-grams with a contribution score below this.')
+    parser.add_argument('-b', type=float, help='Pruning: prune until the model fits in this many MB in the binary format.')
+    parser.add_argument('-v', type=str, help='Validation samples file, to report size and accuracy before and after pruning.')
     arguments = parser.parse_args()
     model_path = arguments.m
     data_path = arguments.d
     num_datapoints = arguments.n
     save_data = arguments.s
     k = arguments.k
+    jobs = arguments.j
+    min_counts = arguments.c
+    threshold = arguments.t
+    max_size = arguments.b
+    validation_path = arguments.v
     #source = DataSource(data_path, -1)
     #source.save_samples('samples.txt')
     if os.path.isfile(model_path):
         print('Loading...')
         model = NGramModel.load(model_path)
         print('Done loading.')
+        if prune(model, min_counts, threshold, max_size, validation_path) and save_data:
+            print('Saving...')
+            # The pruned model replaces the loaded one, in the same format.
+            model.save(model_path, binary=NGramModel.is_binary(model_path))
+            print('Done saving.')
     else:
         #if 'nyt' in data_path.lower():
         #    source = DataSourceNTComments(data_path, num_datapoints)
         #else:
         #    source = DataSource(data_path, num_datapoints)
         #source.save_samples('samples.txt')
-        source = DataLoader(data_path)
+        source = DataLoader(data_path, jobs=jobs)
         print('Teaching...')
         model = NGramModel(k)
         #for sentence in sentences():
         #    model.learn(sentence)
-        for sample in source.labeled_samples():
-            model.learn_sample(*sample)
+        if jobs > 1:
+            model.learn_parallel(source, jobs)
+        else:
+            for sample in source.labeled_samples():
+                model.learn_sample(*sample)
         print('Done teaching.')
+        prune(model, min_counts, threshold, max_size, validation_path)
         if save_data:
             print('Saving...')
             model.save(model_path)
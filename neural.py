@@ -1,12 +1,12 @@
 import string
 import os
 from data import Special, context_and_keystrokes
-from trie import FreqTrie
+from trie import make_trie
 import torch
 
 
 class NeuralPredictor(torch.nn.Module):
-    def __init__(self, lstm=True, data_src=None, max_ctx_len=3, epochs=None, device=None):
+    def __init__(self, lstm=True, data_src=None, max_ctx_len=3, epochs=None, device=None, trie='dict'):
         super().__init__()
         if device is None and torch.cuda.is_available():
             device = 'cuda'
@@ -16,7 +16,8 @@ class NeuralPredictor(torch.nn.Module):
         self._lstm = lstm
         self._w2i = {}
         self._i2w = []
-        self._trie = FreqTrie()
+        self._trie_kind = trie
+        self._trie = make_trie(trie)
 
         self._NUM_SPECIAL_WORDS = Special.size()
         self.add_word(Special.PADDING)
@@ -41,23 +42,35 @@ class NeuralPredictor(torch.nn.Module):
         print('Starting training')
         self.train()
         batch_size = 16
+        # The samples of a DataLoader, from data or chardata, are read as
+        # token ids, so its text is only split once, when they are first
+        # compiled.
+        tokens = data_src.tokens() if hasattr(data_src, 'tokens') else None
         try:
             for epoch in range(epochs):
                 print('epoch', epoch+1)
                 epoch_loss = 0.0
                 running_loss = 0.0
-                for i, data in enumerate(data_src.labeled_samples_batch(batch_size)):
+                if tokens is not None:
+                    batches = self._token_batches(tokens, batch_size)
+                else:
+                    batches = data_src.labeled_samples_batch(batch_size)
+                for i, data in enumerate(batches):
                     # get the inputs; data is a list of [inputs, labels]
                     contexts, labels = data #= NeuralPredictor.prep_sample(data)
-                    labels = list(map(lambda l: Special.UNKNOWN if l not in self._w2i else l, labels))
-                    labels = list(map(lambda l: self._w2i[l], labels))
+                    if tokens is None:
+                        labels = list(map(lambda l: Special.UNKNOWN if l not in self._w2i else l, labels))
+                        labels = list(map(lambda l: self._w2i[l], labels))
                     labels = torch.tensor(labels).to(self._device)
                 
                     # zero the parameter gradients
                     optimizer.zero_grad()
 
                     # forward + backward + optimize
-                    outputs = self(contexts)
+                    if tokens is not None:
+                        outputs = self.forward_ids(contexts)
+                    else:
+                        outputs = self(contexts)
                     loss = criterion(outputs, labels)
                     loss.backward()
                     optimizer.step()
@@ -76,6 +89,15 @@ class NeuralPredictor(torch.nn.Module):
             print('Finished Training early')
 
 
+    def _token_batches(self, tokens, batch_size):
+        # The batches of labeled_samples_batch as contexts and labels in
+        # this model's ids.
+        lookup = tokens.lookup(self._w2i)
+        for start in range(0, len(tokens), batch_size):
+            contexts, labels = tokens.batch(start, min(start + batch_size, len(tokens)))
+            yield torch.from_numpy(lookup[contexts]), lookup[labels]
+
+
     def _init_params(self):
         self._word_emb_size = 100
         self._vocab_size = len(self._w2i)
@@ -115,7 +137,7 @@ class NeuralPredictor(torch.nn.Module):
         self.to(self._device)
 
     
-    def load(path, device=None):
+    def load(path, device=None, trie='dict'):
         if device is None and torch.cuda.is_available():
             device = 'cuda'
         elif device is None:
@@ -127,15 +149,13 @@ class NeuralPredictor(torch.nn.Module):
         state = os.path.join(path, 'state.pt')
         words = os.path.join(path, 'words.txt')
         
-        model = NeuralPredictor(lstm=lstm, device=device)
+        model = NeuralPredictor(lstm=lstm, device=device, trie=trie)
         for f in [state, words]:
             if not os.path.isfile(f):
                 raise ValueError(f'Could not find model at path {path}')
 
         with open(words, 'r', encoding='utf-8') as f:
-            for line in f.readlines():
-                word = line.strip()
-                model.add_word(word)
+            model.learn_words((line.strip() for line in f), sidecar=os.path.join(path, 'words.trie'))
         
         model._init_params()
 
@@ -168,8 +188,23 @@ class NeuralPredictor(torch.nn.Module):
                 self._trie.add_word(word)
 
     def learn_vocab(self, data_src):
-        for word in data_src.vocab():
-            self.add_word(word)
+        self.learn_words(data_src.vocab())
+
+
+    def learn_words(self, words, sidecar=None):
+        # Bulk version of add_word, building the trie once at the end.
+        special = Special.all()
+        counts = []
+        for word in words:
+            if word not in self._w2i:
+                idx = len(self._i2w)
+                self._w2i[word] = idx
+                self._i2w.append(word)
+                if word not in special:
+                    counts.append((word, 1))
+        _, known, freqs = self._trie.get_words('')
+        counts.extend(zip(known, freqs))
+        self._trie = make_trie(self._trie_kind, counts, sidecar=sidecar)
 
 
     def forward(self, x):
@@ -194,7 +229,12 @@ class NeuralPredictor(torch.nn.Module):
                 lambda ctx:\
                 list(map(lambda w: self._w2i[w], ctx)),\
                 x))
-        ctx = torch.tensor(x, dtype=torch.long).to(self._device)
+        return self.forward_ids(torch.tensor(x, dtype=torch.long))
+
+
+    def forward_ids(self, ctx):
+        # forward for contexts given as rows of word ids, left padded.
+        ctx = ctx.to(self._device)
         ctx = ctx.permute((1, 0))
         ctx_emb = self._word_emb(ctx).float()
         
@@ -214,14 +254,106 @@ class NeuralPredictor(torch.nn.Module):
         return context, keystrokes, label
 
 
-    def completions(self, context, keystrokes, n=1, deterministic=True):
-        _, candidates, _ = self._trie.get_words(keystrokes)
+    def completions(self, context, keystrokes, n=1, deterministic=True, max_candidates=None):
+        return self._ranked(torch.flatten(self(context)), keystrokes, n, deterministic, max_candidates)
+
+
+    def completions_batch(self, contexts, keystrokes, n=1, max_candidates=None):
+        # Deterministic completions for each pair of contexts[i] and
+        # keystrokes[i]. Contexts with the same number of words share a
+        # forward pass, so none of them is padded and each gets the
+        # completions it gets alone. Rows with the same keystrokes share
+        # their candidates and are ranked together.
+        if len(contexts) == 0:
+            return []
+        contexts = list(contexts)
+        lengths = [max(1, len(ctx.split())) for ctx in contexts]
+        with torch.no_grad():
+            logits = self._bucketed(lengths, lambda rows, _: self([contexts[i] for i in rows]))
+        return self._ranked_batch(logits, keystrokes, n, max_candidates)
+
+
+    def completions_ids(self, contexts, n=1):
+        # completions_batch with no keystrokes for contexts given as rows of
+        # word ids, left padded, as from TokenizedSamples.batch. The padding
+        # is cut off again before the forward passes.
+        if len(contexts) == 0:
+            return []
+        contexts = torch.as_tensor(contexts, dtype=torch.long)
+        lengths = (contexts != self._w2i[Special.PADDING]).sum(dim=1).tolist()
+        with torch.no_grad():
+            logits = self._bucketed(lengths, lambda rows, length: self.forward_ids(contexts[rows, -length:]))
+        return self._ranked_batch(logits, [None] * len(contexts), n)
+
+
+    def _bucketed(self, lengths, forward):
+        # The logits of every row, from one forward(rows, length) call per
+        # context length over the rows of that length.
+        buckets = {}
+        for i, length in enumerate(lengths):
+            buckets.setdefault(length, []).append(i)
+        logits = None
+        for length, rows in buckets.items():
+            bucket = forward(rows, length)
+            if logits is None:
+                logits = bucket.new_empty((len(lengths), bucket.shape[1]))
+            logits[rows] = bucket
+        return logits
+
+
+    def _ranked_batch(self, logits, keystrokes, n=1, max_candidates=None):
+        # Keystrokes of None have every word as a candidate, without going
+        # through the trie. The words are all the ids after the special
+        # words.
+        groups = {}
+        for i, prefix in enumerate(keystrokes):
+            groups.setdefault(prefix, []).append(i)
+        results = [([], []) for _ in range(len(logits))]
+        for prefix, rows in groups.items():
+            if prefix is None:
+                candidates = self._i2w[self._NUM_SPECIAL_WORDS:]
+            else:
+                candidates = self._candidates(prefix, max_candidates)
+            count = len(candidates) if n < 0 else n
+            if count == 0 or len(candidates) == 0:
+                continue
+            if prefix is None:
+                candidate_idx = torch.arange(self._NUM_SPECIAL_WORDS, len(self._i2w), device=logits.device)
+            else:
+                candidate_idx = torch.tensor([self._w2i[cand] for cand in candidates], device=logits.device)
+            prob = torch.nn.functional.softmax(logits[rows][:, candidate_idx], dim=1)
+            # Everything tied with the n-th best is kept, so ties are broken
+            # by word as in completions.
+            nth = prob.topk(min(count, len(candidates)), dim=1).values[:, -1:]
+            for i, row, threshold in zip(rows, prob, nth):
+                chosen = torch.nonzero(row >= threshold).flatten().tolist()
+                det = sorted(zip(row[chosen].tolist(), [candidates[j] for j in chosen]), reverse=True)[:count]
+                probs, completions = list(zip(*det))
+                results[i] = (list(completions), list(probs))
+        return results
+
+
+    def _candidates(self, keystrokes, max_candidates=None):
+        if max_candidates is None:
+            _, candidates, _ = self._trie.get_words(keystrokes)
+        else:
+            _, candidates, _ = self._trie.top_k(keystrokes, max_candidates)
+        return candidates
+
+
+    def _ranked(self, logits, keystrokes, n=1, deterministic=True, max_candidates=None):
+        # The n best completions of keystrokes given the logits of one
+        # context.
+        candidates = self._candidates(keystrokes, max_candidates)
         candidate_idx = list(map(lambda cand: self._w2i[cand], candidates))
-        prob = torch.flatten(self(context))[candidate_idx]
+        prob = logits[candidate_idx]
         prob = torch.nn.functional.softmax(prob, dim=0)
         prob = prob.tolist()
 
-        if n <= 0 or len(candidates) == 0:
+        # A negative n asks for all of them, as for NGramModel.completions.
+        if n < 0:
+            n = len(candidates)
+        if n == 0 or len(candidates) == 0:
             return [], []
         elif deterministic:
             det = list(zip(prob, candidates))
@@ -1,8 +1,19 @@
 # Authored 2024.5 by Rasmus Nylander (nylanderDev)
 
+import os
+import csv
+import json
+import mmap
+import struct
+import threading
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
 import numpy as np
+from bisect import bisect_left, bisect_right
+from heapq import heappush, heappop
+from collections import OrderedDict
 from data import Special, DataSource
-from trie import FreqTrie
+from trie import make_trie
 
 
 def gen_weights(n, factor=0.99, w=1.0):
@@ -12,11 +23,237 @@ def gen_weights(n, factor=0.99, w=1.0):
         return gen_weights(n-1, (1.0 - factor) * w) + [factor * w]
 
 
+def _gather(keys, values, ids):
+    # values[i] where keys[i] == id for each id in ids, 0 where the id is
+    # missing. keys must be sorted.
+    if len(keys) == 0:
+        return np.zeros(len(ids), dtype=np.int64)
+    pos = keys.searchsorted(ids)
+    pos[pos == len(keys)] = 0
+    return np.where(keys[pos] == ids, values[pos], 0)
+
+
+# Binary model layout: magic, format version and header length, then a JSON
+# header, then the raw arrays it lists, each aligned to 64 bytes. Array
+# offsets in the header are relative to the first aligned byte after it.
+BINARY_MAGIC = b'NGRAMBIN'
+BINARY_VERSION = 2
+_BINARY_PREFIX = struct.Struct('<8sII')
+_BINARY_ALIGN = 64
+
+
+def _align(offset):
+    return offset + (-offset % _BINARY_ALIGN)
+
+
+def _store_nbytes(n, contexts, ngrams, count_bits=64):
+    # Size of the arrays of a FrozenNGramStore in the binary format, or of a
+    # QuantizedNGramStore with count_bits bit codes, not counting its levels.
+    size = _align((n - 1) * contexts * 4) + _align((contexts + 1) * 8) + _align(ngrams * 4) + _align(ngrams * count_bits // 8)
+    if count_bits < 64:
+        size += _align(contexts * 8)
+    return size
+
+
+def _count_bits(store):
+    if isinstance(store, QuantizedNGramStore):
+        return store._codes.itemsize * 8
+    return 64
+
+
+def _row_totals(offsets, counts):
+    # Sum of counts over each context row of a FrozenNGramStore layout.
+    lengths = np.diff(offsets)
+    nonempty = lengths > 0
+    totals = np.zeros(len(lengths), dtype=np.int64)
+    totals[nonempty] = np.add.reduceat(counts, offsets[:-1][nonempty])
+    return totals
+
+
+def _stub_total(store, stubgram, counts):
+    # The total count after stubgram, whose counts in store are counts.
+    # QuantizedNGramStores keep it exactly, their dequantized counts only
+    # add up to it roughly.
+    if isinstance(store, OverlayNGramStore) and isinstance(store._base, QuantizedNGramStore):
+        _, delta_counts = store._delta.successor_table(stubgram)
+        return _stub_total(store._base, stubgram, None) + int(delta_counts.sum())
+    if isinstance(store, QuantizedNGramStore):
+        row = store._row(stubgram)
+        return 0 if row is None else int(store._totals[row])
+    return int(counts.sum())
+
+
+# Code sizes QuantizedNGramStore supports.
+COUNT_BITS = [8, 16]
+
+
+def _log_levels(max_count, bits):
+    # Up to 2**bits counts from 1 to max_count, evenly spaced in log scale
+    # and rounded. The low ones round to every integer, so small counts,
+    # most of them, stay exact.
+    return np.unique(np.rint(np.geomspace(1, max(max_count, 1), 2**bits))).astype(np.int64)
+
+
+def _quantized(counts, levels, bits):
+    # Index of the level nearest to each count in log scale.
+    bounds = np.sqrt(levels[:-1].astype(np.float64) * levels[1:])
+    return bounds.searchsorted(counts).astype(np.uint8 if bits == 8 else np.uint16)
+
+
+def _ngram_matrix(store):
+    # The k-grams of a FrozenNGramStore as the columns of a (k, N) array.
+    rows = np.repeat(np.arange(len(store._offsets) - 1), np.diff(store._offsets))
+    return np.vstack([store._contexts[:, rows], store._successors[np.newaxis]])
+
+
+def _ngram_keys(store):
+    # The k-grams of a FrozenNGramStore as one sortable key each, in store
+    # order. Big-endian ids make the bytewise order of the keys the same
+    # as the lexicographic order of the k-grams.
+    grams = _ngram_matrix(store)
+    return np.ascontiguousarray(grams.T.astype('>i8')).view(f'V{8 * store._n}').ravel()
+
+
+def _mix(x):
+    # The splitmix64 finalizer, elementwise on uint64 arrays.
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def _continuations(store, higher):
+    # For each k-gram in store, in how many different (k+1)-grams of higher
+    # it is the suffix.
+    rows = np.repeat(np.arange(len(higher._offsets) - 1), np.diff(higher._offsets))
+    suffixes = np.vstack([higher._contexts[1:, rows], higher._successors[np.newaxis]])
+    suffixes = np.ascontiguousarray(suffixes.T.astype('>i8')).view(f'V{8 * store._n}').ravel()
+    suffixes, counts = np.unique(suffixes, return_counts=True)
+    keys = _ngram_keys(store)
+    continuations = np.zeros(len(keys), dtype=np.int64)
+    if len(keys) > 0:
+        pos = keys.searchsorted(suffixes)
+        pos[pos == len(keys)] = 0
+        found = keys[pos] == suffixes
+        continuations[pos[found]] = counts[found]
+    return continuations
+
+
+def _backoff_counts(stores, kneser_ney):
+    # For each order k of stores, FrozenNGramStores of all orders: the
+    # CountStats of its counts and, with kneser_ney and below the top order,
+    # the continuation counts of its k-grams in store order with their
+    # CountStats. None for the others.
+    counts = {}
+    for k, store in stores.items():
+        continuations = continuation_stats = None
+        if kneser_ney and k + 1 in stores:
+            continuations = _continuations(store, stores[k+1])
+            continuation_stats = CountStats.from_counts(continuations)
+        counts[k] = (CountStats.from_counts(store._counts), continuations, continuation_stats)
+    return counts
+
+
+def _count_shard(job):
+    # Worker side of NGramModel.learn_parallel: counts the samples in one
+    # byte range of source with shard local word ids. The special words get
+    # the same ids as in NGramModel, the rest are numbered in order of first
+    # appearance. Returns that vocabulary, how often each word was learnt
+    # and the counts of each order as {stub: {last: freq}}.
+    source, start, end, n = job
+    i2w = Special.all()
+    w2i = {word: idx for idx, word in enumerate(i2w)}
+    special = set(i2w)
+    word_counts = [0] * len(i2w)
+    counts = {k: {} for k in range(1, n+1)}
+    for context, label in source.labeled_samples(start, end):
+        words = f'{context} {label}'.split()
+        if len(words) < n:
+            words = [Special.PADDING] * (n - len(words)) + words
+        ids = []
+        for word in words:
+            idx = w2i.get(word)
+            if idx is None:
+                idx = len(i2w)
+                w2i[word] = idx
+                i2w.append(word)
+                word_counts.append(0)
+            if word not in special:
+                word_counts[idx] += 1
+            ids.append(idx)
+        for k in range(1, n+1):
+            stub = tuple(ids[len(ids)-k:-1])
+            successors = counts[k].get(stub)
+            if successors is None:
+                successors = counts[k][stub] = {}
+            last = ids[-1]
+            successors[last] = successors.get(last, 0) + 1
+    return i2w, word_counts, counts
+
+
+def _read_section(f, k):
+    # The k-grams of order k with their counts, from the section of a text
+    # model f is at. f can be opened in text or binary mode.
+    count = int(f.readline().split()[0])
+    kgrams = []
+    for _ in range(count):
+        parts = f.readline().split()
+        kgrams.append((list(map(int, parts[:k])), int(parts[k])))
+    return kgrams
+
+
+def _filled(store, kgrams, frozen):
+    # store, empty as NGramModel made it, with kgrams added. frozen=True
+    # gives a FrozenNGramStore instead of a dict based one.
+    if isinstance(store, SketchNGramStore):
+        store.add_ngrams([kgram for kgram, _ in kgrams], [freq for _, freq in kgrams])
+    elif frozen:
+        store = FrozenNGramStore.from_ngrams(store._n, kgrams)
+    else:
+        for kgram, freq in kgrams:
+            store.add_ngram(kgram, freq)
+    return store
+
+
+# Ways NGramModel.completions can score candidates. 'interpolate' mixes all
+# orders with gen_weights. The other two back off: a candidate is scored at
+# the highest order that has seen it after the context, times the backoff
+# weights of the orders above. 'stupid-backoff' uses relative frequencies and
+# a fixed weight, 'kneser-ney' absolute discounting with continuation counts
+# for the lower orders.
+SCORINGS = ['interpolate', 'stupid-backoff', 'kneser-ney']
+STUPID_BACKOFF_WEIGHT = 0.4
+
+
 class NGramModel:
-    def __init__(self, n=2):
+    _CANDIDATE_CACHE_SIZE = 64
+    # Prefixes with fewer candidates than this are scored exhaustively, see
+    # _top_interpolated.
+    _TOP_K_MIN_CANDIDATES = 1024
+
+    def __init__(self, n=2, trie='dict', stub_cache_size=1024, scoring='interpolate', approx_orders=(), sketch_width=2**16, sketch_depth=4):
+        # The orders in approx_orders are kept in count-min sketches of
+        # sketch_depth rows of sketch_width counters, see SketchNGramStore.
+        if scoring not in SCORINGS:
+            raise ValueError(f'Expected scoring to be one of {SCORINGS}, got {scoring}')
+        if 1 in approx_orders:
+            raise ValueError('Unigrams make up the vocabulary and cannot be sketched')
+        if approx_orders and scoring != 'interpolate':
+            raise ValueError(f'Sketched orders only support interpolate scoring, got {scoring}')
         self._lambda = gen_weights(n+1)
         self._n = n
-        self._trie = FreqTrie()
+        self._scoring = scoring
+        self._backoff = None
+        self._count_bits = None
+        self._log = None
+        self._log_writer = None
+        self._log_size = 0
+        self._trie = make_trie(trie)
+        self._candidate_cache = {}
+        self._ranking = None
+        self._stub_cache = StubCache(stub_cache_size)
+        self._last_context = (None, None)
         self._w2i = {}
         self._i2w = []
         self._ngram_stores = {}
@@ -24,7 +261,10 @@ class NGramModel:
         for spec in self._SPECIAL_WORDS:
             self.add_word(spec)
         for i in range(1, n+1):
-            self._ngram_stores[i] = NGramStore(i)
+            if i in approx_orders:
+                self._ngram_stores[i] = SketchNGramStore(i, sketch_width, sketch_depth)
+            else:
+                self._ngram_stores[i] = NGramStore(i)
 
 
     def freq(self, ngram):
@@ -60,10 +300,51 @@ class NGramModel:
             self.add_ngram(kgram)
 
 
-    def save(self, path):
+    def learn_parallel(self, source, jobs):
+        # Same as calling learn_sample for every sample of source, a
+        # DataLoader, in order. The file is split into one byte range per job
+        # and counted in worker processes. The shards are merged in file
+        # order, so word ids, store and trie contents and their order all
+        # come out as in serial training.
+        shards = [(source, start, end, self._n) for start, end in source.shards(jobs)]
+        with multiprocessing.Pool(jobs) as pool:
+            for i2w, word_counts, counts in pool.imap(_count_shard, shards):
+                self._merge_counts(i2w, word_counts, counts)
+
+
+    def _merge_counts(self, i2w, word_counts, counts):
+        # Only special words have a count of 0, and add_word leaves them
+        # out of the trie.
+        for word, freq in zip(i2w, word_counts):
+            self.add_word(word, freq)
+        ids = [self._w2i[word] for word in i2w]
+        for k, stubs in counts.items():
+            store = self._ngram_stores[k]
+            for stub, successors in stubs.items():
+                store.add_successors([ids[idx] for idx in stub], [(ids[idx], freq) for idx, freq in successors.items()])
+        self._stub_cache.clear()
+        self._ranking = None
+        self._backoff = None
+
+
+    def save(self, path, binary=False):
+        # Written to a temporary file that then replaces path, so a model
+        # still mapped from path is never overwritten in place.
+        tmp_path = f'{path}.tmp'
+        if binary:
+            self._save_binary(tmp_path)
+        else:
+            self._save_text(tmp_path)
+        os.replace(tmp_path, path)
+
+
+    def _save_text(self, path):
         with open(path, 'w', encoding='utf-8') as f:
             vocab_size = len(self._i2w)
-            header = f'{self._n} {vocab_size}\n'
+            if self._scoring == 'interpolate':
+                header = f'{self._n} {vocab_size}\n'
+            else:
+                header = f'{self._n} {vocab_size} {self._scoring}\n'
             f.writelines([header])
             for i in range(vocab_size):
                 idx = i
@@ -79,13 +360,224 @@ class NGramModel:
                     f.writelines([f'{kgram_str} {freq}\n'])
 
 
-    def load(path):
+    def _save_binary(self, path):
+        header, arrays = self._binary_layout()
+        with open(path, 'wb') as f:
+            f.write(_BINARY_PREFIX.pack(BINARY_MAGIC, BINARY_VERSION, len(header)))
+            f.write(header)
+            for array in arrays.values():
+                f.write(b'\0' * (-f.tell() % _BINARY_ALIGN))
+                f.write(np.ascontiguousarray(array).tobytes())
+
+
+    def _binary_layout(self):
+        # The JSON header of the binary format and the arrays it lists, in
+        # order.
+        words = [word.encode('utf-8') for word in self._i2w]
+        vocab_offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        vocab_offsets[1:] = np.cumsum([len(word) for word in words])
+        arrays = {
+            'vocab_offsets': vocab_offsets,
+            'vocab_bytes': np.frombuffer(b''.join(words), dtype=np.uint8),
+        }
+        stores = {}
+        for k, store in self._ngram_stores.items():
+            if isinstance(store, SketchNGramStore):
+                arrays[f'{k}.sketch'] = store._counters
+                continue
+            if not isinstance(store, FrozenNGramStore):
+                store = FrozenNGramStore.from_store(store)
+            if self._count_bits is not None and k > 1 and not isinstance(store, QuantizedNGramStore):
+                # Counts learnt since quantize are quantized again.
+                store = QuantizedNGramStore.from_store(store, self._count_bits)
+            arrays[f'{k}.contexts'] = store._contexts
+            arrays[f'{k}.offsets'] = store._offsets
+            arrays[f'{k}.successors'] = store._successors
+            if isinstance(store, QuantizedNGramStore):
+                arrays[f'{k}.codes'] = store._codes
+                arrays[f'{k}.levels'] = store._levels
+                arrays[f'{k}.totals'] = store._totals
+            else:
+                arrays[f'{k}.counts'] = store._counts
+            stores[k] = store
+
+        header = {'n': self._n, 'scoring': self._scoring, 'arrays': {}}
+        if self._scoring != 'interpolate':
+            # What the backoff scorings need besides the counts is computed
+            # from the stores as saved, so loading needs no more than
+            # mapping it.
+            counts = _backoff_counts(stores, self._scoring == 'kneser-ney')
+            header['count_stats'] = [counts[k][0].header() for k in range(1, self._n+1)]
+            header['continuation_stats'] = [None if counts[k][2] is None else counts[k][2].header() for k in range(1, self._n+1)]
+            for k in range(1, self._n+1):
+                if counts[k][1] is not None:
+                    arrays[f'{k}.continuations'] = counts[k][1]
+        if self._count_bits is not None:
+            header['count_bits'] = self._count_bits
+        offset = 0
+        for name, array in arrays.items():
+            header['arrays'][name] = [array.dtype.str, list(array.shape), offset]
+            offset = _align(offset + array.nbytes)
+        return json.dumps(header).encode('utf-8'), arrays
+
+
+    def share(self, name=None):
+        # Copies the model in the binary layout into a new block of shared
+        # memory, for other processes to attach to by its name. Returns the
+        # SharedMemory. The caller keeps it while the model is in use, then
+        # closes and unlinks it.
+        header, arrays = self._binary_layout()
+        base = _align(_BINARY_PREFIX.size + len(header))
+        offsets = []
+        size = 0
+        for array in arrays.values():
+            offsets.append(size)
+            size = _align(size + array.nbytes)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=base + size)
+        _BINARY_PREFIX.pack_into(shm.buf, 0, BINARY_MAGIC, BINARY_VERSION, len(header))
+        shm.buf[_BINARY_PREFIX.size:_BINARY_PREFIX.size + len(header)] = header
+        for offset, array in zip(offsets, arrays.values()):
+            data = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+            np.frombuffer(shm.buf, dtype=np.uint8, count=len(data), offset=base + offset)[:] = data
+        return shm
+
+
+    def attach(name, trie='dict', stub_cache_size=1024, scoring=None):
+        # A model over the block of shared memory made by share(). As with
+        # binary files its stores are read-only views into the block, so
+        # processes attached to it share one copy of the counts. Only the
+        # vocabulary and the trie are per process.
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 opening a block always registers it with
+            # the resource tracker, which unlinks it when this process exits
+            # and takes it away from all the others. Only share() should.
+            register = resource_tracker.register
+            resource_tracker.register = lambda name, rtype: None
+            try:
+                shm = shared_memory.SharedMemory(name=name)
+            finally:
+                resource_tracker.register = register
+        model = NGramModel._from_buffer(shm.buf, trie, stub_cache_size, scoring=scoring)
+        # Kept for as long as the model, its arrays point into it.
+        model._shared = shm
+        return model
+
+
+    def _load_binary(path, trie='dict', stub_cache_size=1024, scoring=None, approx_orders=(), sketch_width=2**16, sketch_depth=4):
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        model = NGramModel._from_buffer(buffer, trie, stub_cache_size, sidecar=f'{path}.trie', scoring=scoring)
+        if 1 in approx_orders:
+            raise ValueError('Unigrams make up the vocabulary and cannot be sketched')
+        if approx_orders and model._scoring != 'interpolate':
+            raise ValueError(f'Sketched orders only support interpolate scoring, got {model._scoring}')
+        for k in approx_orders:
+            store = model._ngram_stores[k]
+            if isinstance(store, FrozenNGramStore):
+                model._ngram_stores[k] = SketchNGramStore(k, sketch_width, sketch_depth)
+                model._ngram_stores[k].add_ngrams(_ngram_matrix(store).T, store._counts)
+        return model
+
+
+    def _from_buffer(buffer, trie='dict', stub_cache_size=1024, sidecar=None, scoring=None):
+        # The stores are FrozenNGramStores whose arrays are read-only views
+        # into buffer, nothing is copied but the vocabulary. Files written
+        # before scoring modes existed are 'interpolate' ones. Version 1
+        # files saved backoff probabilities rather than the counts they are
+        # made from, their backoff tables are made again when needed.
+        magic, version, length = _BINARY_PREFIX.unpack_from(buffer)
+        if magic != BINARY_MAGIC:
+            raise ValueError('Not a binary n-gram model')
+        if version not in (1, BINARY_VERSION):
+            raise ValueError(f'Unsupported binary n-gram model version {version}, expected {BINARY_VERSION}')
+        start = _BINARY_PREFIX.size
+        header = json.loads(bytes(buffer[start:start + length]).decode('utf-8'))
+        base = _align(start + length)
+
+        def array(name):
+            dtype, shape, offset = header['arrays'][name]
+            count = int(np.prod(shape))
+            if count == 0:
+                return np.zeros(shape, dtype=dtype)
+            view = np.frombuffer(buffer, dtype=dtype, count=count, offset=base + offset).reshape(shape)
+            # Shared memory is writable, the stores must not write to it.
+            view.flags.writeable = False
+            return view
+
+        _n = header['n']
+        saved_scoring = header.get('scoring', 'interpolate')
+        model = NGramModel(_n, trie=trie, stub_cache_size=stub_cache_size, scoring=scoring or saved_scoring)
+        model._count_bits = header.get('count_bits')
+        vocab_offsets = array('vocab_offsets').tolist()
+        vocab_bytes = array('vocab_bytes').tobytes()
+        model._i2w = [vocab_bytes[vocab_offsets[i]:vocab_offsets[i + 1]].decode('utf-8') for i in range(len(vocab_offsets) - 1)]
+        model._w2i = {word: idx for idx, word in enumerate(model._i2w)}
+        for k in range(1, _n+1):
+            if f'{k}.sketch' in header['arrays']:
+                model._ngram_stores[k] = SketchNGramStore(k, counters=array(f'{k}.sketch'))
+                continue
+            if f'{k}.codes' in header['arrays']:
+                model._ngram_stores[k] = QuantizedNGramStore(k,
+                        array(f'{k}.contexts'),
+                        array(f'{k}.offsets'),
+                        array(f'{k}.successors'),
+                        array(f'{k}.codes'),
+                        array(f'{k}.levels'),
+                        array(f'{k}.totals'))
+                continue
+            model._ngram_stores[k] = FrozenNGramStore(k,
+                    array(f'{k}.contexts'),
+                    array(f'{k}.offsets'),
+                    array(f'{k}.successors'),
+                    array(f'{k}.counts'))
+        if model._scoring == saved_scoring != 'interpolate' and 'count_stats' in header:
+            model._backoff = {}
+            for k in range(1, _n+1):
+                continuations = continuation_stats = None
+                if f'{k}.continuations' in header['arrays']:
+                    store = model._ngram_stores[k]
+                    continuations = OverlayNGramStore(FrozenNGramStore(k, store._contexts, store._offsets, store._successors, array(f'{k}.continuations')))
+                    continuation_stats = CountStats(*header['continuation_stats'][k - 1])
+                model._backoff[k] = (CountStats(*header['count_stats'][k - 1]), continuations, continuation_stats)
+
+        unigrams = model._ngram_stores[1]
+        freqs = np.zeros(len(model._i2w), dtype=np.int64)
+        freqs[unigrams._successors] = unigrams._counts
+        vocab_counts = [(word, freq) for word, freq in zip(model._i2w, freqs.tolist()) if word not in model._SPECIAL_WORDS]
+        model._trie = make_trie(trie, vocab_counts, sidecar=sidecar)
+        return model
+
+
+    def is_binary(path):
+        with open(path, 'rb') as f:
+            return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+    def load(path, trie='dict', frozen=False, stub_cache_size=1024, scoring=None, approx_orders=(), sketch_width=2**16, sketch_depth=4, lazy=False):
+        # Reads both the text and the binary format. Binary models always
+        # come with FrozenNGramStores mapped from the file. For text models,
+        # frozen=True puts the k-grams straight into FrozenNGramStores,
+        # without building the dict based stores first. scoring overrides
+        # the scoring mode saved with the model. The orders in
+        # approx_orders are loaded into count-min sketches. lazy=True
+        # returns a text model as soon as the vocabulary, unigrams and trie
+        # are read, and reads the other orders in the background, see
+        # LazyStores. Binary models are mapped, so lazy has no effect there.
+        if NGramModel.is_binary(path):
+            return NGramModel._load_binary(path, trie, stub_cache_size, scoring, approx_orders, sketch_width, sketch_depth)
         with open(path, 'r', encoding='utf-8') as f:
             headers = f.readline().strip().split(' ')
             _n = int(headers[0])
-            model = NGramModel(_n)
+            if scoring is None:
+                scoring = headers[2] if len(headers) > 2 else 'interpolate'
+            model = NGramModel(_n, trie=trie, stub_cache_size=stub_cache_size, scoring=scoring,
+                    approx_orders=approx_orders, sketch_width=sketch_width, sketch_depth=sketch_depth)
             vocab_size = int(headers[1])
             model._i2w = [None] * vocab_size
+            vocab_counts = []
+            unigrams = []
             for i in range(vocab_size):
                 parts = f.readline().strip().split(' ')
                 idx = int(parts[0])
@@ -93,104 +585,664 @@ class NGramModel:
                 freq = int(parts[2])
                 model._w2i[word] = idx
                 model._i2w[idx] = word
-                model.add_ngram([idx], freq)
-                model.add_word(word, freq)
+                if frozen:
+                    unigrams.append(([idx], freq))
+                else:
+                    model.add_ngram([idx], freq)
+                if word not in model._SPECIAL_WORDS:
+                    vocab_counts.append((word, freq))
+            model._trie = make_trie(trie, vocab_counts, sidecar=f'{path}.trie')
+            if frozen:
+                model._ngram_stores[1] = FrozenNGramStore.from_ngrams(1, unigrams)
+            if lazy and _n > 1:
+                model._ngram_stores = LazyStores(path, f.tell(), model._ngram_stores, frozen)
+                return model
             for k in range(2, _n+1):
-                headers = f.readline().strip().split(' ')
-                kgram_count = int(headers[0])
-                for i in range(kgram_count):
-                    parts = f.readline().strip().split(' ')
-                    kgram = list(map(int, parts[:k]))
-                    freq = int(parts[k])
-                    model.add_ngram(kgram, freq)
+                model._ngram_stores[k] = _filled(model._ngram_stores[k], _read_section(f, k), frozen)
             return model
 
 
+    def freeze(self):
+        # Replace the training time stores with read-only FrozenNGramStores.
+        # Learning more n-grams afterwards raises ValueError.
+        for k, store in self._ngram_stores.items():
+            if not isinstance(store, (FrozenNGramStore, SketchNGramStore)):
+                self._ngram_stores[k] = FrozenNGramStore.from_store(store)
+        self._stub_cache.clear()
+        self._backoff = None
+
+
+    def quantize(self, bits=8):
+        # Replace the stores of order 2 and up with QuantizedNGramStores of
+        # bits bit counts, and keep saving them that way. Unigrams stay
+        # exact, they rank the vocabulary, and sketched orders stay as they
+        # are.
+        if bits not in COUNT_BITS:
+            raise ValueError(f'Expected bits to be one of {COUNT_BITS}, got {bits}')
+        for k in range(2, self._n+1):
+            if not isinstance(self._ngram_stores[k], SketchNGramStore):
+                self._ngram_stores[k] = QuantizedNGramStore.from_store(self._ngram_stores[k], bits)
+        self._count_bits = bits
+        self._stub_cache.clear()
+        self._backoff = None
+
+
+    def nbytes(self):
+        # Size of the model in the binary format, not counting the header.
+        vocab_bytes = sum(len(word.encode('utf-8')) for word in self._i2w)
+        size = _align((len(self._i2w) + 1) * 8) + _align(vocab_bytes)
+        for k, store in self._ngram_stores.items():
+            if isinstance(store, SketchNGramStore):
+                size += _align(store._counters.nbytes)
+            elif isinstance(store, QuantizedNGramStore):
+                size += _store_nbytes(k, store.num_contexts(), len(store), _count_bits(store)) + _align(store._levels.nbytes)
+            else:
+                size += _store_nbytes(k, store.num_contexts(), len(store))
+        return size
+
+
+    def prune(self, min_counts=None, threshold=None, max_bytes=None):
+        # Removes k-grams of order 2 and up. min_counts lists the smallest
+        # count kept for each order from 2 up, the last one also applies to
+        # the orders after it. threshold removes the k-grams whose
+        # contribution score (see _contributions) is below it. max_bytes
+        # raises the threshold just enough for nbytes() to fit. Unigrams are
+        # never pruned, they make up the vocabulary, and neither are the
+        # orders from the first sketched one up. Returns the number of
+        # k-grams removed per order.
+        if not min_counts:
+            min_counts = [0]
+        ngrams = {}
+        for k in range(2, self._n+1):
+            if isinstance(self._ngram_stores[k], SketchNGramStore):
+                break
+            ngrams[k] = self._ngram_stores[k].all_ngrams()
+        scores = self._contributions(ngrams)
+        keep = {}
+        for k, kgrams in ngrams.items():
+            freqs = np.fromiter((freq for _, freq in kgrams), dtype=np.int64, count=len(kgrams))
+            keep[k] = freqs >= min_counts[min(k - 2, len(min_counts) - 1)]
+        if max_bytes is not None:
+            fit = self._fit_threshold(ngrams, scores, keep, max_bytes)
+            threshold = fit if threshold is None else max(threshold, fit)
+        if threshold is not None:
+            for k in keep:
+                keep[k] &= scores[k] >= threshold
+
+        removed = {}
+        for k in keep:
+            self._ngram_stores[k] = self._ngram_stores[k].pruned(keep[k])
+            removed[k] = int(len(keep[k]) - keep[k].sum())
+        self._stub_cache.clear()
+        self._backoff = None
+        return removed
+
+
+    def _contributions(self, ngrams):
+        # Score of each k-gram in ngrams (order: list as from all_ngrams),
+        # its count times the log ratio of the interpolated weight of the
+        # last word after the whole stub with and without the k-gram's own
+        # order. A k-gram whose order adds little over the lower orders, or
+        # that is rarely seen, scores low.
+        unigrams = self._ngram_stores[1].all_ngrams()
+        total = sum(freq for _, freq in unigrams)
+        lower = {tuple(ngram): self._lambda[0] + self._lambda[1] * freq / total for ngram, freq in unigrams}
+        scores = {}
+        for k in ngrams:
+            totals = {}
+            for ngram, freq in ngrams[k]:
+                stub = tuple(ngram[:-1])
+                totals[stub] = totals.get(stub, 0) + freq
+            weights = {}
+            scores[k] = np.empty(len(ngrams[k]))
+            for i, (ngram, freq) in enumerate(ngrams[k]):
+                key = tuple(ngram)
+                low = lower.get(key[1:], self._lambda[0])
+                weight = low + self._lambda[k] * freq / totals[key[:-1]]
+                weights[key] = weight
+                scores[k][i] = freq * np.log(weight / low)
+            lower = weights
+        return scores
+
+
+    def _fit_threshold(self, ngrams, scores, keep, max_bytes):
+        # Smallest threshold on the scores for which the model fits in
+        # max_bytes, found by bisection over the scores that are left.
+        rows = {}
+        for k, kgrams in ngrams.items():
+            stubs = {}
+            rows[k] = np.fromiter((stubs.setdefault(tuple(ngram[:-1]), len(stubs)) for ngram, _ in kgrams), dtype=np.int64, count=len(kgrams))
+        fixed = self.nbytes()
+        bits = {k: _count_bits(self._ngram_stores[k]) for k in ngrams}
+        for k in ngrams:
+            fixed -= _store_nbytes(k, self._ngram_stores[k].num_contexts(), len(self._ngram_stores[k]), bits[k])
+
+        def size(threshold):
+            total = fixed
+            for k in ngrams:
+                kept = keep[k] & (scores[k] >= threshold)
+                contexts = np.count_nonzero(np.bincount(rows[k][kept]))
+                total += _store_nbytes(k, contexts, int(kept.sum()), bits[k])
+            return total
+
+        candidates = np.unique(np.concatenate([scores[k][keep[k]] for k in ngrams] + [[-np.inf]]))
+        if size(candidates[0]) <= max_bytes:
+            return candidates[0]
+        lo, hi = 0, len(candidates)
+        while lo + 1 < hi:
+            mid = (lo + hi) // 2
+            if size(candidates[mid]) <= max_bytes:
+                hi = mid
+            else:
+                lo = mid
+        if hi == len(candidates):
+            return np.inf
+        return candidates[hi]
+
+
+    def set_scoring(self, scoring):
+        if scoring not in SCORINGS:
+            raise ValueError(f'Expected scoring to be one of {SCORINGS}, got {scoring}')
+        if scoring != self._scoring:
+            self._scoring = scoring
+            self._backoff = None
+
+
+    def _backoff_tables(self):
+        # For each order k: the CountStats of its counts, which give its
+        # discount, and for 'kneser-ney' below the top order the
+        # continuation counts of its k-grams as a store, with their
+        # CountStats, or None. The probabilities are worked out from the
+        # counts of each context as it is scored, see _discounted. Made once,
+        # then kept up to date by add_ngram.
+        if self._backoff is not None:
+            return self._backoff
+        stores = {}
+        for k, store in self._ngram_stores.items():
+            if not isinstance(store, FrozenNGramStore):
+                store = FrozenNGramStore.from_store(store)
+            stores[k] = store
+
+        self._backoff = {}
+        for k, (stats, continuations, continuation_stats) in _backoff_counts(stores, self._scoring == 'kneser-ney').items():
+            if continuations is not None:
+                store = stores[k]
+                continuations = OverlayNGramStore(FrozenNGramStore(k, store._contexts, store._offsets, store._successors, continuations))
+            self._backoff[k] = (stats, continuations, continuation_stats)
+        return self._backoff
+
+
+    def _counted(self, ngram, old, freq):
+        # Keeps the backoff tables up to date with freq more of ngram, whose
+        # count was old. A new k-gram is one more continuation of its suffix.
+        n = len(ngram)
+        self._backoff[n][0].update(old, old + freq)
+        if old == 0 and n > 1 and self._backoff[n-1][1] is not None:
+            _, continuations, continuation_stats = self._backoff[n-1]
+            seen = continuations.freq(ngram[1:])
+            continuations.add_ngram(ngram[1:])
+            continuation_stats.update(seen, seen + 1)
+
+
+    def _discounted(self, counts, total, stats):
+        # Probabilities from the counts of one context row, whose total count
+        # is total, and the backoff weight of the row. stats are the
+        # CountStats of the order the counts belong to.
+        if self._scoring == 'stupid-backoff':
+            return counts / max(total, 1), STUPID_BACKOFF_WEIGHT
+        # Absolute discounting, the mass taken off is what is left for
+        # backing off.
+        probs = np.maximum(counts - stats.discount(), 0) / max(total, 1)
+        return probs, max(1.0 - probs.sum(), 0.0)
+
+
+    def observe(self, context, word):
+        # Learns word after context the way completions sees the context,
+        # as a user accepting a suggestion. Frozen stores get an overlay to
+        # take the new counts. Only the cache and table entries the update
+        # touches change, see add_ngram. With a log open the sample is also
+        # appended to it.
+        if self._n == 1:
+            ids = []
+        else:
+            ids = self.transform_input(context)[-(self._n - 1):]
+        self.add_word(word)
+        ngram = ids + [self._w2i[word]]
+        for k in range(1, self._n + 1):
+            if isinstance(self._ngram_stores[k], FrozenNGramStore):
+                self._ngram_stores[k] = OverlayNGramStore(self._ngram_stores[k])
+            self.add_ngram(ngram[-k:])
+        if self._log is not None:
+            self._log_writer.writerow([DataSource.clean(context), word])
+            self._log.flush()
+            self._log_size += 1
+
+
+    def open_log(self, path):
+        # Replays the samples in the log at path, then appends every
+        # observed sample to it until compact. The log is a CSV file of
+        # context and word rows.
+        self.close_log()
+        replayed = 0
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                for context, word in csv.reader(f):
+                    self.observe(context, word)
+                    replayed += 1
+        self._log = open(path, 'a', encoding='utf-8', newline='')
+        self._log_writer = csv.writer(self._log)
+        self._log_size = replayed
+
+
+    def close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+            self._log_writer = None
+
+
+    def log_size(self):
+        return self._log_size
+
+
+    def compact(self, path):
+        # Saves the model to path, in the format already there, and empties
+        # the log. The file is replaced at once, so a crash leaves either
+        # the old model with the full log or the new one.
+        binary = os.path.isfile(path) and NGramModel.is_binary(path)
+        self.save(path, binary=binary)
+        if self._log is not None:
+            self._log.seek(0)
+            self._log.truncate()
+            self._log_size = 0
+
+
+    def stub_cache_info(self):
+        return self._stub_cache.info()
+
+
     def add_ngram(self, ngram, freq=1):
         n = len(ngram)
         if n > self._n or n <= 0:
             raise ValueError(f'Expected 0<N<={self._n} for NGram, got {n}-gram')
         
-        self._ngram_stores[n].add_ngram(ngram, freq)
+        store = self._ngram_stores[n]
+        if self._backoff is not None:
+            old = store.freq(ngram)
+        store.add_ngram(ngram, freq)
+        # Caches and tables are updated rather than dropped, so learning one
+        # more k-gram costs about as much at every order.
+        if self._stub_cache:
+            self._stub_cache.add(ngram[:-1], ngram[-1], freq)
+        if n == 1 and self._ranking is not None:
+            self._ranking.add(ngram[0], freq)
+        if self._backoff is not None:
+            self._counted(ngram, old, freq)
 
 
     def add_word(self, word, n=1):
-        if word not in self._w2i:
+        new = word not in self._w2i
+        if new:
             idx = len(self._i2w)
             self._w2i[word] = idx
             self._i2w.append(word)
         if word not in self._SPECIAL_WORDS:
             self._trie.add_word(word, n)
+            if new and n > 0 and self._ranking is not None:
+                self._ranking.insert(word, self._w2i[word])
+            if self._candidate_cache:
+                self._recount_candidates(word, n, new)
 
 
-    def completions(self, context, keystrokes, n=1, deterministic=True):
-        context = self.transform_input(context) 
-        if self._n == 1:
-            context = []
-        elif len(context) > self._n - 1:
-            context = context[-(self._n - 1):]
+    def _recount_candidates(self, word, n, new):
+        # Only lookups for prefixes of word can have changed, but typo
+        # tolerant ones may have matched it from anywhere. A known word only
+        # changes its count, which can reorder top_k lookups. The others
+        # just get a new total.
+        for key in list(self._candidate_cache):
+            prefix, max_candidates, max_edits = key
+            if max_edits > 0 or word.startswith(prefix) and (new or max_candidates is not None):
+                del self._candidate_cache[key]
+            elif word.startswith(prefix) and word != prefix:
+                tot, candidates, cand_ids, dists = self._candidate_cache[key]
+                self._candidate_cache[key] = (tot + n, candidates, cand_ids, dists)
+
+
+    def completions(self, context, keystrokes, n=1, deterministic=True, max_candidates=None, max_edits=0, edit_penalty=0.1):
+        context = self._context_ids(context)
+        if deterministic:
+            top = self._top_completions(context, keystrokes, n, max_candidates, max_edits)
+            if top is not None:
+                return top
 
-        tot, candidates, _ = self._trie.get_words(keystrokes)
+        tot, candidates, cand_ids, dists = self._candidates(keystrokes, max_candidates, max_edits)
         if n < 0:
             n = len(candidates) 
         else:
             n = min(n, len(candidates))
-        
-        freqs = {}
-        probs = {}
-        for k in range(len(context)+1):
-            freqs[k] = [0] * len(candidates)
-            probs[k] = [0] * len(candidates)
-            tot_freq = 0
-            if k == 0:
-                subctx = []
-            else:
-                subctx = context[-k:]
-            for i in range(len(candidates)):
-                cand = candidates[i]
-                idx = self._w2i[cand]
-                ngram = subctx + [idx]
-                freq = self.freq(ngram)
-                freqs[k][i] = freq
-                tot_freq += freq
-            for i in range(len(candidates)):
-                if tot_freq != 0:
-                    probs[k][i] = freqs[k][i] / tot_freq
-                else:
-                    probs[k][i] = 1 / len(candidates)
-
-        weights = [self._lambda[0]] * len(candidates)
-        total_weight = 0
-        for i in range(len(candidates)):
-            for k in range(len(context)+1):
-                weights[i] += self._lambda[k+1] * probs[k][i]
-            total_weight += weights[i]
-        
-        for i in range(len(candidates)):
-            weights[i] /= total_weight
-        
-        if tot <= 0:
+        if tot <= 0 or n == 0:
             return [], []
-        elif deterministic:
-            det = list(zip(weights, candidates))
-            det.sort(reverse=True)
-            probs, completions = list(zip(*det[:n]))
-            completions = list(completions)
-            probs = list(probs)
-            return completions, probs
+
+        if self._scoring == 'interpolate':
+            weights = self._interpolated(context, cand_ids)
+        else:
+            weights = self._backed_off(context, cand_ids)
+        weights = self._penalized(weights, dists, edit_penalty)
+
+        if deterministic:
+            return self._best(candidates, weights, n)
         else:
-            prob = np.array(weights)
             indices = np.random.choice(len(candidates),\
                     size=n,\
-                    p=prob,\
+                    p=weights,\
                     replace=False)
-            sampled = list(map(lambda i: (weights[i], candidates[i]), indices))
+            sampled = list(map(lambda i: (float(weights[i]), candidates[i]), indices))
             sampled.sort(reverse=True)
             probs, completions = list(zip(*sampled[:n]))
             completions = list(completions)
             probs = list(probs)
             return completions, probs
 
+
+    def _context_ids(self, context):
+        # The ids of the context completions scores with. The context stays
+        # the same while a word is typed, so its ids are kept until the
+        # context or the vocabulary changes.
+        key = (context, len(self._i2w))
+        if self._last_context[0] == key:
+            context = self._last_context[1]
+        else:
+            context = self.transform_input(context)
+            self._last_context = (key, context)
+        if self._n == 1:
+            context = []
+        elif len(context) > self._n - 1:
+            context = context[-(self._n - 1):]
+        if isinstance(self._ngram_stores, LazyStores) and self._scoring == 'interpolate':
+            # Until all orders are read, only those read so far are used.
+            # The backoff modes wait for all of them to make their tables.
+            context = context[len(context) - min(len(context), self._ngram_stores.loaded() - 1):]
+        return context
+
+
+    def _top_completions(self, context, keystrokes, n, max_candidates, max_edits):
+        # Deterministic completions of keystrokes from only the candidates
+        # that can be among the n best, see _top_interpolated, or None when
+        # all candidates have to be scored.
+        if not (n >= 0 and max_candidates is None and max_edits == 0 and self._scoring == 'interpolate'):
+            return None
+        ranking = self._prefix_ranking()
+        lo, hi = ranking.span(keystrokes)
+        if hi - lo < self._TOP_K_MIN_CANDIDATES or any(isinstance(self._ngram_stores[k], SketchNGramStore) for k in range(1, len(context)+2)):
+            return None
+        n = min(n, hi - lo)
+        if n == 0:
+            return [], []
+        cand_ids, weights, mass = self._top_interpolated(context, ranking, lo, hi, n)
+        candidates = [self._i2w[idx] for idx in cand_ids.tolist()]
+        # Each order's probabilities sum to its mass over all the
+        # candidates, scored or not.
+        weights /= (hi - lo) * self._lambda[0] + sum(weight * order_mass for weight, order_mass in zip(self._lambda[1:], mass))
+        return self._best(candidates, weights, n)
+
+
+    def _penalized(self, weights, dists, edit_penalty):
+        # weights normalized to sum to one, after corrected candidates count
+        # for less the further they are from what was actually typed.
+        if dists is not None:
+            weights *= edit_penalty ** np.array(dists, dtype=np.float64)
+        weights /= np.cumsum(weights)[-1]
+        return weights
+
+
+    def _best(self, candidates, weights, n):
+        if n < len(candidates):
+            # Everything tied with the n-th best weight is kept, so the
+            # sort below breaks ties by word as before.
+            top = np.argpartition(-weights, n - 1)[:n]
+            chosen = np.flatnonzero(weights >= weights[top].min())
+        else:
+            chosen = np.arange(len(candidates))
+        det = list(zip(weights[chosen].tolist(), [candidates[i] for i in chosen]))
+        det.sort(reverse=True)
+        probs, completions = list(zip(*det[:n]))
+        completions = list(completions)
+        probs = list(probs)
+        return completions, probs
+
+
+    def _prefix_ranking(self):
+        # Made once, then kept up to date by add_word and add_ngram.
+        if self._ranking is None:
+            _, words, trie_freqs = self._trie.get_words('')
+            ids = np.fromiter((self._w2i[word] for word in words), dtype=np.int64, count=len(words))
+            successors, counts, _ = self._stub_cache.get(self._ngram_stores[1], [])
+            self._ranking = PrefixRanking(words, ids, _gather(successors, counts, ids), len(self._i2w))
+        return self._ranking
+
+
+    def _top_interpolated(self, context, ranking, lo, hi, n):
+        # Ids and interpolated weights of the candidates of ranks lo..hi-1
+        # that can be among the n best, rather than of all of them. Only
+        # the successors of the context, at some order, are scored from the
+        # counts. All other candidates differ only in their unigram counts
+        # and their weight grows with it, so they are visited in order of
+        # their counts, best first, until one has scored below the n-th best
+        # weight so far and no later one can beat it. Candidates tied with
+        # the n-th best are all kept. Also gives what the probabilities of
+        # each order add up to over all the candidates, see
+        # _candidate_totals.
+        totals = np.zeros(len(context)+1, dtype=np.int64)
+        totals[0] = ranking.total(lo, hi)
+        mass = np.ones(len(context)+1)
+        seen = [np.zeros(0, dtype=np.int64)]
+        for k in range(1, len(context)+1):
+            successors, counts, total = self._stub_cache.get(self._ngram_stores[k+1], context[-k:])
+            inside = ranking.within(successors, lo, hi)
+            totals[k] = total if inside.all() else counts[inside].sum()
+            if totals[k] > 0:
+                mass[k] = counts[inside].sum() / totals[k]
+            seen.append(successors[inside])
+        cand_ids = [np.unique(np.concatenate(seen))]
+        weights = [self._interpolated(context, cand_ids[0], totals, hi - lo)]
+        scored = set(cand_ids[0].tolist())
+
+        # The rest are taken in blocks of growing size. They have no counts
+        # but unigram ones, which the ranking already has.
+        ranks = ranking.descending(lo, hi)
+        block_size = n
+        while True:
+            block = []
+            for rank in ranks:
+                if ranking.id(rank) not in scored:
+                    block.append(rank)
+                    if len(block) == block_size:
+                        break
+            if not block:
+                break
+            freqs = np.zeros((len(context)+1, len(block)), dtype=np.int64)
+            freqs[0] = ranking.counts(block)
+            cand_ids.append(ranking.ids(block))
+            weights.append(self._mixed(freqs, totals, hi - lo))
+            block_size *= 2
+            everything = np.concatenate(weights)
+            if len(everything) >= n and weights[-1][-1] < np.partition(everything, len(everything) - n)[len(everything) - n]:
+                break
+        return np.concatenate(cand_ids), np.concatenate(weights), mass
+
+
+    def completions_batch(self, contexts, keystrokes, n=1, max_candidates=None, max_edits=0, edit_penalty=0.1):
+        # Deterministic completions for each pair of contexts[i] and
+        # keystrokes[i], the same as completions gives. The pairs are
+        # grouped by context. Each context is turned into ids once, and the
+        # counts of the candidates of all its prefixes are looked up in one
+        # go, then each prefix is scored from its share of them. Repeated
+        # pairs are scored once.
+        groups = {}
+        for i, (context, prefix) in enumerate(zip(contexts, keystrokes)):
+            groups.setdefault(context, {}).setdefault(prefix, []).append(i)
+        results = [None] * len(contexts)
+        for context, prefixes in groups.items():
+            ids = self._context_ids(context)
+            scored = {}
+            for prefix in prefixes:
+                top = self._top_completions(ids, prefix, n, max_candidates, max_edits)
+                if top is not None:
+                    scored[prefix] = top
+            rest = [prefix for prefix in prefixes if prefix not in scored]
+            scored.update(zip(rest, self._scored_batch(ids, rest, n, max_candidates, max_edits, edit_penalty)))
+            for prefix, indices in prefixes.items():
+                completions, probs = scored[prefix]
+                for i in indices:
+                    results[i] = (list(completions), list(probs))
+        return results
+
+
+    def _scored_batch(self, context, prefixes, n, max_candidates, max_edits, edit_penalty):
+        # Deterministic completions of each of prefixes after the context
+        # ids, from the counts of all their candidates at once.
+        lookups = [self._candidates(prefix, max_candidates, max_edits) for prefix in prefixes]
+        if len(lookups) == 0:
+            return []
+        all_ids = np.unique(np.concatenate([cand_ids for _, _, cand_ids, _ in lookups]))
+        if self._scoring == 'interpolate':
+            freqs, rows = self._interpolation_counts(context, all_ids)
+        else:
+            # Backed off weights do not depend on the other candidates.
+            backed_off = self._backed_off(context, all_ids)
+        results = []
+        for tot, candidates, cand_ids, dists in lookups:
+            count = len(candidates) if n < 0 else min(n, len(candidates))
+            if tot <= 0 or count == 0:
+                results.append(([], []))
+                continue
+            columns = all_ids.searchsorted(cand_ids)
+            if self._scoring == 'interpolate':
+                weights = self._mixed(freqs[:, columns], self._candidate_totals(freqs[:, columns], rows))
+            else:
+                weights = backed_off[columns]
+            weights = self._penalized(weights, dists, edit_penalty)
+            results.append(self._best(candidates, weights, count))
+        return results
+
+
+    def _interpolated(self, context, cand_ids, totals=None, count=None):
+        freqs, rows = self._interpolation_counts(context, cand_ids)
+        if totals is None:
+            totals = self._candidate_totals(freqs, rows)
+        return self._mixed(freqs, totals, count)
+
+
+    def _interpolation_counts(self, context, cand_ids):
+        # One row of counts per context order, one column per candidate,
+        # and the total count and the number of successors of the context
+        # at each order. Sketches do not list successors, their number is
+        # given as -1.
+        freqs = np.empty((len(context)+1, len(cand_ids)), dtype=np.int64)
+        rows = np.zeros((2, len(context)+1), dtype=np.int64)
+        for k in range(len(context)+1):
+            if k == 0:
+                subctx = []
+            else:
+                subctx = context[-k:]
+            store = self._ngram_stores[k+1]
+            if isinstance(store, SketchNGramStore):
+                freqs[k] = store.counts(subctx, cand_ids)
+                rows[:, k] = freqs[k].sum(), -1
+            else:
+                successors, counts, total = self._stub_cache.get(store, subctx)
+                freqs[k] = _gather(successors, counts, cand_ids)
+                rows[:, k] = total, len(successors)
+        return freqs, rows
+
+
+    def _candidate_totals(self, freqs, rows):
+        # The total count of each order over the candidates, the columns of
+        # freqs. When they hold every successor of the context it is the
+        # context's total from rows, which QuantizedNGramStores keep exactly
+        # rather than as the sum of their dequantized counts.
+        totals, sizes = rows
+        return np.where(np.count_nonzero(freqs, axis=1) == sizes, totals, freqs.sum(axis=1))
+
+
+    def _mixed(self, freqs, totals, count=None):
+        # Interpolated weights from the counts of each order (rows) of each
+        # candidate (columns) and the total count of each order. count is
+        # the number of candidates when the columns are only some of them.
+        if count is None:
+            count = freqs.shape[1]
+        tot_freqs = np.asarray(totals).reshape(-1, 1)
+        probs = np.divide(freqs, tot_freqs, out=np.full(freqs.shape, 1 / count), where=tot_freqs != 0)
+
+        # Interpolation with self._lambda, accumulated one order at a time so
+        # the floating point operations match the scalar formula exactly.
+        weights = np.full(freqs.shape[1], self._lambda[0])
+        for k in range(len(freqs)):
+            weights += self._lambda[k+1] * probs[k]
+        return weights
+
+
+    def _backed_off(self, context, cand_ids):
+        # Each candidate gets its probability at the highest order whose
+        # context has seen it, times the backoff weights of the orders above
+        # that had data for the context. Only the successors listed for each
+        # context are visited, not every candidate at every order.
+        tables = self._backoff_tables()
+        slots = np.full(len(self._i2w), -1)
+        slots[cand_ids] = np.arange(len(cand_ids))
+        weights = np.zeros(len(cand_ids))
+        scored = np.zeros(len(cand_ids), dtype=bool)
+        factor = 1.0
+        backed_off = False
+        for k in range(len(context)+1, 0, -1):
+            stats, continuations, continuation_stats = tables[k]
+            stub = context[len(context)-k+1:]
+            if backed_off and continuations is not None and continuation_stats.total > 0:
+                successors, counts = continuations.successor_table(stub)
+                total = int(counts.sum())
+                stats = continuation_stats
+            else:
+                successors, counts, total = self._stub_cache.get(self._ngram_stores[k], stub)
+            if len(successors) == 0:
+                continue
+            probs, weight = self._discounted(counts, total, stats)
+            backed_off = True
+            found = slots[successors]
+            new = (found >= 0) & (probs > 0)
+            new[new] = ~scored[found[new]]
+            weights[found[new]] = factor * probs[new]
+            scored[found[new]] = True
+            factor *= weight
+        weights[~scored] = factor / len(self._i2w)
+        return weights
+
+
+    def _candidates(self, keystrokes, max_candidates=None, max_edits=0):
+        # Trie lookup for completions, remembered until the trie changes.
+        # While a word is being typed the same prefixes come up again, and
+        # the empty prefix (the whole vocabulary) after every space.
+        key = (keystrokes, max_candidates, max_edits)
+        if key in self._candidate_cache:
+            return self._candidate_cache[key]
+
+        dists = None
+        if max_edits > 0:
+            tot, candidates, cand_freqs, dists = self._trie.get_words_fuzzy(keystrokes, max_edits)
+            if max_candidates is not None:
+                ranked = sorted(zip(dists, [-f for f in cand_freqs], candidates))[:max_candidates]
+                dists = [d for d, _, _ in ranked]
+                candidates = [c for _, _, c in ranked]
+        elif max_candidates is None:
+            tot, candidates, _ = self._trie.get_words(keystrokes)
+        else:
+            tot, candidates, _ = self._trie.top_k(keystrokes, max_candidates)
+        cand_ids = np.fromiter((self._w2i[cand] for cand in candidates), dtype=np.int64, count=len(candidates))
+
+        if len(self._candidate_cache) >= self._CANDIDATE_CACHE_SIZE:
+            del self._candidate_cache[next(iter(self._candidate_cache))]
+        self._candidate_cache[key] = (tot, candidates, cand_ids, dists)
+        return self._candidate_cache[key]
+
         
     def transform_input(self, phrase):
         phrase = DataSource.clean(phrase)
@@ -202,6 +1254,313 @@ class NGramModel:
         return indices
     
 
+class StubCache:
+    # LRU cache of successor tables, keyed by the context ids as a tuple. The
+    # key length tells which order a table belongs to, so one cache serves
+    # all the stores of a model. Each entry is (successor ids, counts, total).
+    def __init__(self, maxsize=1024):
+        self._maxsize = maxsize
+        self._tables = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self._tables)
+
+
+    def get(self, store, stubgram):
+        key = tuple(stubgram)
+        table = self._tables.get(key)
+        if table is not None:
+            self.hits += 1
+            self._tables.move_to_end(key)
+            return table
+
+        self.misses += 1
+        successors, counts = store.successor_table(stubgram)
+        table = (successors, counts, _stub_total(store, stubgram, counts))
+        if self._maxsize > 0:
+            self._tables[key] = table
+            if len(self._tables) > self._maxsize:
+                self._tables.popitem(last=False)
+        return table
+
+
+    def add(self, stubgram, successor, freq):
+        # Updates the cached table of stubgram, if any, for freq more of
+        # successor after it. Counts are changed in place once the table
+        # owns them, not a view into a frozen store.
+        key = tuple(stubgram)
+        table = self._tables.get(key)
+        if table is None:
+            return
+        successors, counts, total = table
+        i = successors.searchsorted(successor)
+        if i < len(successors) and successors[i] == successor:
+            if not counts.flags.owndata:
+                counts = counts.copy()
+            counts[i] += freq
+        else:
+            successors = np.insert(successors, i, successor)
+            counts = np.insert(counts, i, freq)
+        self._tables[key] = (successors, counts, total + freq)
+
+
+    def clear(self):
+        self._tables.clear()
+
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._tables), 'maxsize': self._maxsize}
+
+
+class CountStats:
+    # How many k-grams of one order are counted once and twice, which give
+    # the discount of absolute discounting, and the sum of their counts.
+    # Kept up to date one count change at a time.
+    def __init__(self, ones=0, twos=0, total=0):
+        self.ones = ones
+        self.twos = twos
+        self.total = total
+
+
+    @staticmethod
+    def from_counts(counts):
+        return CountStats(int(np.count_nonzero(counts == 1)), int(np.count_nonzero(counts == 2)), int(counts.sum()))
+
+
+    def update(self, old, new):
+        # One k-gram's count went from old to new.
+        self.ones += (new == 1) - (old == 1)
+        self.twos += (new == 2) - (old == 2)
+        self.total += new - old
+
+
+    def discount(self):
+        # D = n1 / (n1 + 2 n2).
+        if self.ones + self.twos > 0:
+            return self.ones / (self.ones + 2 * self.twos)
+        return 0.75
+
+
+    def header(self):
+        return [self.ones, self.twos, self.total]
+
+
+class LazyStores(dict):
+    # The stores of a text model loaded with lazy=True, as a dict from order
+    # to store. Orders 2 and up are read by a background thread, lowest
+    # first, and looking one up waits until it is read. With the offsets of
+    # the sections known from an earlier load (the sidecar path.sections),
+    # an order looked up ahead of the thread is read right away instead.
+    # Going over all the stores waits for all of them.
+    def __init__(self, path, start, stores, frozen):
+        super().__init__({1: stores[1]})
+        self._path = path
+        self._frozen = frozen
+        self._empty = {k: store for k, store in stores.items() if k > 1}
+        self._locks = {k: threading.Lock() for k in self._empty}
+        self._read = {k: threading.Event() for k in self._empty}
+        self._stat = os.stat(path)
+        self._offsets = self._saved_offsets() or {2: start}
+        self._sidecar_valid = len(self._offsets) > 1
+        self._loaded = 1
+        self._thread = threading.Thread(target=self._read_all, daemon=True)
+        self._thread.start()
+
+
+    def _saved_offsets(self):
+        try:
+            with open(f'{self._path}.sections', 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get('size') != self._stat.st_size or saved.get('mtime_ns') != self._stat.st_mtime_ns:
+            return None
+        return {int(k): offset for k, offset in saved['offsets'].items()}
+
+
+    def _read_order(self, k):
+        with self._locks[k]:
+            if self._read[k].is_set():
+                return
+            with open(self._path, 'rb') as f:
+                f.seek(self._offsets[k])
+                kgrams = _read_section(f, k)
+                self._offsets[k + 1] = f.tell()
+            dict.__setitem__(self, k, _filled(self._empty.pop(k), kgrams, self._frozen))
+            self._read[k].set()
+
+
+    def _read_all(self):
+        for k in sorted(self._read):
+            self._read_order(k)
+        if not self._sidecar_valid:
+            saved = {'size': self._stat.st_size, 'mtime_ns': self._stat.st_mtime_ns, 'offsets': self._offsets}
+            try:
+                with open(f'{self._path}.sections', 'w', encoding='utf-8') as f:
+                    json.dump(saved, f)
+            except OSError:
+                pass
+
+
+    def loaded(self):
+        # The highest order k for which orders 1 to k are all read.
+        while self._loaded < len(self._read) + 1 and self._read[self._loaded + 1].is_set():
+            self._loaded += 1
+        return self._loaded
+
+
+    def wait(self):
+        for k in self._read:
+            self[k]
+
+
+    def __missing__(self, k):
+        if k not in self._read:
+            raise KeyError(k)
+        if k in self._offsets:
+            self._read_order(k)
+        self._read[k].wait()
+        return dict.__getitem__(self, k)
+
+
+    def get(self, k, default=None):
+        self.wait()
+        return dict.get(self, k, default)
+
+
+    def keys(self):
+        self.wait()
+        return dict.keys(self)
+
+
+    def values(self):
+        self.wait()
+        return dict.values(self)
+
+
+    def items(self):
+        self.wait()
+        return dict.items(self)
+
+
+    def __iter__(self):
+        self.wait()
+        return dict.__iter__(self)
+
+
+    def __contains__(self, k):
+        return k == 1 or k in self._read
+
+
+    def __len__(self):
+        return len(self._read) + 1
+
+
+class PrefixRanking:
+    # The vocabulary sorted by word, so the words with a given prefix are
+    # the ranks in one range, with a sparse table over their unigram counts
+    # for the position of the largest count in any range.
+    def __init__(self, words, ids, counts, vocab_size):
+        order = sorted(range(len(words)), key=words.__getitem__)
+        self._words = [words[i] for i in order]
+        self._ids = ids[order]
+        self._ranks = np.full(vocab_size, -1, dtype=np.int64)
+        self._ranks[self._ids] = np.arange(len(order))
+        self._counts = np.asarray(counts, dtype=np.int64)[order]
+        self._totals = np.concatenate([[0], np.cumsum(self._counts)])
+        self._build_table()
+
+
+    def _build_table(self):
+        # _table[j][i] is the rank of the largest count in i..i+2**j-1, the
+        # first one of them if there are several.
+        self._table = [np.arange(len(self._counts))]
+        width = 1
+        while 2 * width <= len(self._counts):
+            prev = self._table[-1]
+            left, right = prev[:len(prev) - width], prev[width:]
+            self._table.append(np.where(self._counts[left] >= self._counts[right], left, right))
+            width *= 2
+
+
+    def add(self, idx, freq):
+        # freq more of the word with id idx, if it is ranked. Only the
+        # ranges that hold it can get it as their largest count.
+        if idx >= len(self._ranks) or self._ranks[idx] < 0:
+            return
+        rank = self._ranks[idx]
+        self._counts[rank] += freq
+        self._totals[rank + 1:] += freq
+        for j in range(1, len(self._table)):
+            best = self._table[j][max(0, rank - (1 << j) + 1):rank + 1]
+            best[(self._counts[best] < self._counts[rank]) | ((self._counts[best] == self._counts[rank]) & (best > rank))] = rank
+
+
+    def insert(self, word, idx):
+        # A new word with id idx and a count of 0. The ranks after it move
+        # up by one.
+        rank = bisect_left(self._words, word)
+        self._words.insert(rank, word)
+        self._ids = np.insert(self._ids, rank, idx)
+        if idx >= len(self._ranks):
+            self._ranks = np.concatenate([self._ranks, np.full(idx + 1 - len(self._ranks), -1, dtype=np.int64)])
+        self._ranks[self._ids] = np.arange(len(self._ids))
+        self._counts = np.insert(self._counts, rank, 0)
+        self._totals = np.insert(self._totals, rank + 1, self._totals[rank])
+        self._build_table()
+
+
+    def span(self, prefix):
+        # Ranks lo..hi-1 are the words starting with prefix, other than
+        # prefix itself, the same words as the trie's get_words.
+        if prefix == '':
+            return 0, len(self._words)
+        lo = bisect_right(self._words, prefix)
+        return lo, bisect_left(self._words, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo)
+
+
+    def within(self, ids, lo, hi):
+        ranks = self._ranks[ids]
+        return (ranks >= lo) & (ranks < hi)
+
+
+    def id(self, rank):
+        return int(self._ids[rank])
+
+
+    def ids(self, ranks):
+        return self._ids[ranks]
+
+
+    def counts(self, ranks):
+        return self._counts[ranks]
+
+
+    def total(self, lo, hi):
+        return int(self._totals[hi] - self._totals[lo])
+
+
+    def _argmax(self, lo, hi):
+        j = (hi - lo).bit_length() - 1
+        left, right = self._table[j][lo], self._table[j][hi - (1 << j)]
+        return int(left if self._counts[left] >= self._counts[right] else right)
+
+
+    def descending(self, lo, hi):
+        # Ranks lo..hi-1 in order of descending count.
+        heap = [(-self._counts[self._argmax(lo, hi)], lo, hi)] if lo < hi else []
+        while heap:
+            _, lo, hi = heappop(heap)
+            best = self._argmax(lo, hi)
+            yield best
+            for a, b in [(lo, best), (best + 1, hi)]:
+                if a < b:
+                    heappush(heap, (-self._counts[self._argmax(a, b)], a, b))
+
+
 class NGramStore:
     def __init__(self, n):
         if n <= 0:
@@ -223,8 +1582,18 @@ class NGramStore:
         unigrams[uni] += freq
 
 
+    def add_successors(self, stubgram, successors):
+        # add_ngram for each (last, freq) in successors after stubgram.
+        if len(stubgram) != self._n - 1:
+            m = len(stubgram)
+            raise ValueError(f'Expected {self._n - 1}-gram as stub, got {m}-gram')
+        unigrams = self._stub_dict(stubgram)
+        for uni, freq in successors:
+            unigrams[uni] = unigrams.get(uni, 0) + freq
+
+
     def _stub_dict(self, stubgram, create=True):
-        idx = str(stubgram)
+        idx = tuple(stubgram)
         if idx not in self._root:
             if create:
                 self._root[idx] = {}
@@ -238,7 +1607,7 @@ class NGramStore:
             m = len(stubgram)
             raise ValueError(f'Expected {self._n - 1}-gram as stub, got {m}-gram')
 
-        unigrams = self._stub_dict(stubgram)
+        unigrams = self._stub_dict(stubgram, create=False)
         if unigrams is None:
             return []
         return unigrams.items()
@@ -248,20 +1617,410 @@ class NGramStore:
         if len(ngram) != self._n:
             m = len(ngram)
             raise ValueError(f'Expected {self._n}-gram, got {m}-gram')
-        unigrams = self._stub_dict(ngram[:-1])
-        uni = ngram[-1]
-        if uni in unigrams:
-            return unigrams[ngram[-1]]
-        else:
+        unigrams = self._stub_dict(ngram[:-1], create=False)
+        if unigrams is None:
             return 0
+        return unigrams.get(ngram[-1], 0)
+
+
+    def successor_table(self, stubgram):
+        # Successor ids of stubgram as a sorted array, with their counts.
+        unigrams = self._stub_dict(stubgram, create=False)
+        if not unigrams:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        keys = np.fromiter(unigrams.keys(), dtype=np.int64, count=len(unigrams))
+        values = np.fromiter(unigrams.values(), dtype=np.int64, count=len(unigrams))
+        order = keys.argsort()
+        return keys[order], values[order]
+
+
+    def counts(self, stubgram, ids):
+        # Vectorized freq for every successor id in ids after stubgram.
+        return _gather(*self.successor_table(stubgram), ids)
+
+
+    def __len__(self):
+        return sum(len(unigrams) for unigrams in self._root.values())
+
+
+    def num_contexts(self):
+        return len(self._root)
+
+
+    def pruned(self, keep):
+        # A new store with the k-grams of all_ngrams() where keep is true.
+        store = NGramStore(self._n)
+        keep = iter(keep)
+        for stub, unigrams in self._root.items():
+            kept = {uni: freq for uni, freq in unigrams.items() if next(keep)}
+            if kept:
+                store._root[stub] = kept
+        return store
+
+
+    def all_ngrams(self):
+        ngrams = []
+        for stub, unigrams in self._root.items():
+            for last, freq in unigrams.items():
+                ngrams.append((list(stub) + [last], freq))
+        return ngrams
+
+
+class FrozenNGramStore:
+    # Read-only counterpart of NGramStore in a CSR-like layout. The distinct
+    # contexts are sorted lexicographically and stored column by column in
+    # contexts, shape (n-1, C). The successors of context row r are
+    # successors[offsets[r]:offsets[r+1]], sorted by id, with their counts at
+    # the same positions in counts.
+    def __init__(self, n, contexts, offsets, successors, counts):
+        if n <= 0:
+            raise ValueError(f'Expected N>=1 for FrozenNGramStore, got {n}')
+        self._n = n
+        self._contexts = contexts
+        self._offsets = offsets
+        self._successors = successors
+        self._counts = counts
+
+
+    @staticmethod
+    def from_store(store):
+        if isinstance(store, OverlayNGramStore):
+            # Only the k-grams added to the overlay are listed, the frozen
+            # ones are taken as they are.
+            delta = FrozenNGramStore.from_ngrams(store._n, store._delta.all_ngrams())
+            grams = np.hstack([_ngram_matrix(store._base), _ngram_matrix(delta)]).T
+            return FrozenNGramStore.from_arrays(store._n, grams, np.concatenate([store._base._counts, delta._counts]))
+        return FrozenNGramStore.from_ngrams(store._n, store.all_ngrams())
+
+
+    @staticmethod
+    def from_ngrams(n, ngrams):
+        # ngrams: iterable of (ngram, freq) pairs, duplicates are summed.
+        grams = []
+        freqs = []
+        for ngram, freq in ngrams:
+            grams.append(ngram)
+            freqs.append(freq)
+        return FrozenNGramStore.from_arrays(n, grams, freqs)
+
+
+    @staticmethod
+    def from_arrays(n, grams, freqs):
+        # grams: (N, n) array of k-grams, freqs their N counts, duplicates
+        # are summed.
+        grams = np.array(grams, dtype=np.int32).reshape(-1, n)
+        freqs = np.array(freqs, dtype=np.int64)
+
+        order = np.lexsort(grams.T[::-1])
+        grams = grams[order]
+        freqs = freqs[order]
+        if len(grams) > 0:
+            first = np.ones(len(grams), dtype=bool)
+            first[1:] = np.any(grams[1:] != grams[:-1], axis=1)
+            starts = np.flatnonzero(first)
+            freqs = np.add.reduceat(freqs, starts)
+            grams = grams[starts]
+
+        stubs = grams[:, :-1]
+        new_row = np.ones(len(grams), dtype=bool)
+        new_row[1:] = np.any(stubs[1:] != stubs[:-1], axis=1)
+        rows = np.flatnonzero(new_row)
+        contexts = np.ascontiguousarray(stubs[rows].T)
+        offsets = np.append(rows, len(grams)).astype(np.int64)
+        successors = np.ascontiguousarray(grams[:, -1])
+        return FrozenNGramStore(n, contexts, offsets, successors, freqs)
+
+
+    def add_ngram(self, ngram, freq=1):
+        raise ValueError(f'Cannot add to a frozen {self._n}-gram store')
+
+
+    def add_successors(self, stubgram, successors):
+        raise ValueError(f'Cannot add to a frozen {self._n}-gram store')
+
+
+    def _row(self, stubgram):
+        lo = 0
+        hi = len(self._offsets) - 1
+        for column, idx in zip(self._contexts, stubgram):
+            # Rows lo..hi agree on the earlier columns, so this one is sorted.
+            span = column[lo:hi]
+            lo, hi = lo + span.searchsorted(idx, 'left'), lo + span.searchsorted(idx, 'right')
+        if lo >= hi:
+            return None
+        return lo
+
+
+    def _span(self, stubgram):
+        row = self._row(stubgram)
+        if row is None:
+            return 0, 0
+        return self._offsets[row], self._offsets[row + 1]
+
+
+    def unigrams(self, stubgram):
+        if len(stubgram) != self._n - 1:
+            m = len(stubgram)
+            raise ValueError(f'Expected {self._n - 1}-gram as stub, got {m}-gram')
+
+        successors, counts = self.successor_table(stubgram)
+        return list(zip(successors.tolist(), counts.tolist()))
+
+
+    def freq(self, ngram):
+        if len(ngram) != self._n:
+            m = len(ngram)
+            raise ValueError(f'Expected {self._n}-gram, got {m}-gram')
+        successors, counts = self.successor_table(ngram[:-1])
+        i = successors.searchsorted(ngram[-1])
+        if i < len(successors) and successors[i] == ngram[-1]:
+            return int(counts[i])
+        return 0
+
+
+    def successor_table(self, stubgram):
+        start, end = self._span(stubgram)
+        return self._successors[start:end], self._counts[start:end]
+
+
+    def counts(self, stubgram, ids):
+        return _gather(*self.successor_table(stubgram), ids)
+
+
+    def __len__(self):
+        return len(self._successors)
+
+
+    def num_contexts(self):
+        return len(self._offsets) - 1
+
+
+    def pruned(self, keep):
+        # A new store with the k-grams of all_ngrams() where keep is true.
+        keep = np.asarray(keep, dtype=bool)
+        rows = np.repeat(np.arange(len(self._offsets) - 1), np.diff(self._offsets))[keep]
+        new_row = np.ones(len(rows), dtype=bool)
+        new_row[1:] = rows[1:] != rows[:-1]
+        starts = np.flatnonzero(new_row)
+        contexts = np.ascontiguousarray(self._contexts[:, rows[starts]])
+        offsets = np.append(starts, len(rows)).astype(np.int64)
+        return FrozenNGramStore(self._n, contexts, offsets, self._successors[keep], self._counts[keep])
 
 
     def all_ngrams(self):
         ngrams = []
-        for stub in self._root:
-            stub_list = stub.strip('[]').split(', ')
-            for last in self._root[stub]:
-                ngrams.append((stub_list + [last], self._root[stub][last]))
+        counts = self._counts
+        for row in range(len(self._offsets) - 1):
+            stub = self._contexts[:, row].tolist()
+            for i in range(self._offsets[row], self._offsets[row + 1]):
+                ngrams.append((stub + [int(self._successors[i])], int(counts[i])))
         return ngrams
 
 
+class QuantizedNGramStore(FrozenNGramStore):
+    # FrozenNGramStore with each count kept as an 8 or 16 bit code, its
+    # index in levels (see _log_levels). Counts are exact as long as the
+    # levels are still every integer, and off by at most half a level step
+    # above that. The total count of each context row is kept exactly in
+    # totals, in row order.
+    def __init__(self, n, contexts, offsets, successors, codes, levels, totals):
+        if n <= 0:
+            raise ValueError(f'Expected N>=1 for QuantizedNGramStore, got {n}')
+        self._n = n
+        self._contexts = contexts
+        self._offsets = offsets
+        self._successors = successors
+        self._codes = codes
+        self._levels = levels
+        self._totals = totals
+
+
+    @staticmethod
+    def from_store(store, bits=8):
+        if bits not in COUNT_BITS:
+            raise ValueError(f'Expected bits to be one of {COUNT_BITS}, got {bits}')
+        if not isinstance(store, FrozenNGramStore):
+            store = FrozenNGramStore.from_store(store)
+        counts = store._counts
+        if isinstance(store, QuantizedNGramStore):
+            totals = store._totals
+        else:
+            totals = _row_totals(store._offsets, counts)
+        levels = _log_levels(int(counts.max()) if len(counts) > 0 else 1, bits)
+        return QuantizedNGramStore(store._n, store._contexts, store._offsets, store._successors, _quantized(counts, levels, bits), levels, totals)
+
+
+    @property
+    def _counts(self):
+        return self._levels[self._codes]
+
+
+    def successor_table(self, stubgram):
+        start, end = self._span(stubgram)
+        return self._successors[start:end], self._levels[self._codes[start:end]]
+
+
+    def pruned(self, keep):
+        # The rows left keep their totals from before pruning, the mass of
+        # the removed k-grams goes to backing off.
+        keep = np.asarray(keep, dtype=bool)
+        store = FrozenNGramStore.pruned(self, keep)
+        rows = np.unique(np.repeat(np.arange(len(self._offsets) - 1), np.diff(self._offsets))[keep])
+        return QuantizedNGramStore(self._n, store._contexts, store._offsets, store._successors, self._codes[keep], self._levels, self._totals[rows])
+
+
+class SketchNGramStore:
+    # Approximate NGramStore in fixed memory, a count-min sketch of depth
+    # rows of width counters. A k-gram adds its count to one counter in each
+    # row, picked by a hash of its ids with a different seed per row, and its
+    # count is read back as the smallest of those counters. Collisions can
+    # only make counts larger than they are. Each stub is also counted, under
+    # an id no word has, so lookups after a stub never seen give 0 rather
+    # than whatever collides, and no count is more than its stub's. The
+    # k-grams themselves are not kept, so they cannot be listed or saved in
+    # the text format.
+    def __init__(self, n, width=2**16, depth=4, counters=None):
+        if n <= 0:
+            raise ValueError(f'Expected N>=1 for SketchNGramStore, got {n}')
+        self._n = n
+        if counters is None:
+            counters = np.zeros((depth, width), dtype=np.int32)
+        self._counters = counters
+        depth, width = counters.shape
+        self._width = np.uint64(width)
+        self._rows = np.arange(depth)[:, np.newaxis]
+        self._seeds = _mix(np.arange(1, depth + 1, dtype=np.uint64) * np.uint64(0x9e3779b97f4a7c15))[:, np.newaxis]
+
+
+    def _hash(self, state, ids):
+        # Ids are shifted by one so that -1, the stub total, hashes as 0.
+        return _mix(state ^ (np.asarray(ids, dtype=np.int64).astype(np.uint64) + np.uint64(1)))
+
+
+    def _state(self, stubs):
+        # Hash state after the ids of each stub in stubs, shape (N, k-1).
+        state = self._seeds
+        for column in stubs.T:
+            state = self._hash(state, column)
+        return state
+
+
+    def _column(self, state, ids):
+        return (self._hash(state, ids) % self._width).astype(np.intp)
+
+
+    def add_ngram(self, ngram, freq=1):
+        if len(ngram) != self._n:
+            m = len(ngram)
+            raise ValueError(f'Expected {self._n}-gram, got {m}-gram')
+        self.add_ngrams([ngram], [freq])
+
+
+    def add_ngrams(self, grams, freqs):
+        if not self._counters.flags.writeable:
+            # Mapped from a binary model, counting starts on a copy.
+            self._counters = self._counters.copy()
+        grams = np.asarray(grams, dtype=np.int64).reshape(-1, self._n)
+        freqs = np.asarray(freqs, dtype=self._counters.dtype)
+        state = self._state(grams[:, :-1])
+        np.add.at(self._counters, (self._rows, self._column(state, grams[:, -1])), freqs)
+        np.add.at(self._counters, (self._rows, self._column(state, np.full(len(grams), -1))), freqs)
+
+
+    def add_successors(self, stubgram, successors):
+        successors = list(successors)
+        self.add_ngrams([list(stubgram) + [uni] for uni, _ in successors], [freq for _, freq in successors])
+
+
+    def freq(self, ngram):
+        if len(ngram) != self._n:
+            m = len(ngram)
+            raise ValueError(f'Expected {self._n}-gram, got {m}-gram')
+        return int(self.counts(ngram[:-1], [ngram[-1]])[0])
+
+
+    def counts(self, stubgram, ids):
+        # The stub is hashed once and only the last step is done per id.
+        state = self._state(np.array([stubgram], dtype=np.int64).reshape(1, -1))
+        total = self._counters[self._rows, self._column(state, [-1])].min()
+        if total == 0:
+            return np.zeros(len(ids), dtype=np.int64)
+        counts = self._counters[self._rows, self._column(state, ids)].min(axis=0)
+        return np.minimum(counts, total).astype(np.int64)
+
+
+    def unigrams(self, stubgram):
+        raise ValueError(f'Cannot list the k-grams of a sketched {self._n}-gram store')
+
+
+    def successor_table(self, stubgram):
+        raise ValueError(f'Cannot list the k-grams of a sketched {self._n}-gram store')
+
+
+    def all_ngrams(self):
+        raise ValueError(f'Cannot list the k-grams of a sketched {self._n}-gram store')
+
+
+class OverlayNGramStore:
+    # A FrozenNGramStore that takes new counts after all. They go into an
+    # NGramStore next to it and are added to the frozen counts on lookup.
+    def __init__(self, base):
+        self._n = base._n
+        self._base = base
+        self._delta = NGramStore(base._n)
+
+
+    def add_ngram(self, ngram, freq=1):
+        self._delta.add_ngram(ngram, freq)
+
+
+    def add_successors(self, stubgram, successors):
+        self._delta.add_successors(stubgram, successors)
+
+
+    def unigrams(self, stubgram):
+        unigrams = dict(self._base.unigrams(stubgram))
+        for uni, freq in self._delta.unigrams(stubgram):
+            unigrams[uni] = unigrams.get(uni, 0) + freq
+        return unigrams.items()
+
+
+    def freq(self, ngram):
+        return self._base.freq(ngram) + self._delta.freq(ngram)
+
+
+    def successor_table(self, stubgram):
+        successors, counts = self._base.successor_table(stubgram)
+        if self._delta._stub_dict(stubgram, create=False) is None:
+            return successors, counts
+        delta_successors, delta_counts = self._delta.successor_table(stubgram)
+        successors, inverse = np.unique(np.concatenate([successors, delta_successors]), return_inverse=True)
+        merged = np.zeros(len(successors), dtype=np.int64)
+        np.add.at(merged, inverse, np.concatenate([counts, delta_counts]))
+        return successors, merged
+
+
+    def counts(self, stubgram, ids):
+        return _gather(*self.successor_table(stubgram), ids)
+
+
+    def __len__(self):
+        return len(self._base) + sum(1 for ngram, _ in self._delta.all_ngrams() if self._base.freq(ngram) == 0)
+
+
+    def num_contexts(self):
+        return self._base.num_contexts() + sum(1 for stub in self._delta._root if self._base._row(stub) is None)
+
+
+    def pruned(self, keep):
+        return FrozenNGramStore.from_ngrams(self._n, [ngram for ngram, kept in zip(self.all_ngrams(), keep) if kept])
+
+
+    def all_ngrams(self):
+        ngrams = []
+        for ngram, freq in self._base.all_ngrams():
+            ngrams.append((ngram, freq + self._delta.freq(ngram)))
+        for ngram, freq in self._delta.all_ngrams():
+            if self._base.freq(ngram) == 0:
+                ngrams.append((ngram, freq))
+        return ngrams
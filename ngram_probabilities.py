@@ -6,8 +6,19 @@ from ngram import NGramModel
 from data import context_and_keystrokes
 
 class NGramProbabilities(WordProbabilities):
-    def __init__(self, model_path):
-        self._model = NGramModel.load(model_path)
+    # With log=True chosen words are logged next to the model and compacted
+    # into it on close, otherwise they are only learnt for the session. A
+    # log left by a session that was not closed is replayed on load.
+    # lazy=True reads the higher orders in the background, see
+    # NGramModel.load.
+    def __init__(self, model_path, trie='dict', lazy=False, log=False):
+        self._model_path = model_path
+        self._model = NGramModel.load(model_path, trie=trie, lazy=lazy)
+        if log:
+            try:
+                self._model.open_log(f'{model_path}.log')
+            except OSError:
+                pass
 
     def most_likely_words(self, input_str: str, n: int) -> tuple[list[str], list[float]]:
         #if len(input_str) == 0:
@@ -15,3 +26,20 @@ class NGramProbabilities(WordProbabilities):
         context, keystrokes = context_and_keystrokes(input_str)
         return self._model.completions(context, keystrokes, n)
 
+    def most_likely_words_batch(self, inputs: list[str], n: int) -> list[tuple[list[str], list[float]]]:
+        contexts = []
+        keystrokes = []
+        for input_str in inputs:
+            context, prefix = context_and_keystrokes(input_str)
+            contexts.append(context)
+            keystrokes.append(prefix)
+        return self._model.completions_batch(contexts, keystrokes, n)
+
+    def observe(self, input_str: str, word: str) -> None:
+        context, _ = context_and_keystrokes(input_str)
+        self._model.observe(context, word)
+
+    def close(self) -> None:
+        if self._model.log_size() > 0:
+            self._model.compact(self._model_path)
+        self._model.close_log()
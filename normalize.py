@@ -0,0 +1,140 @@
+import re
+import multiprocessing
+from collections import deque
+
+
+# Lines are normalized this many at a time.
+CHUNK_LINES = 10000
+
+# Same as the split patterns of DataSource, whose capture group makes
+# re.split return the lookahead text, or None, between the sentences.
+_SENTENCE_END = re.compile('\\.(?=(\\s+[A-Z])|$)')
+_JUNK = re.compile('<a|href=|text=|target=|&amp|http|www\\.')
+_SPACES = re.compile('  +')
+# Joins the phrases cleaned together. clean removes it from any phrase.
+_SEPARATOR = '\x00'
+
+
+class _Filter(dict):
+    # A str.translate table that keeps a to z and ', turns whitespace into
+    # a space and removes everything else, as the regex substitutions of
+    # clean did. Characters outside ASCII are looked up once each.
+    def __init__(self, keep=''):
+        super().__init__()
+        self._keep = keep
+        for code in range(128):
+            self[code] = self.__missing__(code)
+
+
+    def __missing__(self, code):
+        char = chr(code)
+        if 'a' <= char <= 'z' or char == "'" or char in self._keep:
+            value = code
+        elif char.isspace():
+            value = ' '
+        else:
+            value = None
+        self[code] = value
+        return value
+
+
+_TABLE = _Filter()
+_BATCH_TABLE = _Filter(keep=_SEPARATOR)
+
+
+def clean(phrase):
+    phrase = phrase.strip().lower().translate(_TABLE)
+    if '  ' in phrase:
+        phrase = _SPACES.sub(' ', phrase)
+    return phrase
+
+
+def clean_batch(phrases):
+    # clean for each of phrases, done on all of them joined into one
+    # string.
+    phrases = [phrase.strip() for phrase in phrases]
+    if len(phrases) == 0:
+        return []
+    text = _SEPARATOR.join(phrases)
+    if text.count(_SEPARATOR) != len(phrases) - 1:
+        return [clean(phrase) for phrase in phrases]
+    text = text.lower().translate(_BATCH_TABLE)
+    if '  ' in text:
+        text = _SPACES.sub(' ', text)
+    return text.split(_SEPARATOR)
+
+
+def split(line):
+    if '.' not in line:
+        fragments = [line]
+    else:
+        fragments = _SENTENCE_END.split(line)
+    # Drops the lookahead text and None that re.split includes.
+    return [s for s in fragments if s and not s.startswith(' ')]
+
+
+def split_comment(line):
+    # split, also dropping the fragments with HTML and links in them.
+    return [s for s in split(line) if not _JUNK.search(s)]
+
+
+def clean_comment(phrase):
+    return clean(phrase.replace('<br/>', ' ').replace('-', ' '))
+
+
+def sentences(lines, comments=False):
+    # The cleaned sentences of each of lines, in order. comments splits and
+    # cleans as for New York Times comments.
+    return line_sentences(lines, comments)[0]
+
+
+def line_sentences(lines, comments=False):
+    # sentences, and for each line the index in them where its sentences
+    # end.
+    split_line = split_comment if comments else split
+    fragments = []
+    ends = []
+    for line in lines:
+        fragments.extend(split_line(line.strip()))
+        ends.append(len(fragments))
+    if comments:
+        fragments = [s.replace('<br/>', ' ').replace('-', ' ') for s in fragments]
+    return clean_batch(fragments), ends
+
+
+def _chunks(lines, size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def ordered_map(function, tasks, jobs=1):
+    # Yields function(*task) for each of tasks, in order. With jobs > 1 the
+    # calls are made in that many processes, with at most two tasks per
+    # process taken from tasks ahead of the results yielded, so memory
+    # stays bounded however many tasks there are.
+    if jobs <= 1:
+        for task in tasks:
+            yield function(*task)
+        return
+    with multiprocessing.Pool(jobs) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(function, task))
+            if len(pending) > 2 * jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def normalized(lines, jobs=1, comments=False, chunk_size=CHUNK_LINES):
+    # The sentences of lines, in order, normalized chunk_size lines at a
+    # time in jobs processes.
+    tasks = ((chunk, comments) for chunk in _chunks(lines, chunk_size))
+    for chunk_sentences in ordered_map(sentences, tasks, jobs):
+        yield from chunk_sentences
@@ -147,6 +147,7 @@ def main():
     parser.add_argument('-n', type=int, help='Number of datapoints to read. Default behavior is reading all the data.')
     parser.add_argument('-k', type=int, help='Max label vocab size.')
     parser.add_argument('-t', action='store_true', help='Stratify the data.')
+    parser.add_argument('-j', type=int, default=1, help='Number of processes to read the data with.')
     arguments = parser.parse_args()
 
     out_dir = arguments.o
@@ -160,9 +161,9 @@ def main():
 
     if not samples_path:
         if 'nyt' in data_path.lower():
-            source = DataSourceNTComments(data_path)
+            source = DataSourceNTComments(data_path, jobs=arguments.j)
         else:
-            source = DataSource(data_path, arguments.n)
+            source = DataSource(data_path, arguments.n, jobs=arguments.j)
         samples_path = os.path.join(out_dir, 'samples.txt')
         source.save_samples(samples_path)
 
@@ -0,0 +1,114 @@
+import os
+from collections import Counter
+import pytest
+import data
+from data import DataSource, read_lines, DataLoader, line_shards, Special
+
+
+TEXT = 'first\r\nsécond line\n\rthird\tline\r\n\nfourth'
+
+
+SAMPLES = [
+    ('<S> the', 'cat'),
+    ('<S> the cat', 'sat'),
+    ('', 'alone'),
+    ('<S> un café', 'noir'),
+    ('<S> the cat sat on the', 'mat'),
+] * 3
+
+
+def write_samples(path, samples):
+    path.write_text(''.join(f'{context},{label}\n' for context, label in samples), encoding='utf-8')
+    return str(path)
+
+
+def token_samples(tokens):
+    for i in range(len(tokens)):
+        words = [tokens.words[idx] for idx in tokens.ids[tokens.offsets[i]:tokens.offsets[i + 1]].tolist()]
+        yield ' '.join(words[:-1]), words[-1]
+
+
+@pytest.mark.parametrize('buffer_size', [1, 2, 7, 1 << 20])
+def test_read_lines_translates_newlines(tmp_path, monkeypatch, buffer_size):
+    monkeypatch.setattr(data, 'READ_BUFFER_SIZE', buffer_size)
+    path = tmp_path / 'train.txt'
+    path.write_bytes(TEXT.encode('utf-8'))
+    lines = TEXT.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    assert list(read_lines(str(path), 'utf-8')) == lines
+    start = len('first\r\nsécond line\n'.encode('utf-8'))
+    end = start + len('\rthird\tline\r\n'.encode('utf-8'))
+    assert list(read_lines(str(path), 'utf-8', start, end)) == ['', 'third\tline']
+    assert list(read_lines(str(path), 'utf-8', start)) == lines[2:]
+
+
+def test_encodings_are_remembered_until_the_file_changes(tmp_path, monkeypatch):
+    detected = []
+
+    def detect(sample):
+        detected.append(sample)
+        return {'encoding': 'ascii'}
+
+    monkeypatch.setattr(data, 'detect', detect)
+    monkeypatch.setattr(data, 'ENCODING_SAMPLE_SIZE', 8)
+    path = tmp_path / 'train.txt'
+    path.write_bytes(b'short\n')
+    assert DataSource.get_encoding_type(str(path)) == 'ascii'
+    assert DataSource.get_encoding_type(str(path)) == 'ascii'
+    assert len(detected) == 1
+    # A sample of part of the file may miss what is not ASCII further on.
+    path.write_bytes(b'a longer file\n')
+    assert DataSource.get_encoding_type(str(path)) == 'utf-8'
+    assert detected[-1] == b'a longer'
+    assert os.path.isfile(tmp_path / data.ENCODING_MANIFEST)
+
+
+@pytest.mark.parametrize('count', [1, 2, 5, 100])
+def test_line_shards_split_at_lines(tmp_path, count):
+    path = tmp_path / 'train.txt'
+    path.write_bytes(TEXT.encode('utf-8'))
+    shards = line_shards(str(path), count)
+    assert shards[0][0] == 0 and shards[-1][1] == path.stat().st_size
+    assert all(end == start for (_, end), (start, _) in zip(shards[:-1], shards[1:]))
+    lines = [line for start, end in shards for line in read_lines(str(path), 'utf-8', start, end)]
+    assert lines == list(read_lines(str(path), 'utf-8'))
+
+
+def test_tokens_match_the_samples(tmp_path):
+    path = write_samples(tmp_path / 'train.txt', SAMPLES)
+    source = DataLoader(path)
+    assert list(token_samples(source.tokens())) == SAMPLES
+    contexts, labels = source.tokens().batch(0, len(SAMPLES))
+    assert contexts.shape == (len(SAMPLES), 6)
+    # The empty context is the start word alone, after padding.
+    start = Special.all().index(Special.START)
+    assert contexts[2].tolist() == [0] * 5 + [start]
+
+
+def test_tokens_are_compiled_again_after_a_change(tmp_path):
+    path = write_samples(tmp_path / 'train.txt', SAMPLES)
+    DataLoader(path).tokens()
+    compiled = os.stat(f'{path}__ids.npy').st_mtime_ns
+    assert list(token_samples(DataLoader(path).tokens())) == SAMPLES
+    assert os.stat(f'{path}__ids.npy').st_mtime_ns == compiled
+    write_samples(tmp_path / 'train.txt', SAMPLES[:4])
+    assert list(token_samples(DataLoader(path).tokens())) == SAMPLES[:4]
+
+
+
+def test_chardata_tokens_match_the_samples(tmp_path):
+    import chardata
+    samples = [('<S> t h e', 'c'), ('<S> c a', 't'), ('', 'x')] * 2
+    path = write_samples(tmp_path / 'train.txt', samples)
+    assert list(token_samples(chardata.DataLoader(path).tokens())) == samples
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_vocabulary_counts(tmp_path, jobs):
+    path = write_samples(tmp_path / 'train.txt', SAMPLES)
+    source = DataLoader(path, min_freq=2, jobs=jobs)
+    expected = Counter()
+    for context, label in SAMPLES:
+        expected.update(context.split() + [label])
+    assert source._saved_counts() == expected
+    with open(f'{path}__vocab.txt', encoding='utf-8') as f:
+        assert sorted(f.read().split()) == sorted(word for word, count in expected.items() if count >= 2 and word not in Special.all())
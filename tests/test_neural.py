@@ -0,0 +1,52 @@
+import torch
+import pytest
+from data import DataLoader
+from neural import NeuralPredictor
+
+
+SAMPLES = [
+    ('<S> the', 'cat'),
+    ('<S> the cat', 'sat'),
+    ('', 'alone'),
+    ('<S> the cat sat on the', 'mat'),
+    ('<S> a cat', 'ran'),
+    ('<S> the mat', 'was'),
+] * 2
+
+
+@pytest.fixture(scope='module')
+def loader(tmp_path_factory):
+    path = tmp_path_factory.mktemp('neural') / 'train.txt'
+    path.write_text(''.join(f'{context},{label}\n' for context, label in SAMPLES), encoding='utf-8')
+    return DataLoader(str(path))
+
+
+@pytest.fixture(scope='module')
+def model(loader):
+    torch.manual_seed(0)
+    return NeuralPredictor(data_src=loader, epochs=1, device='cpu')
+
+
+def assert_same(batch, single):
+    words, probs = batch
+    assert words == single[0]
+    assert probs == pytest.approx(single[1], rel=1e-5)
+
+
+@pytest.mark.parametrize('n', [1, 3, -1])
+def test_batches_of_mixed_lengths_match_single_contexts(model, n):
+    contexts = [context for context, _ in SAMPLES] + ['unknown words', 'the']
+    keystrokes = ['', 'c', '', 'm', 'zz', ''] * 2 + ['', 'c']
+    batch = model.completions_batch(contexts, keystrokes, n=n)
+    for context, prefix, result in zip(contexts, keystrokes, batch):
+        with torch.no_grad():
+            assert_same(result, model.completions(context, prefix, n=n))
+
+
+def test_token_batches_match_single_contexts(model, loader):
+    tokens = loader.tokens()
+    contexts, _ = tokens.batch(0, len(tokens))
+    batch = model.completions_ids(tokens.lookup(model._w2i)[contexts], n=3)
+    for (context, _), result in zip(SAMPLES, batch):
+        with torch.no_grad():
+            assert_same(result, model.completions(context, '', n=3))
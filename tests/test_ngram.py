@@ -0,0 +1,450 @@
+import time
+import random
+import numpy as np
+import pytest
+import ngram
+from data import DataLoader
+from ngram import NGramModel, SCORINGS, SketchNGramStore, QuantizedNGramStore, LazyStores
+
+
+WORDS = ['the', 'a', 'cat', 'dog', 'sat', 'ran', 'on', 'mat', 'with', 'big', 'small', 'red',
+        'car', 'card', 'care', 'cart', 'case', 'cast', 'to', 'too', 'top', 'tops', 'dot']
+CONTEXTS = ['', 'the', 'the big', 'a small red', 'unknown words here', 'the cat sat on the']
+PREFIXES = ['', 'c', 'ca', 'car', 't', 'to', 'x']
+
+
+def sentences(count, seed=0):
+    # Words drawn with Zipf like frequencies, so counts cover a wide range.
+    rng = random.Random(seed)
+    weights = [1 / (i + 1) for i in range(len(WORDS))]
+    return [' '.join(rng.choices(WORDS, weights, k=rng.randint(1, 12))) for _ in range(count)]
+
+
+def samples(count, n, seed=0):
+    # (context, label) pairs as DataLoader files hold them.
+    pairs = []
+    for sentence in sentences(count, seed):
+        words = ['<S>'] + sentence.split()
+        for i in range(1, len(words)):
+            pairs.append((' '.join(words[max(0, i - n + 1):i]), words[i]))
+    return pairs
+
+
+def trained(n=3, count=800, **kwargs):
+    model = NGramModel(n, **kwargs)
+    for sentence in sentences(count):
+        model.learn(sentence)
+    return model
+
+
+def all_completions(model, n=5, **kwargs):
+    return [model.completions(context, prefix, n, **kwargs) for context in CONTEXTS for prefix in PREFIXES]
+
+
+def assert_same_completions(model, other, n=5):
+    for (words, probs), (other_words, other_probs) in zip(all_completions(model, n), all_completions(other, n)):
+        assert words == other_words
+        assert np.allclose(probs, other_probs, rtol=1e-12, atol=0)
+
+
+def ngram_counts(model):
+    # The text format lists the special words with a count of 0.
+    return {k: sorted((tuple(ngram), freq) for ngram, freq in model._ngram_stores[k].all_ngrams() if freq > 0) for k in range(1, model._n + 1)}
+
+
+def interpolated(model, context, prefix):
+    # The interpolation as completions computed it one candidate at a time.
+    ids = model.transform_input(context)[-(model._n - 1):] if model._n > 1 else []
+    _, candidates, _ = model._trie.get_words(prefix)
+    weights = {word: model._lambda[0] for word in candidates}
+    for k in range(len(ids) + 1):
+        freqs = {word: model.freq(ids[len(ids) - k:] + [model._w2i[word]]) for word in candidates}
+        total = sum(freqs.values())
+        for word in candidates:
+            weights[word] += model._lambda[k + 1] * (freqs[word] / total if total else 1 / len(candidates))
+    total = sum(weights.values())
+    return {word: weight / total for word, weight in weights.items()}
+
+
+def test_text_format_loads_the_same_model(tmp_path):
+    model = trained()
+    path = str(tmp_path / 'model.txt')
+    model.save(path)
+    loaded = NGramModel.load(path)
+    assert loaded._i2w == model._i2w
+    assert ngram_counts(loaded) == ngram_counts(model)
+    assert_same_completions(loaded, model)
+
+
+def test_frozen_stores_match_the_dict_stores(tmp_path):
+    model = trained(n=4)
+    path = str(tmp_path / 'model.txt')
+    model.save(path)
+    frozen = NGramModel.load(path, frozen=True)
+    assert ngram_counts(frozen) == ngram_counts(model)
+    for k in range(2, 5):
+        for ngram, _ in ngram_counts(model)[k]:
+            stub = list(ngram[:-1])
+            assert sorted(frozen._ngram_stores[k].unigrams(stub)) == sorted(model._ngram_stores[k].unigrams(stub))
+    assert_same_completions(frozen, model)
+
+
+@pytest.mark.parametrize('n', [1, 2, 3])
+def test_completions_match_the_interpolation(n):
+    model = trained(n=n)
+    for context in CONTEXTS:
+        for prefix in PREFIXES:
+            words, probs = model.completions(context, prefix, -1)
+            expected = interpolated(model, context, prefix)
+            assert sorted(words) == sorted(expected)
+            assert np.allclose(probs, [expected[word] for word in words], rtol=1e-9, atol=0)
+            assert list(probs) == sorted(probs, reverse=True)
+
+
+def test_stub_cache_keeps_completions():
+    cached = trained()
+    uncached = trained(stub_cache_size=0)
+    assert all_completions(cached) == all_completions(uncached)
+    assert cached.stub_cache_info()['hits'] > 0
+    # Learning drops the cached tables of the contexts it changes.
+    for sentence in sentences(50, seed=1):
+        cached.learn(sentence)
+        uncached.learn(sentence)
+    assert all_completions(cached) == all_completions(uncached)
+
+
+@pytest.mark.parametrize('scoring', SCORINGS)
+def test_text_and_binary_formats_load_the_same_model(tmp_path, scoring):
+    model = trained(scoring=scoring)
+    text_path = str(tmp_path / 'model.txt')
+    binary_path = str(tmp_path / 'model.bin')
+    model.save(text_path)
+    model.save(binary_path, binary=True)
+    assert not NGramModel.is_binary(text_path) and NGramModel.is_binary(binary_path)
+    for loaded in [NGramModel.load(text_path), NGramModel.load(text_path, frozen=True), NGramModel.load(binary_path)]:
+        assert loaded._scoring == scoring
+        assert loaded._i2w == model._i2w
+        assert ngram_counts(loaded) == ngram_counts(model)
+        assert_same_completions(loaded, model)
+
+
+def test_binary_model_saved_over_itself(tmp_path):
+    path = str(tmp_path / 'model.bin')
+    trained().save(path, binary=True)
+    model = NGramModel.load(path)
+    expected = all_completions(model)
+    # The loaded model is still mapped from the file it is saved over.
+    model.save(path, binary=True)
+    assert all_completions(model) == expected
+    assert all_completions(NGramModel.load(path)) == expected
+
+
+@pytest.mark.parametrize('scoring', SCORINGS)
+def test_probabilities_sum_to_one(scoring):
+    model = trained(scoring=scoring)
+    for context in CONTEXTS:
+        _, probs = model.completions(context, '', -1)
+        assert np.isclose(sum(probs), 1)
+
+
+@pytest.mark.parametrize('scoring', SCORINGS)
+def test_shared_model_matches_the_original(scoring):
+    model = trained(scoring=scoring)
+    shm = model.share()
+    try:
+        attached = NGramModel.attach(shm.name)
+        assert attached._scoring == scoring
+        assert ngram_counts(attached) == ngram_counts(model)
+        assert_same_completions(attached, model)
+        del attached
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def test_observed_words_are_counted_at_every_order(tmp_path):
+    path = str(tmp_path / 'model.bin')
+    trained().save(path, binary=True)
+    model = NGramModel.load(path)
+    ids = model.transform_input('the cat')[-2:] + [model._w2i['sat']]
+    before = [model.freq(ids[-k:]) for k in range(1, 4)]
+    model.observe('the cat', 'sat')
+    assert [model.freq(ids[-k:]) for k in range(1, 4)] == [freq + 1 for freq in before]
+    model.observe('the cat', 'newword')
+    assert model._trie.get_words('newwor')[1] == ['newword']
+
+
+def test_log_is_replayed(tmp_path):
+    path = str(tmp_path / 'model.bin')
+    trained().save(path, binary=True)
+    model = NGramModel.load(path)
+    model.open_log(str(tmp_path / 'model.log'))
+    for context, word in [('the cat', 'sat'), ('the big', 'dog'), ('a', 'newword')]:
+        model.observe(context, word)
+    assert model.log_size() == 3
+    replayed = NGramModel.load(path)
+    replayed.open_log(str(tmp_path / 'model.log'))
+    assert replayed.log_size() == 3
+    assert ngram_counts(replayed) == ngram_counts(model)
+
+
+def test_log_keeps_commas_and_quotes(tmp_path):
+    path = str(tmp_path / 'model.bin')
+    trained().save(path, binary=True)
+    model = NGramModel.load(path)
+    model.open_log(str(tmp_path / 'model.log'))
+    for context, word in [('the cat, "the dog"', 'sat'), ('a', 'new,word'), ('"quoted', 'dog')]:
+        model.observe(context, word)
+    model.close_log()
+    replayed = NGramModel.load(path)
+    replayed.open_log(str(tmp_path / 'model.log'))
+    replayed.close_log()
+    assert replayed._i2w == model._i2w
+    assert ngram_counts(replayed) == ngram_counts(model)
+
+
+@pytest.mark.parametrize('scoring', SCORINGS)
+def test_observed_words_score_as_after_a_reload(tmp_path, scoring):
+    path = str(tmp_path / 'model.bin')
+    trained(scoring=scoring).save(path, binary=True)
+    model = NGramModel.load(path)
+    all_completions(model)
+    for context, word in [('the cat', 'sat'), ('the big', 'dog'), ('a', 'newword'), ('', 'cat')]:
+        model.observe(context, word)
+        model.save(str(tmp_path / 'reloaded.txt'))
+        assert_same_completions(model, NGramModel.load(str(tmp_path / 'reloaded.txt')))
+
+
+def backoff_state(model):
+    # The backoff tables and the prefix ranking as plain values.
+    tables = {}
+    for k, (stats, continuations, continuation_stats) in (model._backoff or {}).items():
+        if continuations is not None:
+            continuations = sorted((tuple(ngram), freq) for ngram, freq in continuations.all_ngrams() if freq > 0)
+            continuation_stats = continuation_stats.header()
+        tables[k] = (stats.header(), continuations, continuation_stats)
+    ranking = model._ranking
+    return tables, ranking._words, ranking._ids.tolist(), ranking._counts.tolist(), ranking._totals.tolist(), [level.tolist() for level in ranking._table]
+
+
+@pytest.mark.parametrize('scoring', SCORINGS)
+@pytest.mark.parametrize('kind', ['dict', 'binary', 'quantized'])
+@pytest.mark.parametrize('trie', ['dict', 'compact'])
+def test_observed_words_update_the_tables_in_place(tmp_path, scoring, kind, trie):
+    model = trained(scoring=scoring, trie=trie)
+    if kind != 'dict':
+        if kind == 'quantized':
+            model.quantize(8)
+        path = str(tmp_path / 'model.bin')
+        model.save(path, binary=True)
+        model = NGramModel.load(path, trie=trie)
+    all_completions(model)
+    model._prefix_ranking()
+    tables, ranking = model._backoff, model._ranking
+    for context, word in [('the cat', 'sat'), ('the big', 'newword'), ('a', 'newword'), ('', 'cat'), ('unknown words', 'zebra'), ('the cat', 'sat')] + [('the', 'zzy')] + [('a', 'zzz')] * 3:
+        model.observe(context, word)
+    assert model._backoff is tables and model._ranking is ranking
+    cached = {key: (successors.tolist(), counts.tolist(), total) for key, (successors, counts, total) in model._stub_cache._tables.items()}
+    incremental = backoff_state(model), all_completions(model)
+
+    model._backoff = None
+    model._ranking = None
+    model._stub_cache.clear()
+    model._candidate_cache.clear()
+    for key in cached:
+        successors, counts, total = model._stub_cache.get(model._ngram_stores[len(key) + 1], key)
+        assert cached[key] == (successors.tolist(), counts.tolist(), total)
+    all_completions(model)
+    model._prefix_ranking()
+    assert (backoff_state(model), all_completions(model)) == incremental
+
+
+def test_completions_batch_matches_completions():
+    contexts = [context for context in CONTEXTS for _ in PREFIXES] * 2
+    keystrokes = PREFIXES * len(CONTEXTS) * 2
+    for scoring in SCORINGS:
+        model = trained(scoring=scoring)
+        for kwargs in [dict(n=3), dict(n=-1), dict(n=0), dict(n=4, max_edits=1), dict(n=2, max_candidates=3)]:
+            batch = model.completions_batch(contexts, keystrokes, **kwargs)
+            single = [model.completions(context, prefix, **kwargs) for context, prefix in zip(contexts, keystrokes)]
+            assert batch == [(list(words), list(probs)) for words, probs in single]
+
+
+def test_learn_parallel_matches_serial(tmp_path):
+    path = tmp_path / 'train.txt'
+    path.write_text(''.join(f'{context},{label}\n' for context, label in samples(500, 3)), encoding='utf-8')
+    source = DataLoader(str(path))
+    serial = NGramModel(3)
+    for context, label in source.labeled_samples():
+        serial.learn_sample(context, label)
+    parallel = NGramModel(3)
+    parallel.learn_parallel(source, 3)
+    serial.save(str(tmp_path / 'serial.txt'))
+    parallel.save(str(tmp_path / 'parallel.txt'))
+    assert (tmp_path / 'serial.txt').read_bytes() == (tmp_path / 'parallel.txt').read_bytes()
+
+
+def test_prune_by_count():
+    model = trained()
+    before = ngram_counts(model)
+    removed = model.prune(min_counts=[2, 3])
+    after = ngram_counts(model)
+    assert after[1] == before[1]
+    for k, least in [(2, 2), (3, 3)]:
+        assert after[k] == [(ngram, freq) for ngram, freq in before[k] if freq >= least]
+        assert removed[k] == len(before[k]) - len(after[k])
+
+
+@pytest.mark.parametrize('fraction', [0.9, 0.5, 0.2])
+def test_prune_to_fit(tmp_path, fraction):
+    model = trained()
+    full = model.nbytes()
+    budget = int(full * fraction)
+    model.prune(max_bytes=budget)
+    assert model.nbytes() <= budget
+    path = str(tmp_path / 'pruned.bin')
+    model.save(path, binary=True)
+    assert ngram_counts(NGramModel.load(path)) == ngram_counts(model)
+
+
+@pytest.mark.parametrize('bits', [8, 16])
+def test_quantized_counts_stay_close(tmp_path, bits):
+    model = trained(count=3000)
+    exact = ngram_counts(model)
+    model.quantize(bits)
+    path = str(tmp_path / 'quantized.bin')
+    model.save(path, binary=True)
+    loaded = NGramModel.load(path)
+    for k in range(2, 4):
+        store = loaded._ngram_stores[k]
+        assert isinstance(store, QuantizedNGramStore)
+        levels = store._levels.astype(np.float64)
+        # Counts round to the nearest level in log scale, so they are off by
+        # at most half the widest gap between levels.
+        ratio = np.sqrt((levels[1:] / levels[:-1]).max()) if len(levels) > 1 else 1.0
+        for (ngram, freq), (quantized_ngram, quantized) in zip(exact[k], ngram_counts(loaded)[k]):
+            assert ngram == quantized_ngram
+            assert freq / ratio - 1e-9 <= quantized <= freq * ratio + 1e-9
+            if freq <= 8:
+                assert quantized == freq
+    assert ngram_counts(loaded)[1] == exact[1]
+
+
+@pytest.mark.parametrize('bits', [8, 16])
+def test_quantized_probabilities_stay_close(bits):
+    exact = trained(count=3000)
+    quantized = trained(count=3000)
+    quantized.quantize(bits)
+    ratio = 1.0
+    for k in range(2, 4):
+        # Counts between levels that are not next to each other round to
+        # the nearest one in log scale.
+        levels = quantized._ngram_stores[k]._levels.astype(np.float64)
+        gaps = levels[1:] - levels[:-1] > 1
+        if gaps.any():
+            ratio = max(ratio, np.sqrt((levels[1:][gaps] / levels[:-1][gaps]).max()))
+    for context in CONTEXTS:
+        ids = quantized._context_ids(context)
+        for k in range(1, len(ids) + 1):
+            # Contexts have their exact total count, not the sum of the
+            # quantized counts.
+            _, counts, total = exact._stub_cache.get(exact._ngram_stores[k+1], ids[-k:])
+            assert quantized._stub_cache.get(quantized._ngram_stores[k+1], ids[-k:])[2] == total == counts.sum()
+        for prefix in PREFIXES:
+            words, probs = exact.completions(context, prefix, -1)
+            expected = dict(zip(words, probs))
+            words, probs = quantized.completions(context, prefix, -1)
+            assert sorted(words) == sorted(expected)
+            # Each count is off by at most ratio, and so is each order's
+            # probability over the exact total, and each weight before and
+            # after they are normalized.
+            assert np.allclose(probs, [expected[word] for word in words], rtol=ratio**2 - 1 + 1e-12, atol=0)
+
+
+def test_sketched_counts_are_bounded():
+    exact = trained()
+    width, depth = 512, 4
+    sketched = trained(approx_orders=(3,), sketch_width=width, sketch_depth=depth)
+    store = sketched._ngram_stores[3]
+    assert isinstance(store, SketchNGramStore)
+    counts = ngram_counts(exact)[3]
+    total = sum(freq for _, freq in counts)
+    over = []
+    for ngram, freq in counts:
+        estimate = store.freq(list(ngram))
+        # Count-min sketches only ever overcount.
+        assert estimate >= freq
+        over.append(estimate - freq)
+    # The error bound e / width * total holds with probability 1 - e^-depth
+    # for each k-gram.
+    assert np.mean(np.array(over) > np.e / width * total) <= np.exp(-depth) * 2
+
+
+def test_sketches_need_interpolate_scoring():
+    with pytest.raises(ValueError):
+        NGramModel(3, scoring='kneser-ney', approx_orders=(3,))
+    with pytest.raises(ValueError):
+        NGramModel(3, approx_orders=(1,))
+
+
+def test_binary_models_load_sketches_for_interpolate_scoring_only(tmp_path):
+    path = str(tmp_path / 'model.bin')
+    trained(scoring='kneser-ney').save(path, binary=True)
+    with pytest.raises(ValueError):
+        NGramModel.load(path, approx_orders=(3,))
+    with pytest.raises(ValueError):
+        NGramModel.load(path, scoring='interpolate', approx_orders=(1,))
+    assert isinstance(NGramModel.load(path, scoring='interpolate', approx_orders=(3,))._ngram_stores[3], SketchNGramStore)
+
+
+@pytest.mark.parametrize('kind', ['exact', 'quantized', 'observed'])
+def test_pruned_top_k_matches_scoring_every_candidate(tmp_path, kind):
+    model = trained(n=4)
+    if kind == 'quantized':
+        model.quantize(8)
+    elif kind == 'observed':
+        path = str(tmp_path / 'model.bin')
+        model.save(path, binary=True)
+        model = NGramModel.load(path)
+        for context, word in [('the cat', 'sat'), ('the big', 'dog'), ('a', 'newword')]:
+            model.observe(context, word)
+    vocab = len(model._trie.get_words('')[1])
+    for context in CONTEXTS:
+        for prefix in PREFIXES:
+            for n in [0, 1, 3, vocab - 1, vocab, vocab + 5]:
+                # The smallest threshold prunes every lookup, the largest
+                # none.
+                model._TOP_K_MIN_CANDIDATES = 0
+                words, probs = model.completions(context, prefix, n)
+                model._TOP_K_MIN_CANDIDATES = float('inf')
+                exhaustive_words, exhaustive_probs = model.completions(context, prefix, n)
+                assert words == exhaustive_words
+                assert np.allclose(probs, exhaustive_probs, rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('frozen', [False, True])
+def test_lazy_stores(tmp_path, monkeypatch, frozen):
+    read_section = ngram._read_section
+
+    def slow_read_section(f, k):
+        time.sleep(0.2)
+        return read_section(f, k)
+
+    monkeypatch.setattr(ngram, '_read_section', slow_read_section)
+    model = trained(n=4)
+    path = str(tmp_path / 'model.txt')
+    model.save(path)
+    expected = ngram_counts(model)
+    # The first load finds the sections in order, the second one jumps to
+    # them from the sidecar. Stores are asked for while the background
+    # thread is still reading, highest order first.
+    for _ in range(2):
+        lazy = NGramModel.load(path, frozen=frozen, lazy=True)
+        assert isinstance(lazy._ngram_stores, LazyStores)
+        assert lazy._ngram_stores.loaded() == 1
+        lazy.completions('the big', 'c', 5)
+        for k in [4, 2, 3]:
+            assert sorted((tuple(ngram), freq) for ngram, freq in lazy._ngram_stores[k].all_ngrams()) == expected[k]
+        assert lazy._ngram_stores.loaded() == 4
+        assert_same_completions(lazy, model)
+        assert (tmp_path / 'model.txt.sections').exists()
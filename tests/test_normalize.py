@@ -0,0 +1,58 @@
+import random
+import pytest
+import normalize
+from bench import regex_split, regex_clean
+
+
+LINES = [
+    'The cat sat. The dog ran.',
+    'e.g. this is. Not a split. 3.5 Million people.',
+    'Ends with a dot.',
+    'Trailing dot.   ',
+    'No sentence end here',
+    'A.B. Smith said. Then   he  left.\tDone.',
+    "It's  don't -- well-known, isn't it? Yes. Really",
+    'Tabs\tand\nnewlines\r\nand\x0bvertical\x1ctabs.',
+    'Ünïcödé wörds ñ and fancy spaces here. Emoji 🙂 too.',
+    'See <a href="http://www.nytimes.com">this</a>. Also www.x.com. Fine.',
+    'Line<br/>break and dash-separated words. &amp; more.',
+    '',
+    '.',
+    '...',
+    '. Leading dot. A',
+    'Null\x00byte. Kept out.',
+]
+
+
+def random_lines(count):
+    rng = random.Random(0)
+    alphabet = 'abcXYZ .,\'-!?\t\n<br/>\x00é ' + 'e' * 10
+    return [''.join(rng.choices(alphabet, k=rng.randint(0, 60))) for _ in range(count)]
+
+
+@pytest.mark.parametrize('comments', [False, True])
+def test_split_matches_regex(comments):
+    split = normalize.split_comment if comments else normalize.split
+    for line in LINES + random_lines(2000):
+        assert split(line) == list(regex_split(line, comments))
+
+
+@pytest.mark.parametrize('comments', [False, True])
+def test_clean_matches_regex(comments):
+    clean = normalize.clean_comment if comments else normalize.clean
+    for phrase in LINES + random_lines(2000):
+        assert clean(phrase) == regex_clean(phrase, comments)
+
+
+@pytest.mark.parametrize('comments', [False, True])
+def test_sentences_match_regex(comments):
+    lines = LINES + random_lines(2000)
+    expected = [regex_clean(s, comments) for line in lines for s in regex_split(line.strip(), comments)]
+    assert normalize.sentences(lines, comments) == expected
+    assert list(normalize.normalized(lines, comments=comments, chunk_size=7)) == expected
+    assert list(normalize.normalized(lines, jobs=2, comments=comments, chunk_size=7)) == expected
+
+
+def test_clean_batch_with_separator():
+    phrases = ['One', 'two\x00three', '', ' Four ']
+    assert normalize.clean_batch(phrases) == [normalize.clean(phrase) for phrase in phrases]
@@ -0,0 +1,107 @@
+import csv
+import random
+from collections import Counter
+import pytest
+import data
+import normalize
+from data import DataSourceNTComments, Special, csv_shards, record_shards
+
+
+WORDS = ['the', 'president', 'said', 'Trump', 'voters', 'in', 'New', 'York', "don't", 'a', 'tax']
+
+
+def comment(rng):
+    sentences = []
+    for _ in range(rng.randint(1, 4)):
+        words = rng.choices(WORDS, k=rng.randint(1, 8))
+        sentences.append(' '.join(words).capitalize() + rng.choice(['.', '!', ',', '-', ' "quoted"', '<br/>']))
+    return rng.choice([' ', '\n', '\r\n', ', ']).join(sentences)
+
+
+def write_comments(path, count, seed=0, quote_row=False):
+    # A New York Times comments file whose comment bodies span lines and
+    # have quotes and commas in them. quote_row adds a row with a quote
+    # inside an unquoted field, which csv.reader keeps as it is.
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['commentID', 'commentBody', 'userDisplayName'])
+        for i in range(count):
+            writer.writerow([i, comment(rng), rng.choice(WORDS)])
+            if quote_row and i == count // 2:
+                f.write(f'{i}x,Said 5" of snow. Then more,nobody\r\n')
+    return path
+
+
+def csv_sentences(paths, limit=None):
+    # The sentences as read before the files were read in chunks, with
+    # csv.reader over each whole file.
+    comments = []
+    for path in paths:
+        with open(path, 'r', encoding='utf8') as f:
+            reader = csv.reader(f)
+            index = next(reader).index('commentBody')
+            comments.extend(row[index] for row in reader)
+    return normalize.sentences(comments[:limit], comments=True)
+
+
+def record_starts(path):
+    # The offsets csv.reader starts a record at, found by reading the file
+    # one line at a time.
+    with open(path, 'rb') as f:
+        def lines():
+            while line := f.readline():
+                yield line.decode('utf-8')
+        starts = {0}
+        for _ in csv.reader(lines()):
+            starts.add(f.tell())
+    return starts
+
+
+@pytest.mark.parametrize('quote_row', [False, True])
+@pytest.mark.parametrize('buffer_size', [5, 64, 1 << 20])
+def test_csv_shards_start_at_records(tmp_path, monkeypatch, quote_row, buffer_size):
+    monkeypatch.setattr(data, 'READ_BUFFER_SIZE', buffer_size)
+    path = write_comments(tmp_path / 'CommentsJan2017.csv', 200, quote_row=quote_row)
+    size = path.stat().st_size
+    starts = record_starts(path)
+    for shard_size in [1, 100, 1000, size]:
+        shards = csv_shards(path, shard_size)
+        assert shards[0][0] == 0 and shards[-1][1] == size
+        assert all(end == start for (_, end), (start, _) in zip(shards[:-1], shards[1:]))
+        assert {start for start, _ in shards} <= starts
+
+
+def test_quote_in_unquoted_field_falls_back_to_csv_reader(tmp_path):
+    path = write_comments(tmp_path / 'CommentsJan2017.csv', 200, quote_row=True)
+    assert csv_shards(path, 100) == record_shards(path, 100)
+
+
+@pytest.mark.parametrize('quote_row', [False, True])
+@pytest.mark.parametrize('jobs', [1, 2])
+@pytest.mark.parametrize('limit', [None, 1, 150, 1000])
+def test_chunked_reader_matches_csv_reader(tmp_path, monkeypatch, quote_row, jobs, limit):
+    monkeypatch.setattr(data, 'COMMENT_CHUNK_SIZE', 500)
+    paths = [write_comments(tmp_path / f'Comments{month}2017.csv', 100, seed, quote_row) for seed, month in enumerate(['Jan', 'Feb'])]
+    source = DataSourceNTComments(str(tmp_path), num_datapoints=limit, jobs=jobs)
+    assert list(source.sentences()) == csv_sentences(sorted(paths, key=lambda p: source._paths.index(str(p))), limit)
+
+
+
+def test_vocabulary_counts_follow_the_number_of_comments(tmp_path):
+    paths = [write_comments(tmp_path / 'CommentsJan2017.csv', 100)]
+    # Counts cached for one limit are not used for another.
+    for limit in [10, None, 150, 10]:
+        source = DataSourceNTComments(str(tmp_path), num_datapoints=limit)
+        expected = Counter(word for sentence in csv_sentences(paths, limit) for word in sentence.split())
+        assert source._saved_counts() == expected
+        assert sorted(source.vocab()) == sorted(word for word, count in expected.items() if count >= 2 and word not in Special.all())
+
+def test_chardata_reads_the_words_of_the_same_comments(tmp_path, monkeypatch):
+    import chardata
+    monkeypatch.setattr(data, 'COMMENT_CHUNK_SIZE', 500)
+    monkeypatch.setattr(chardata, 'COMMENT_CHUNK_SIZE', 500)
+    write_comments(tmp_path / 'CommentsJan2017.csv', 100, quote_row=True)
+    words = list(chardata.DataSourceNTComments(str(tmp_path), num_datapoints=60).sentences())
+    sentences = DataSourceNTComments(str(tmp_path), num_datapoints=60).sentences()
+    assert words == [word for sentence in sentences for word in sentence.split()]
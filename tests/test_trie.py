@@ -0,0 +1,146 @@
+import random
+import pytest
+from trie import FreqTrie, CompactFreqTrie, make_trie, vocab_key
+
+
+def levenshtein(a, b):
+    row = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        prev, row[0] = row[0], i
+        for j, y in enumerate(b, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (x != y))
+    return row[-1]
+
+
+@pytest.fixture(scope='module')
+def counts():
+    rng = random.Random(0)
+    words = {''.join(rng.choices('abcde', k=rng.randint(1, 6))) for _ in range(400)}
+    return [(word, rng.choice([1, 1, 2, 3, 5, 8, 40])) for word in sorted(words)]
+
+
+PREFIXES = ['', 'a', 'ab', 'abc', 'e', 'dd', 'cab', 'z', 'abcdea']
+ADDED = [('abc', 7), ('zzz', 2), ('ab', 1), ('zzza', 3), ('', 0)]
+
+
+def below(counts, prefix):
+    # Words are completions of prefix, prefix itself is not one.
+    return {word: freq for word, freq in counts if word.startswith(prefix) and word != prefix}
+
+
+def added(kind, counts):
+    trie = kind()
+    for word, freq in counts:
+        trie.add_word(word, freq)
+    return trie
+
+
+def grown(kind, counts):
+    # A trie queried once, so the compact one is built, then given more
+    # words.
+    trie = added(kind, counts)
+    trie.get_words('')
+    for word, freq in ADDED:
+        trie.add_word(word, freq)
+    return trie
+
+
+@pytest.mark.parametrize('kind', [FreqTrie, CompactFreqTrie])
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_get_words(counts, kind, prefix):
+    total, words, freqs = added(kind, counts).get_words(prefix)
+    expected = below(counts, prefix)
+    assert dict(zip(words, freqs)) == expected and len(words) == len(expected)
+    assert total == sum(expected.values())
+
+
+def test_words_added_after_building(counts):
+    compact = grown(CompactFreqTrie, counts)
+    tree = grown(FreqTrie, counts)
+    for prefix in PREFIXES + ['zz']:
+        compact_total, compact_words, compact_freqs = compact.get_words(prefix)
+        tree_total, tree_words, tree_freqs = tree.get_words(prefix)
+        assert compact_total == tree_total
+        assert sorted(zip(compact_words, compact_freqs)) == sorted(zip(tree_words, tree_freqs))
+
+
+def test_words_added_after_building_wait_for_a_rebuild(counts):
+    compact = grown(CompactFreqTrie, counts)
+    nodes = len(compact._labels)
+    rebuilt = CompactFreqTrie.from_counts(counts + ADDED)
+    for prefix in PREFIXES + ['zz']:
+        assert compact.get_words(prefix) == rebuilt.get_words(prefix)
+        assert compact.top_k(prefix, 4) == rebuilt.top_k(prefix, 4)
+        _, words, freqs, dists = compact.get_words_fuzzy(prefix, 1)
+        _, rebuilt_words, rebuilt_freqs, rebuilt_dists = rebuilt.get_words_fuzzy(prefix, 1)
+        assert sorted(zip(words, freqs, dists)) == sorted(zip(rebuilt_words, rebuilt_freqs, rebuilt_dists))
+    assert len(compact._labels) == nodes
+    assert compact.node_count() == rebuilt.node_count()
+
+
+@pytest.mark.parametrize('kind', [FreqTrie, CompactFreqTrie])
+@pytest.mark.parametrize('prefix', PREFIXES)
+@pytest.mark.parametrize('k', [0, 1, 5, 1000])
+def test_top_k(counts, kind, prefix, k):
+    total, words, freqs = added(kind, counts).top_k(prefix, k)
+    ranked = sorted((-freq, word) for word, freq in below(counts, prefix).items())[:k]
+    assert words == [word for _, word in ranked]
+    assert freqs == [-freq for freq, _ in ranked]
+    if ranked:
+        assert total == sum(below(counts, prefix).values())
+
+
+def test_top_k_of_words_added_after_building(counts):
+    compact = grown(CompactFreqTrie, counts)
+    tree = grown(FreqTrie, counts)
+    for prefix in PREFIXES + ['zz']:
+        assert compact.top_k(prefix, 4) == tree.top_k(prefix, 4)
+
+
+@pytest.mark.parametrize('kind', [FreqTrie, CompactFreqTrie])
+def test_from_counts_matches_added_words(counts, kind):
+    bulk = kind.from_counts(counts)
+    single = added(kind, counts)
+    for prefix in PREFIXES:
+        total, words, freqs = bulk.get_words(prefix)
+        single_total, single_words, single_freqs = single.get_words(prefix)
+        assert total == single_total
+        assert sorted(zip(words, freqs)) == sorted(zip(single_words, single_freqs))
+        assert bulk.top_k(prefix, 5) == single.top_k(prefix, 5)
+
+
+@pytest.mark.parametrize('kind', [FreqTrie, CompactFreqTrie])
+def test_words_longer_than_the_recursion_limit(kind):
+    long = 'ab' * 2000
+    trie = kind.from_counts([(long, 3), (long + 'c', 2), ('a', 1)])
+    assert trie.get_words(long) == (2, [long + 'c'], [2])
+    assert trie.top_k('a', 1) == (5, [long], [3])
+
+
+@pytest.mark.parametrize('kind', [FreqTrie, CompactFreqTrie])
+@pytest.mark.parametrize('prefix', PREFIXES)
+@pytest.mark.parametrize('max_edits', [0, 1, 2])
+def test_get_words_fuzzy(counts, kind, prefix, max_edits):
+    total, words, freqs, dists = kind.from_counts(counts).get_words_fuzzy(prefix, max_edits)
+    expected = {}
+    for word, freq in counts:
+        # The distance to the closest beginning of the word.
+        dist = min(levenshtein(prefix, word[:i]) for i in range(len(word) + 1))
+        if dist <= max_edits and word != prefix:
+            expected[word] = (freq, dist)
+    assert dict(zip(words, zip(freqs, dists))) == expected and len(words) == len(expected)
+    assert total == sum(freq for freq, _ in expected.values())
+
+
+def test_sidecar(tmp_path, counts):
+    sidecar = str(tmp_path / 'model.trie')
+    built = make_trie('mmap', counts, sidecar=sidecar)
+    mapped = CompactFreqTrie.open(sidecar, vocab_key(counts))
+    assert mapped is not None
+    for prefix in PREFIXES:
+        assert mapped.get_words(prefix) == built.get_words(prefix)
+    # Counts changed in memory leave the file as it was.
+    mapped.add_word('abc', 100)
+    assert CompactFreqTrie.open(sidecar, vocab_key(counts)).get_words('abc') == built.get_words('abc')
+    assert CompactFreqTrie.open(sidecar, vocab_key(counts[1:])) is None
+    assert CompactFreqTrie.open(str(tmp_path / 'missing.trie'), vocab_key(counts)) is None
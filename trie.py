@@ -1,7 +1,49 @@
+import os
+import mmap
+import struct
+import hashlib
+from array import array
+from bisect import bisect_left
+from collections import deque
+from heapq import heapify, heappop, heappush, merge
+
+
 class FreqTrie:
     def __init__(self):
         self._root = FreqTrieNode()
-    
+
+
+    @classmethod
+    def from_counts(cls, counts):
+        # counts: iterable of (word, freq) pairs. Words are inserted in sorted
+        # order, so each word only creates the nodes past the prefix it
+        # shares with the previous one, and a node is complete once it is
+        # popped off the path. Its totals are then folded into its parent.
+        trie = cls()
+        path = [trie._root]
+        prev = ''
+        for word, freq in sorted(counts):
+            common = 0
+            limit = min(len(word), len(prev))
+            while common < limit and word[common] == prev[common]:
+                common += 1
+            FreqTrie._fold(path, common)
+            for char in word[common:]:
+                path.append(path[-1].child(char))
+            path[-1].increment_freq(freq)
+            path[-1].update_maxfreq(path[-1].freq())
+            prev = word
+        FreqTrie._fold(path, 0)
+        return trie
+
+
+    def _fold(path, depth):
+        while len(path) > depth + 1:
+            node = path.pop()
+            parent = path[-1]
+            parent.increment_subfreq(node.freq() + node.subfreq())
+            parent.update_maxfreq(node.maxfreq())
+
 
     def add_word(self, word, n=1):
         self._root.add_suffix(word, n)
@@ -25,6 +67,71 @@ class FreqTrie:
         return (total_freqs, words, freqs)
 
 
+    def top_k(self, prefix, k):
+        # Best-first search over the subtree, where a node is expanded only
+        # once no remaining word can beat the most frequent word below it.
+        # Words come out by descending frequency, ties by ascending word.
+        subroot = self._root.child(prefix, create=False)
+        if subroot is None:
+            return (0, [], [])
+
+        heap = []
+        for child in subroot.children():
+            if child.maxfreq() > 0:
+                heap.append((-child.maxfreq(), child.word(), 1, child))
+        heapify(heap)
+        words = []
+        freqs = []
+        while heap and len(words) < k:
+            neg_freq, word, is_node, node = heappop(heap)
+            if not is_node:
+                words.append(word)
+                freqs.append(-neg_freq)
+                continue
+            if node.freq() > 0:
+                heappush(heap, (-node.freq(), word, 0, None))
+            for child in node.children():
+                if child.maxfreq() > 0:
+                    heappush(heap, (-child.maxfreq(), child.word(), 1, child))
+
+        return (subroot.subfreq(), words, freqs)
+
+
+    def get_words_fuzzy(self, prefix, max_edits=1):
+        # Like get_words, but also matches words whose beginning is within
+        # max_edits edits of prefix. Returns the edit distance of each word
+        # as a fourth list.
+        words = []
+        freqs = []
+        dists = []
+        root_row = list(range(len(prefix) + 1))
+        stack = [(child, root_row, root_row[-1]) for child in self._root.children()]
+        while stack:
+            node, parent_row, parent_dist = stack.pop()
+            row = _edit_row(parent_row, prefix, node.word()[-1])
+            dist = min(parent_dist, row[-1])
+            lowest = min(row)
+            if lowest >= dist:
+                # No longer prefix of the subtree can get closer.
+                if dist <= max_edits:
+                    for match in [node, *node.descendants()]:
+                        if match.freq() > 0 and match.word() != prefix:
+                            words.append(match.word())
+                            freqs.append(match.freq())
+                            dists.append(dist)
+                continue
+            if lowest > max_edits:
+                continue
+            if dist <= max_edits and node.freq() > 0 and node.word() != prefix:
+                words.append(node.word())
+                freqs.append(node.freq())
+                dists.append(dist)
+            for child in node.children():
+                stack.append((child, row, dist))
+
+        return (sum(freqs), words, freqs, dists)
+
+
 
 class FreqTrieNode:
     def __init__(self, word=None):
@@ -34,27 +141,37 @@ class FreqTrieNode:
             self._word = word
         self._freq = 0
         self._subfreq = 0
+        # Highest freq of any word in this subtree, including this node.
+        self._maxfreq = 0
         self._children = {}
 
-    
+
     def add_suffix(self, suffix, n=1):
-        if suffix == '':
-            self.increment_freq(n)
-        else:
-            self.increment_subfreq(n)
-            head = suffix[0]
-            tail = suffix[1:]
-            self.child(head).add_suffix(tail)
-    
+        node = self
+        path = [node]
+        for head in suffix:
+            node.increment_subfreq(n)
+            node = node.child(head)
+            path.append(node)
+        node.increment_freq(n)
+        for ancestor in path:
+            ancestor.update_maxfreq(node.freq())
+        return node.freq()
+
 
     def increment_freq(self, n=1):
         self._freq += n
 
-    
+
     def increment_subfreq(self, n=1):
         self._subfreq += n
 
 
+    def update_maxfreq(self, freq):
+        if freq > self._maxfreq:
+            self._maxfreq = freq
+
+
     def word(self):
         return self._word
 
@@ -67,24 +184,408 @@ class FreqTrieNode:
         return self._subfreq
 
 
+    def maxfreq(self):
+        return self._maxfreq
+
+
+    def children(self):
+        return self._children.values()
+
+
     def child(self, suffix, create=True):
-        if suffix == '':
-            return self
-        else:
-            head = suffix[0]
-            tail = suffix[1:]
-            if head not in self._children:
+        node = self
+        for head in suffix:
+            if head not in node._children:
                 if not create:
                     return None
-                child_word = self._word + head
-                child = FreqTrieNode(child_word)
-                self._children[head] = child
-            return self._children[head].child(tail)
+                node._children[head] = FreqTrieNode(node._word + head)
+            node = node._children[head]
+        return node
 
 
     def descendants(self):
-        nodes = []
-        for child in self._children.values():
-            nodes.append(child)
-            nodes.extend(child.descendants())
-        return nodes
+        # Pre-order, children in insertion order, without recursion.
+        stack = list(reversed(self._children.values()))
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node._children.values()))
+
+
+
+class CompactFreqTrie:
+    # Same interface as FreqTrie, but the nodes live in flat arrays instead of
+    # one object per character. Nodes are numbered breadth first with the root
+    # as node 0, so the children of node i are the contiguous range
+    # [first_child[i], first_child[i+1]), sorted by their edge label. Words
+    # are not stored, they are spelled out by the labels along the path.
+    _PENDING_SHARE = 16
+
+    def __init__(self):
+        self._first_child = array('i', [1, 1])
+        self._labels = array('I', [0])
+        self._freq = array('q', [0])
+        self._subfreq = array('q', [0])
+        self._maxfreq = array('q', [0])
+        # Words whose path does not exist yet, in a FreqTrie that queries
+        # search along with the arrays. They are merged into the arrays by a
+        # rebuild once there have been more additions to them than
+        # 1/_PENDING_SHARE of the nodes, so rebuilds add up to O(1) per word.
+        self._pending = FreqTrie()
+        self._pending_words = 0
+
+
+    @classmethod
+    def from_counts(cls, counts):
+        merged = {}
+        for word, freq in counts:
+            merged[word] = merged.get(word, 0) + freq
+        trie = cls()
+        trie._build(sorted(merged.items()))
+        return trie
+
+
+    # Sidecar file layout: header, then the arrays in the order below, each
+    # starting on an 8 byte boundary. Arrays are in native byte order, the
+    # byte order mark in the header rejects files from other machines.
+    _MAGIC = b'FREQTRIE'
+    _VERSION = 1
+    _HEADER = struct.Struct('=8sII20sq')
+    _ARRAYS = [('_first_child', 'i'), ('_labels', 'I'), ('_freq', 'q'), ('_subfreq', 'q'), ('_maxfreq', 'q')]
+
+
+    def save(self, path, key):
+        # key: digest of the vocabulary the trie was built from, see vocab_key.
+        self._flush()
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self._HEADER.pack(self._MAGIC, self._VERSION, 0x01020304, key, len(self._labels)))
+            for name, _ in self._ARRAYS:
+                f.write(b'\0' * (-f.tell() % 8))
+                f.write(getattr(self, name))
+        os.replace(tmp_path, path)
+
+
+    @classmethod
+    def open(cls, path, key):
+        # Maps a file written by save. The arrays are read straight from the
+        # mapped pages. The mapping is copy-on-write, so counts can still be
+        # updated in memory without touching the file. Returns None if the
+        # file is missing, damaged or was built from another vocabulary.
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return None
+        if len(mapped) < cls._HEADER.size:
+            return None
+        magic, version, order, file_key, size = cls._HEADER.unpack_from(mapped)
+        if (magic, version, order, file_key) != (cls._MAGIC, cls._VERSION, 0x01020304, key):
+            return None
+
+        trie = cls()
+        view = memoryview(mapped)
+        offset = cls._HEADER.size
+        for name, typecode in cls._ARRAYS:
+            count = size + 1 if name == '_first_child' else size
+            offset += -offset % 8
+            end = offset + count * array(typecode).itemsize
+            if end > len(mapped):
+                return None
+            setattr(trie, name, view[offset:end].cast(typecode))
+            offset = end
+        return trie
+
+
+    def add_word(self, word, n=1):
+        path = self._path(word)
+        if path is None:
+            self._pending.add_word(word, n)
+            self._pending_words += 1
+            return
+        for node in path[:-1]:
+            self._subfreq[node] += n
+        self._freq[path[-1]] += n
+        freq = self._freq[path[-1]]
+        for node in path:
+            if self._maxfreq[node] < freq:
+                self._maxfreq[node] = freq
+
+
+    def get_words(self, prefix):
+        self._flush(everything=False)
+        total_freqs, words, freqs = self._get_words(prefix)
+        if self._pending_words == 0:
+            return (total_freqs, words, freqs)
+        pending_total, pending_words, pending_freqs = self._pending.get_words(prefix)
+        merged = list(merge(zip(words, freqs), sorted(zip(pending_words, pending_freqs))))
+        return (total_freqs + pending_total, [word for word, _ in merged], [freq for _, freq in merged])
+
+
+    def _get_words(self, prefix):
+        path = self._path(prefix)
+        if path is None:
+            return (0, [], [])
+
+        subroot = path[-1]
+        total_freqs = self._subfreq[subroot]
+        words = []
+        freqs = []
+
+        for node, word in self._descendants(subroot, prefix):
+            freq = self._freq[node]
+            if freq > 0:
+                words.append(word)
+                freqs.append(freq)
+
+        return (total_freqs, words, freqs)
+
+
+    def top_k(self, prefix, k):
+        self._flush(everything=False)
+        total_freqs, words, freqs = self._top_k(prefix, k)
+        if self._pending_words == 0:
+            return (total_freqs, words, freqs)
+        pending_total, pending_words, pending_freqs = self._pending.top_k(prefix, k)
+        best = list(merge(zip(freqs, words), zip(pending_freqs, pending_words), key=lambda pair: (-pair[0], pair[1])))[:k]
+        return (total_freqs + pending_total, [word for _, word in best], [freq for freq, _ in best])
+
+
+    def _top_k(self, prefix, k):
+        # Same best-first search as FreqTrie.top_k, on node indices.
+        path = self._path(prefix)
+        if path is None:
+            return (0, [], [])
+
+        subroot = path[-1]
+        heap = []
+        for child in range(self._first_child[subroot], self._first_child[subroot + 1]):
+            if self._maxfreq[child] > 0:
+                heap.append((-self._maxfreq[child], prefix + chr(self._labels[child]), 1, child))
+        heapify(heap)
+        words = []
+        freqs = []
+        while heap and len(words) < k:
+            neg_freq, word, is_node, node = heappop(heap)
+            if not is_node:
+                words.append(word)
+                freqs.append(-neg_freq)
+                continue
+            if self._freq[node] > 0:
+                heappush(heap, (-self._freq[node], word, 0, node))
+            for child in range(self._first_child[node], self._first_child[node + 1]):
+                if self._maxfreq[child] > 0:
+                    heappush(heap, (-self._maxfreq[child], word + chr(self._labels[child]), 1, child))
+
+        return (self._subfreq[subroot], words, freqs)
+
+
+    def get_words_fuzzy(self, prefix, max_edits=1):
+        # Same walk as FreqTrie.get_words_fuzzy, on node indices, followed
+        # by the pending words.
+        self._flush(everything=False)
+        words = []
+        freqs = []
+        dists = []
+        root_row = list(range(len(prefix) + 1))
+        stack = []
+        for child in range(self._first_child[0], self._first_child[1]):
+            stack.append((child, chr(self._labels[child]), root_row, root_row[-1]))
+        while stack:
+            node, word, parent_row, parent_dist = stack.pop()
+            row = _edit_row(parent_row, prefix, word[-1])
+            dist = min(parent_dist, row[-1])
+            lowest = min(row)
+            if lowest >= dist:
+                if dist <= max_edits:
+                    for match, match_word in [(node, word), *self._descendants(node, word)]:
+                        if self._freq[match] > 0 and match_word != prefix:
+                            words.append(match_word)
+                            freqs.append(self._freq[match])
+                            dists.append(dist)
+                continue
+            if lowest > max_edits:
+                continue
+            if dist <= max_edits and self._freq[node] > 0 and word != prefix:
+                words.append(word)
+                freqs.append(self._freq[node])
+                dists.append(dist)
+            for child in range(self._first_child[node], self._first_child[node + 1]):
+                stack.append((child, word + chr(self._labels[child]), row, dist))
+
+        if self._pending_words > 0:
+            _, pending_words, pending_freqs, pending_dists = self._pending.get_words_fuzzy(prefix, max_edits)
+            words += pending_words
+            freqs += pending_freqs
+            dists += pending_dists
+        return (sum(freqs), words, freqs, dists)
+
+
+    def node_count(self):
+        self._flush()
+        return len(self._labels)
+
+
+    def _child(self, node, char):
+        lo = self._first_child[node]
+        hi = self._first_child[node + 1]
+        label = ord(char)
+        i = bisect_left(self._labels, label, lo, hi)
+        if i < hi and self._labels[i] == label:
+            return i
+        return None
+
+
+    def _path(self, word):
+        node = 0
+        path = [node]
+        for char in word:
+            node = self._child(node, char)
+            if node is None:
+                return None
+            path.append(node)
+        return path
+
+
+    def _descendants(self, subroot, prefix):
+        # Pre-order walk yielding (node, word) in lexicographic order. Like
+        # FreqTrieNode.descendants, the subroot itself is not included.
+        stack = [(subroot, prefix)]
+        while stack:
+            node, word = stack.pop()
+            if node != subroot:
+                yield node, word
+            lo = self._first_child[node]
+            hi = self._first_child[node + 1]
+            for child in range(hi - 1, lo - 1, -1):
+                stack.append((child, word + chr(self._labels[child])))
+
+
+    def _flush(self, everything=True):
+        # Rebuilds the arrays with the pending words, or with everything
+        # False only once there are enough of them.
+        if self._pending_words == 0:
+            return
+        if not everything and self._pending_words * self._PENDING_SHARE < len(self._labels):
+            return
+        counts = {}
+        if self._freq[0] > 0:
+            counts[''] = self._freq[0]
+        for node, word in self._descendants(0, ''):
+            is_leaf = self._first_child[node] == self._first_child[node + 1]
+            if self._freq[node] > 0 or is_leaf:
+                counts[word] = self._freq[node]
+        for node in self._pending._root.descendants():
+            if node.freq() > 0 or len(node.children()) == 0:
+                counts[node.word()] = counts.get(node.word(), 0) + node.freq()
+        self._build(sorted(counts.items()))
+        self._pending = FreqTrie()
+        self._pending_words = 0
+
+
+    def _build(self, items):
+        # items: (word, freq) pairs sorted by word, without duplicates. Every
+        # node corresponds to the range of items sharing its prefix, so the
+        # trie can be laid out level by level from those ranges.
+        words = [word for word, _ in items]
+        cumfreq = [0]
+        for _, freq in items:
+            cumfreq.append(cumfreq[-1] + freq)
+
+        first_child = array('i')
+        labels = array('I', [0])
+        freqs = array('q')
+        subfreqs = array('q')
+        queue = deque([(0, len(words), 0)])
+        next_node = 1
+        while queue:
+            start, end, depth = queue.popleft()
+            first_child.append(next_node)
+            freq = 0
+            i = start
+            if i < end and len(words[i]) == depth:
+                freq = items[i][1]
+                i += 1
+            freqs.append(freq)
+            subfreqs.append(cumfreq[end] - cumfreq[start] - freq)
+            while i < end:
+                char = words[i][depth]
+                j = i + 1
+                while j < end and words[j][depth] == char:
+                    j += 1
+                labels.append(ord(char))
+                queue.append((i, j, depth + 1))
+                next_node += 1
+                i = j
+        first_child.append(next_node)
+
+        # Children are numbered after their parent, so a reverse sweep sees
+        # every child before the node it belongs to.
+        maxfreqs = array('q', freqs)
+        for node in range(len(maxfreqs) - 1, -1, -1):
+            for child in range(first_child[node], first_child[node + 1]):
+                if maxfreqs[node] < maxfreqs[child]:
+                    maxfreqs[node] = maxfreqs[child]
+
+        self._first_child = first_child
+        self._labels = labels
+        self._freq = freqs
+        self._subfreq = subfreqs
+        self._maxfreq = maxfreqs
+
+
+
+def _edit_row(row, prefix, char):
+    # One step of the Levenshtein table between prefix and a trie path:
+    # row[j] is the distance between prefix[:j] and the path so far, the
+    # returned row the same after appending char to the path.
+    left = row[0] + 1
+    next_row = [left]
+    for j in range(1, len(row)):
+        dist = row[j - 1] if prefix[j - 1] == char else row[j - 1] + 1
+        if row[j] + 1 < dist:
+            dist = row[j] + 1
+        if left + 1 < dist:
+            dist = left + 1
+        next_row.append(dist)
+        left = dist
+    return next_row
+
+
+TRIE_TYPES = {
+    'dict': FreqTrie,
+    'compact': CompactFreqTrie,
+    # A CompactFreqTrie persisted next to the model, see make_trie.
+    'mmap': CompactFreqTrie,
+}
+
+
+def vocab_key(counts):
+    digest = hashlib.sha1()
+    for word, freq in counts:
+        digest.update(f'{word} {freq}\n'.encode('utf-8'))
+    return digest.digest()
+
+
+def make_trie(kind='dict', counts=None, sidecar=None):
+    # With kind 'mmap' and a sidecar path, the trie is mapped from the
+    # sidecar if it was built from the same counts, otherwise it is built
+    # and the sidecar (re)written for the next load.
+    if kind not in TRIE_TYPES:
+        options = ', '.join(TRIE_TYPES)
+        raise ValueError(f'Unknown trie type {kind}, expected one of {options}')
+    if counts is None:
+        return TRIE_TYPES[kind]()
+    if kind != 'mmap' or sidecar is None:
+        return TRIE_TYPES[kind].from_counts(counts)
+
+    counts = list(counts)
+    key = vocab_key(counts)
+    trie = CompactFreqTrie.open(sidecar, key)
+    if trie is None:
+        trie = CompactFreqTrie.from_counts(counts)
+        try:
+            trie.save(sidecar, key)
+        except OSError:
+            pass
+    return trie
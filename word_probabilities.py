@@ -18,6 +18,33 @@ class WordProbabilities:
     def most_likely_words(self, input_str: str, n: int) -> tuple[list[str], list[float]]:
         pass
 
+    """
+    inputs: Unsanitized input strings, as for most_likely_words.
+    n: Number of words and probabilities (int) to be returned per input.
+
+    Returns:
+    A list with the tuple most_likely_words returns for each input, in order.
+    Backends override it to handle the whole batch at once.
+    """
+    def most_likely_words_batch(self, inputs: list[str], n: int) -> list[tuple[list[str], list[float]]]:
+        return [self.most_likely_words(input_str, n) for input_str in inputs]
+
+    """
+    input_str: Unsanitized input string typed by the user when the word was chosen.
+    word: The word the user chose, to be learnt as following input_str.
+
+    Models that cannot learn online ignore it.
+    """
+    def observe(self, input_str: str, word: str) -> None:
+        pass
+
+    """
+    Called once the model is no longer used, for models to save what they
+    learnt with observe.
+    """
+    def close(self) -> None:
+        pass
+
 
 """
 Demonstrate class behaviour with mock data.